@@ -0,0 +1,273 @@
+"""
+下载流程的离线基准测试，所有请求都发往本地的模拟服务（见 fake_bilibili.py），不需要访问网络
+
+场景:
+    single  单个大视频的下载 + 合并
+    batch   多个小视频的批量下载
+    info    仅获取视频信息（--info）
+    parse   页面请求与解析
+    merge   ffmpeg 与内置合并器的合并耗时
+    startup 命令行启动耗时（python -X importtime main.py --version），并检查没有导入下载相关的重量级模块
+
+用法:
+    python benchmark/bench_download.py [场景 ...] [--size 256M] [--batch 20] [-c 4] [-j 4]
+                                       [--engine async] [--latency 0.02] [--bandwidth 20M] [--startup-rounds 10]
+                                       [--json result.json]
+
+不指定场景时运行全部场景。--latency / --bandwidth 作用于模拟服务的每个请求/连接，
+用于模拟高延迟或慢速的 CDN 节点。
+"""
+import argparse
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_bilibili import AUDIO_FRAME, AUDIO_TIMESCALE, FakeBilibili, use_fake_api, write_m4s  # noqa: E402
+from tool import parse_size  # noqa: E402
+
+SCENARIOS = ('single', 'batch', 'info', 'parse', 'merge', 'startup')
+
+# 启动阶段不应导入的模块：它们只在下载、登录、查看信息时才需要
+STARTUP_FORBIDDEN = ('curl_cffi', 'qrcode', 'rich.progress', 'download_sync', 'scheduler', 'video_info')
+
+HEADERS = {
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36',
+}
+
+
+def run_tasks(urls: list[str], save_dir: str, args, jobs: int = 1) -> float:
+    from scheduler import AsyncTaskScheduler, TaskScheduler
+    from task import BiliTask
+
+    tasks = [BiliTask(url, dict(HEADERS, Referer=url), None, None, save_dir, connections=args.connections,
+                      merger=args.merger) for url in urls]
+    if args.engine == 'async':
+        scheduler = AsyncTaskScheduler(jobs=jobs, connections=args.connections)
+    else:
+        scheduler = TaskScheduler(jobs=jobs)
+    start = time.perf_counter()
+    succeeded, failed = scheduler.run(tasks)
+    elapsed = time.perf_counter() - start
+    if failed:
+        raise RuntimeError(f'{len(failed)} 个任务失败')
+    return elapsed
+
+
+def bench_single(service: FakeBilibili, work_dir: Path, args) -> dict:
+    size = parse_size(args.size)
+    url = service.add_video('BV1single0001', '单个大视频', size, size // 8, args.duration)
+    elapsed = run_tasks([url], str(work_dir / 'single'), args)
+    total = size + size // 8
+    return {'seconds': elapsed, 'bytes': total}
+
+
+def bench_batch(service: FakeBilibili, work_dir: Path, args) -> dict:
+    size = parse_size(args.batch_size)
+    urls = [service.add_video(f'BV1batch{i:04d}', f'批量视频{i}', size, size // 8, 5) for i in range(args.batch)]
+    elapsed = run_tasks(urls, str(work_dir / 'batch'), args, jobs=args.jobs)
+    return {'seconds': elapsed, 'bytes': (size + size // 8) * args.batch, 'items': args.batch}
+
+
+def bench_info(service: FakeBilibili, work_dir: Path, args) -> dict:
+    import video_info
+
+    urls = [service.add_video(f'BV1info{i:04d}', f'信息视频{i}', 64 * 1024, 16 * 1024, 5) for i in range(args.batch)]
+    # 视频信息只接受 www.bilibili.com 的地址，这里放行模拟服务的地址，并关闭信息面板的输出
+    video_info.BiliVideoInfo.check_url_valid = staticmethod(lambda url: url.startswith(service.base_url))
+    video_info.console.quiet = True
+    page_requests = service.page_requests
+    start = time.perf_counter()
+    results = video_info.resolve_video_infos(urls, HEADERS, args.jobs)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+        result.show()
+    elapsed = time.perf_counter() - start
+    video_info.console.quiet = False
+    return {'seconds': elapsed, 'items': len(urls), 'page_requests': service.page_requests - page_requests}
+
+
+def bench_parse(service: FakeBilibili, work_dir: Path, args) -> dict:
+    from download_sync import parse
+
+    url = service.add_video('BV1parse0001', '解析视频', 64 * 1024, 16 * 1024, 5)
+    rounds = args.batch * 5
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse(url, dict(HEADERS, Referer=url))
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'items': rounds}
+
+
+def audio_edit_duration(path: Path) -> int:
+    """
+    读取合并结果中音频轨道（第二个 trak）编辑列表的 segment_duration
+    """
+    from mp4_mux import find_box, iter_boxes
+    data = path.read_bytes()
+    moov = next(b for b in iter_boxes(data) if b.type == b'moov')
+    trak = [b for b in iter_boxes(data, moov.payload_offset, moov.end) if b.type == b'trak'][1]
+    elst = find_box(data, find_box(data, trak, b'edts'), b'elst')
+    return struct.unpack_from('>I', data, elst.payload_offset + 8)[0]
+
+
+def bench_merge(service: FakeBilibili, work_dir: Path, args) -> dict:
+    from mp4_mux import merge_m4s_native
+    from tool import get_ffmpeg_path, merge_m4s_ffmpeg
+
+    size = parse_size(args.size)
+    video, audio = work_dir / 'merge_v.m4s', work_dir / 'merge_a.m4s'
+    write_m4s(video, 'video', size, args.duration)
+    # 音频文件的 mvhd 使用与视频不同的时间单位，并带有跳过前导帧的编辑列表，检查合并后编辑列表是否被正确换算
+    write_m4s(audio, 'audio', size // 8, args.duration, movie_timescale=AUDIO_TIMESCALE, media_time=AUDIO_FRAME)
+    result = {'bytes': video.stat().st_size + audio.stat().st_size}
+
+    mergers = {'native': merge_m4s_native}
+    if Path(get_ffmpeg_path()).exists():
+        mergers['ffmpeg'] = merge_m4s_ffmpeg
+    for name, merge in mergers.items():
+        output = work_dir / f'merge_{name}.mp4'
+        start = time.perf_counter()
+        if not merge(str(video), str(audio), str(output)):
+            raise RuntimeError(f'{name} 合并失败')
+        result[f'{name}_seconds'] = time.perf_counter() - start
+        if name == 'native' and audio_edit_duration(output) != args.duration * 1000:
+            raise RuntimeError(f'音频编辑列表时长错误: {audio_edit_duration(output)}，应为 {args.duration * 1000}')
+        output.unlink()
+    result['seconds'] = min(value for key, value in result.items() if key.endswith('_seconds'))
+    return result
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """
+    解析 -X importtime 的输出，返回 [(模块名, 累计导入耗时（微秒）, 嵌套层级)]，层级为 0 的是顶层导入
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(cumulative), depth))
+    return modules
+
+
+def bench_startup(service: FakeBilibili, work_dir: Path, args) -> dict:
+    walls, import_times = [], []
+    modules = []
+    for _ in range(args.startup_rounds):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', str(ROOT / 'main.py'), '--version'],
+                              capture_output=True, text=True, cwd=work_dir)
+        walls.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError(f'启动失败: {proc.stderr[-500:]}')
+        modules = parse_importtime(proc.stderr)
+        import_times.append(sum(us for _, us, depth in modules if depth == 0))
+
+    loaded = [forbidden for forbidden in STARTUP_FORBIDDEN
+              if any(name == forbidden or name.startswith(f'{forbidden}.') for name, _, _ in modules)]
+    if loaded:
+        raise RuntimeError(f'启动时导入了重量级模块: {", ".join(loaded)}')
+    top = sorted((item for item in modules if item[2] == 0), key=lambda item: item[1], reverse=True)[:5]
+    return {
+        'seconds': statistics.median(walls),
+        'rounds': args.startup_rounds,
+        'import_seconds': statistics.median(import_times) / 1e6,
+        'top_imports_ms': {name: us / 1000 for name, us, _ in top},
+    }
+
+
+BENCHMARKS = {
+    'single': bench_single,
+    'batch': bench_batch,
+    'info': bench_info,
+    'parse': bench_parse,
+    'merge': bench_merge,
+    'startup': bench_startup,
+}
+
+
+def format_result(name: str, result: dict) -> str:
+    line = f'{name:<8} {result["seconds"]:>8.3f} s'
+    if 'bytes' in result:
+        line += f'  {result["bytes"] / 1024 / 1024:>9.1f} MiB  {result["bytes"] / 1024 / 1024 / result["seconds"]:>8.1f} MiB/s'
+    if 'items' in result:
+        line += f'  {result["items"]:>5} 个  {result["seconds"] / result["items"] * 1000:>8.1f} ms/个'
+    for key, value in result.items():
+        if key.endswith('_seconds'):
+            line += f'  {key[:-8]}: {value:.3f} s'
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bilix 离线基准测试')
+    parser.add_argument('scenarios', nargs='*', help=f'要运行的场景 {"/".join(SCENARIOS)}，默认全部')
+    parser.add_argument('--size', default='128M', help='single / merge 场景的视频流大小')
+    parser.add_argument('--duration', type=int, default=60, help='single / merge 场景的视频时长（秒）')
+    parser.add_argument('--batch', type=int, default=20, help='batch / info 场景的视频数量')
+    parser.add_argument('--batch-size', default='2M', help='batch 场景每个视频流的大小')
+    parser.add_argument('-c', '--connections', type=int, default=4, help='每个流的并发连接数')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='batch 场景同时下载的视频数量，info 场景同时获取信息的视频数量')
+    parser.add_argument('--engine', default='thread', choices=['thread', 'async'], help='下载场景使用的下载引擎')
+    parser.add_argument('--write-buffer', default=None, help='下载场景写文件的缓冲区大小，例如 1M、16M')
+    parser.add_argument('--fsync', action='store_true', help='下载场景每个文件完成后调用 fsync')
+    parser.add_argument('--no-preallocate', action='store_true', help='下载场景不预分配磁盘空间')
+    parser.add_argument('--merger', default='native', choices=['ffmpeg', 'native'], help='下载场景使用的合并方式')
+    parser.add_argument('--latency', type=float, default=0.0, help='模拟服务每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth', default='0', help='模拟服务每个连接的带宽上限，例如 20M')
+    parser.add_argument('--slow-backup', action='store_true', help='备用镜像只有四分之一带宽')
+    parser.add_argument('--startup-rounds', type=int, default=10, help='startup 场景启动命令行的次数')
+    parser.add_argument('--json', help='把结果以 JSON 格式写入该文件，便于对比不同版本')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'未知的场景: {", ".join(sorted(unknown))}')
+
+    from file_writer import configure_writer
+    from log_config import log_init
+    from meta_cache import meta_cache
+
+    log_init()
+    configure_writer(parse_size(args.write_buffer), args.fsync, not args.no_preallocate)
+    # 每次都要真实地请求模拟服务，不使用本地缓存
+    meta_cache.enabled = False
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bilix-bench-out-') as out_dir, \
+            FakeBilibili(args.latency, parse_size(args.bandwidth) or 0, args.slow_backup) as service:
+        use_fake_api(service)
+        # 下载索引放在临时目录中，不影响本机的状态目录，每次运行都真实下载
+        from download_index import INDEX_FILE_NAME, download_index
+        download_index.path = Path(out_dir) / INDEX_FILE_NAME
+        cwd = os.getcwd()
+        os.chdir(out_dir)
+        try:
+            for name in args.scenarios or SCENARIOS:
+                results[name] = BENCHMARKS[name](service, Path(out_dir), args)
+        finally:
+            os.chdir(cwd)
+
+    print()
+    for name, result in results.items():
+        print(format_result(name, result))
+    if 'startup' in results:
+        print('启动时导入最慢的模块: ' + ', '.join(f'{name} {ms:.1f} ms'
+                                              for name, ms in results['startup']['top_imports_ms'].items()))
+    if args.json:
+        Path(args.json).write_text(json.dumps({'args': vars(args), 'results': results}, ensure_ascii=False, indent=2),
+                                   encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
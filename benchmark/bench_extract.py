@@ -0,0 +1,65 @@
+"""
+页面内容提取的微基准：对比旧的多次正则扫描与 tool.extract_page 的单次扫描
+
+用法:
+    python benchmark/bench_extract.py [保存的页面.html ...]
+
+不指定页面文件时，使用 doc/ 下的 JSON 样例拼出一个模拟的视频页面。
+"""
+import json
+import re
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from tool import extract_page  # noqa: E402
+
+
+def legacy_extract(html_content: str) -> dict:
+    """
+    旧实现：每个字段各自用惰性 .*? 正则扫描一遍整个页面
+    """
+    result = {}
+    patterns = {
+        'playinfo': r'window\.__playinfo__\s*=\s*(\{.*?})\s*</script>',
+        'initial_state': r'window\.__INITIAL_STATE__\s*=\s*(\{.*?})\s*;',
+        'playurl_ssr_data': r'const\s+playurlSSRData\s*=\s*({.*?})\s',
+    }
+    for name, pattern in patterns.items():
+        match = re.search(pattern, html_content, re.DOTALL)
+        result[name] = json.loads(match.group(1)) if match else None
+    match = re.search(r'<title\b[^>]*>(.*?)</title>', html_content, re.IGNORECASE | re.DOTALL)
+    result['title'] = match.group(1).strip() if match else None
+    return result
+
+
+def sample_page() -> str:
+    section = (ROOT / 'doc' / 'bangumi_section.json').read_text(encoding='utf-8')
+    season = (ROOT / 'doc' / 'bangumi_media_season.json').read_text(encoding='utf-8')
+    filler = '<div class="placeholder">' + 'x' * 200 + '</div>\n'
+    return (
+        '<!DOCTYPE html><html><head><title>样例视频_哔哩哔哩_bilibili</title>'
+        + filler * 200
+        + '<script>window.__playinfo__=' + json.dumps(json.loads(season)) + '</script>'
+        + filler * 400
+        + '<script>window.__INITIAL_STATE__=' + json.dumps(json.loads(section)) + ';(function(){}());</script>'
+        + filler * 400
+        + '</head><body></body></html>'
+    )
+
+
+def main():
+    pages = [(p, Path(p).read_text(encoding='utf-8')) for p in sys.argv[1:]] or [('sample', sample_page())]
+    for name, html in pages:
+        number = 50
+        legacy = timeit.timeit(lambda: legacy_extract(html), number=number) / number
+        single = timeit.timeit(lambda: extract_page(html), number=number) / number
+        print(f'{name}: {len(html) / 1024:.0f} KB | legacy {legacy * 1000:.2f} ms | '
+              f'single-pass {single * 1000:.2f} ms | x{legacy / single:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+"""
+离线基准测试使用的本地模拟 Bilibili 服务
+
+提供以下接口，全部运行在 127.0.0.1 上，不需要访问网络:
+    /video/{bvid}                  视频网页（包含 __playinfo__ 和 __INITIAL_STATE__）
+    /x/web-interface/wbi/view      稿件信息接口
+    /x/player/playurl              UGC 取流接口
+    /upos/{bvid}/{kind}.m4s        合成的 fMP4 音视频流，支持 Range 请求
+    /upos-backup/{bvid}/{kind}.m4s 同上，作为 backupUrl 镜像
+
+可以为每个请求注入固定延迟，以及限制每个连接的带宽，用来模拟慢速 CDN 节点。
+
+单独运行时启动服务并打印视频地址:
+    python benchmark/fake_bilibili.py --videos 3 --size 32M --latency 0.05 --bandwidth 10M
+"""
+import argparse
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 320x240 H.264 baseline 的 avcC、一帧灰色画面的 IDR 以及 AAC 的 esds，
+# 用于合成可以被 ffmpeg 识别和探测的音视频流
+AVCC = bytes.fromhex('0142c00dffe100176742c00ddc141fb011000003000100000300320f142b8001000468ce0fc8')
+IDR_FRAME = bytes.fromhex(
+    '6588843a26280c9c9c9c9c9c9c9c9c9c9c9c9c9c9c9c9c9c9c9d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75'
+    'd75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75'
+    'd75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75'
+    'd75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75'
+    'd75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75d75e'
+)
+ESDS = bytes.fromhex('0000000003808080250001000480808017401500000000010d8800010d880580808005120856e500068080800102')
+
+VIDEO_TIMESCALE = 12800
+VIDEO_FPS = 25
+AUDIO_TIMESCALE = 44100
+AUDIO_FRAME = 1024
+
+# 每个视频都提供的清晰度，以及对应的编码；不同清晰度实际指向同一个文件，只用于测试流选择
+QUALITIES = [(80, 7, 'avc1.640032'), (64, 7, 'avc1.640028'), (80, 12, 'hev1.1.6.L120.90')]
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload) + 8) + box_type + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def init_segment(kind: str, movie_timescale: int = 1000, edit: Optional[tuple[int, int]] = None) -> bytes:
+    """
+    生成只包含一条轨道的 fMP4 初始化段（ftyp + moov）
+
+    movie_timescale 为 mvhd 的时间单位；edit 不为 None 时写入编辑列表 (segment_duration, media_time)，
+    前者以 movie_timescale 计，后者以轨道的时间单位计（例如跳过音频编码器的前导帧）
+    """
+    video = kind == 'video'
+    timescale = VIDEO_TIMESCALE if video else AUDIO_TIMESCALE
+    duration = timescale // VIDEO_FPS if video else AUDIO_FRAME
+
+    tkhd = full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0) + bytes(8)
+                    + struct.pack('>hhhH', 0, 0, 0 if video else 0x0100, 0) + MATRIX
+                    + struct.pack('>II', (320 << 16) if video else 0, (240 << 16) if video else 0))
+    mdhd = full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, 0, 0x55c4, 0))
+    hdlr = full_box(b'hdlr', 0, 0, struct.pack('>I4s12s', 0, b'vide' if video else b'soun', bytes(12))
+                    + (b'VideoHandler\0' if video else b'SoundHandler\0'))
+    if video:
+        entry = box(b'avc1', bytes(6) + struct.pack('>H', 1) + bytes(16) + struct.pack('>HHIIIH', 320, 240, 0x480000, 0x480000, 0, 1)
+                    + bytes(32) + struct.pack('>Hh', 0x18, -1) + box(b'avcC', AVCC))
+        media_header = full_box(b'vmhd', 0, 1, bytes(8))
+    else:
+        entry = box(b'mp4a', bytes(6) + struct.pack('>H', 1) + bytes(8) + struct.pack('>HHHHI', 2, 16, 0, 0, AUDIO_TIMESCALE << 16)
+                    + full_box(b'esds', 0, 0, ESDS[4:]))
+        media_header = full_box(b'smhd', 0, 0, bytes(4))
+    stbl = box(b'stbl', full_box(b'stsd', 0, 0, struct.pack('>I', 1) + entry)
+               + full_box(b'stts', 0, 0, bytes(4)) + full_box(b'stsc', 0, 0, bytes(4))
+               + full_box(b'stsz', 0, 0, bytes(8)) + full_box(b'stco', 0, 0, bytes(4)))
+    dinf = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1) + full_box(b'url ', 0, 1, b'')))
+    edts = box(b'edts', full_box(b'elst', 0, 0, struct.pack('>IIiI', 1, *edit, 0x10000))) if edit else b''
+    trak = box(b'trak', tkhd + edts + box(b'mdia', mdhd + hdlr + box(b'minf', media_header + dinf + stbl)))
+    mvhd = full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, movie_timescale, 0, 0x10000, 0x0100) + bytes(10)
+                    + MATRIX + bytes(24) + struct.pack('>I', 2))
+    trex = full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, duration, 0, 0))
+    ftyp = box(b'ftyp', b'iso5' + struct.pack('>I', 512) + b'iso5iso6mp41')
+    return ftyp + box(b'moov', mvhd + trak + box(b'mvex', trex))
+
+
+def fragment(sequence: int, decode_time: int, sample_duration: int, sample_sizes: list[int], payload: bytes) -> bytes:
+    """
+    生成一个 moof + mdat 分片，trun 中记录每个样本的时长和大小
+    """
+    def build(data_offset: int) -> bytes:
+        trun = full_box(b'trun', 0, 0x000301, struct.pack('>Ii', len(sample_sizes), data_offset)
+                        + b''.join(struct.pack('>II', sample_duration, size) for size in sample_sizes))
+        traf = box(b'traf', full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+                   + full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)) + trun)
+        return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)) + traf)
+
+    moof = build(0)
+    return build(len(moof) + 8) + box(b'mdat', payload)
+
+
+def video_sample(size: int) -> bytes:
+    """
+    一个视频样本：IDR 帧加上填充 NAL（类型 12，解码器会忽略）凑够 size 字节
+    """
+    sample = struct.pack('>I', len(IDR_FRAME)) + IDR_FRAME
+    filler = max(2, size - len(sample) - 4)
+    return sample + struct.pack('>I', filler) + b'\x0c' + b'\xff' * (filler - 2) + b'\x80'
+
+
+def write_m4s(path: Path, kind: str, size: int, duration: int, movie_timescale: int = 1000,
+              media_time: Optional[int] = None):
+    """
+    写出一个约 size 字节、时长 duration 秒的合成 fMP4 文件，每秒一个分片
+
+    视频样本可以被正常解码，音频样本为随机数据（ffmpeg 只复制不解码，不影响合并）。
+    media_time 不为 None 时写入从该位置开始、长度为 duration 秒的编辑列表。
+    """
+    video = kind == 'video'
+    samples_per_second = VIDEO_FPS if video else AUDIO_TIMESCALE // AUDIO_FRAME
+    sample_duration = VIDEO_TIMESCALE // VIDEO_FPS if video else AUDIO_FRAME
+    sample_size = max(1, size // (duration * samples_per_second))
+    sample = video_sample(sample_size) if video else os.urandom(sample_size)
+    payload = sample * samples_per_second
+    with open(path, 'wb') as f:
+        edit = None if media_time is None else (duration * movie_timescale, media_time)
+        f.write(init_segment(kind, movie_timescale, edit))
+        for second in range(duration):
+            f.write(fragment(second + 1, second * samples_per_second * sample_duration, sample_duration,
+                             [len(sample)] * samples_per_second, payload))
+
+
+class FakeVideo:
+    def __init__(self, bvid: str, title: str, video_size: int, audio_size: int, duration: int, pages: int = 1,
+                 pubdate: int = 1700000000):
+        self.bvid = bvid
+        self.title = title
+        self.video_size = video_size
+        self.audio_size = audio_size
+        self.duration = duration
+        self.pages = pages
+        self.pubdate = pubdate
+        self.cid = int(re.sub(r'\D', '', bvid) or 1)
+
+    def archive(self) -> dict:
+        return {
+            'bvid': self.bvid, 'aid': self.cid, 'cid': self.cid, 'title': self.title, 'desc': '基准测试视频',
+            'tname': '测试', 'tname_v2': '测试', 'pubdate': self.pubdate, 'ctime': self.pubdate, 'duration': self.duration,
+            'owner': {'mid': 1, 'name': 'bilix'},
+            'pages': [{'cid': self.cid + i, 'page': i + 1, 'part': f'P{i + 1}', 'duration': self.duration}
+                      for i in range(self.pages)],
+        }
+
+    def space_entry(self) -> dict:
+        return {'bvid': self.bvid, 'aid': self.cid, 'title': self.title, 'created': self.pubdate,
+                'length': f'{self.duration // 60:02d}:{self.duration % 60:02d}', 'mid': 1}
+
+    def dash(self, base_url: str) -> dict:
+        # 备用镜像使用 localhost 访问同一个服务，在客户端看来是另一个 CDN 节点
+        backup_base = base_url.replace('127.0.0.1', 'localhost')
+
+        def stream(kind: str, entry: dict) -> dict:
+            path = f'{self.bvid}/{kind}.m4s'
+            url = f'{base_url}/upos/{path}'
+            backup = [f'{backup_base}/upos-backup/{path}']
+            return dict(entry, baseUrl=url, base_url=url, backupUrl=backup, backup_url=backup)
+
+        videos = [stream('video', {'id': qn, 'codecid': codecid, 'codecs': codecs, 'width': 320, 'height': 240,
+                                   'bandwidth': self.video_size * 8 // self.duration})
+                  for qn, codecid, codecs in QUALITIES]
+        audios = [stream('audio', {'id': 30280, 'codecs': 'mp4a.40.2',
+                                   'bandwidth': self.audio_size * 8 // self.duration})]
+        return {'duration': self.duration, 'video': videos, 'audio': audios}
+
+    def playinfo(self, base_url: str) -> dict:
+        return {'code': 0, 'message': '0', 'data': {
+            'format': 'flv', 'timelength': self.duration * 1000, 'accept_quality': [80, 64],
+            'accept_description': ['高清 1080P', '高清 720P'], 'dash': self.dash(base_url),
+        }}
+
+    def initial_state(self) -> dict:
+        archive = self.archive()
+        return {'aid': archive['aid'], 'bvid': self.bvid, 'cid': self.cid, 'videoData': archive}
+
+
+def padding_scripts() -> str:
+    """
+    真实页面中除了需要的几段 JSON 外还有大量其他内容，这里用 doc/ 下的 JSON 样例填充到相近的大小
+    """
+    parts = []
+    for name in ('bangumi_section.json', 'bangumi_media_season.json'):
+        path = ROOT / 'doc' / name
+        if path.is_file():
+            parts.append(f'<script>window.__sample_{path.stem}__={path.read_text(encoding="utf-8")}</script>')
+    return '\n'.join(parts)
+
+
+class FakeBilibili:
+    """
+    本地模拟服务
+
+    latency 为每个请求的额外延迟（秒），bandwidth 为每个连接的带宽上限（字节/秒，0 表示不限），
+    slow_backup 为 True 时备用镜像的带宽再降为四分之一，用于测试镜像选择。
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: int = 0, slow_backup: bool = False,
+                 host: str = '127.0.0.1', port: int = 0, data_dir: Optional[str] = None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.slow_backup = slow_backup
+        self.videos: dict[str, FakeVideo] = {}
+        self.pages: dict[str, str] = {}
+        # 视频网页被请求的次数，用于检查是否有重复请求
+        self.page_requests = 0
+        # UP 主投稿列表被请求的次数，用于检查增量同步
+        self.space_requests = 0
+        self.tmp_dir = None if data_dir else tempfile.TemporaryDirectory(prefix='bilix-bench-')
+        self.data_dir = Path(data_dir or self.tmp_dir.name)
+        self.padding = padding_scripts()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add_video(self, bvid: str, title: str, video_size: int, audio_size: int, duration: int = 10,
+                  pages: int = 1) -> str:
+        """
+        注册一个视频并生成对应的 m4s 文件，返回视频网页地址
+
+        视频按注册顺序依次晚一分钟发布，都属于 mid 为 1 的 UP 主。
+        """
+        video = FakeVideo(bvid, title, video_size, audio_size, duration, pages, 1700000000 + len(self.videos) * 60)
+        stream_dir = self.data_dir / bvid
+        stream_dir.mkdir(parents=True, exist_ok=True)
+        write_m4s(stream_dir / 'video.m4s', 'video', video_size, duration)
+        write_m4s(stream_dir / 'audio.m4s', 'audio', audio_size, duration)
+        with self.lock:
+            self.videos[bvid] = video
+        return f'{self.base_url}/video/{bvid}'
+
+    def add_page(self, bvid: str, html: str) -> str:
+        """
+        回放一个保存下来的真实视频网页，返回网页地址
+        """
+        with self.lock:
+            self.pages[bvid] = html
+        return f'{self.base_url}/video/{bvid}'
+
+    def watch_page(self, video: FakeVideo) -> str:
+        return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{video.title}_哔哩哔哩_bilibili</title></head>'
+                f'<body><script>window.__playinfo__={json.dumps(video.playinfo(self.base_url), ensure_ascii=False)}</script>'
+                f'<script>window.__INITIAL_STATE__={json.dumps(video.initial_state(), ensure_ascii=False)};'
+                f'(function(){{var s;}}());</script>{self.padding}</body></html>')
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if service.latency:
+                    time.sleep(service.latency)
+                parsed = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                try:
+                    if match := re.fullmatch(r'/video/(BV\w+)/?', parsed.path):
+                        self.send_page(match.group(1))
+                    elif parsed.path == '/x/web-interface/wbi/view':
+                        video = service.videos.get(query.get('bvid'))
+                        self.send_json({'code': 0, 'data': video.archive()} if video else {'code': -404})
+                    elif parsed.path == '/x/player/playurl':
+                        video = service.videos.get(query.get('bvid'))
+                        self.send_json({'code': 0, 'data': video.playinfo(service.base_url)['data']}
+                                       if video else {'code': -404})
+                    elif parsed.path == '/x/web-interface/nav':
+                        self.send_json({'code': -101, 'message': '账号未登录', 'data': {'isLogin': False, 'wbi_img': {
+                            'img_url': 'https://i0.hdslb.com/bfs/wbi/7cd084941338484aae1ad9425b84077c.png',
+                            'sub_url': 'https://i0.hdslb.com/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png'}}})
+                    elif parsed.path == '/x/space/wbi/arc/search':
+                        self.send_space(query)
+                    elif match := re.fullmatch(r'/(upos|upos-backup)/(BV\w+)/(video|audio)\.m4s', parsed.path):
+                        rate = service.bandwidth
+                        if match.group(1) == 'upos-backup' and service.slow_backup and rate:
+                            rate //= 4
+                        self.send_file(service.data_dir / match.group(2) / f'{match.group(3)}.m4s', rate)
+                    else:
+                        self.send_error(404)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_body(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, data: dict):
+                self.send_body(200, 'application/json', json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+            def send_space(self, query: dict):
+                with service.lock:
+                    service.space_requests += 1
+                    videos = sorted(service.videos.values(), key=lambda video: video.pubdate, reverse=True)
+                if 'w_rid' not in query or 'wts' not in query:
+                    self.send_json({'code': -403, 'message': '访问权限不足'})
+                    return
+                pn, ps = int(query.get('pn', 1)), int(query.get('ps', 30))
+                page = [video.space_entry() for video in videos[(pn - 1) * ps:pn * ps]]
+                self.send_json({'code': 0, 'data': {'list': {'vlist': page},
+                                                    'page': {'pn': pn, 'ps': ps, 'count': len(videos)}}})
+
+            def send_page(self, bvid: str):
+                with service.lock:
+                    service.page_requests += 1
+                if bvid in service.pages:
+                    html = service.pages[bvid]
+                elif bvid in service.videos:
+                    html = service.watch_page(service.videos[bvid])
+                else:
+                    self.send_error(404)
+                    return
+                self.send_body(200, 'text/html; charset=utf-8', html.encode('utf-8'))
+
+            def send_file(self, path: Path, rate: int):
+                if not path.is_file():
+                    self.send_error(404)
+                    return
+                total = path.stat().st_size
+                start, end = 0, total - 1
+                range_header = self.headers.get('Range')
+                if range_header and (match := re.fullmatch(r'bytes=(\d+)-(\d*)', range_header)):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('ETag', f'"{total:x}"')
+                self.end_headers()
+
+                chunk_size = 64 * 1024
+                begin = time.monotonic()
+                sent = 0
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = f.read(min(chunk_size, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                        sent += len(chunk)
+                        if rate:
+                            # 按连接限速：发送速度超过 rate 时等待
+                            delay = sent / rate - (time.monotonic() - begin)
+                            if delay > 0:
+                                time.sleep(delay)
+
+        return Handler
+
+    def start(self) -> 'FakeBilibili':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.tmp_dir:
+            self.tmp_dir.cleanup()
+
+    def __enter__(self) -> 'FakeBilibili':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def use_fake_api(service: FakeBilibili):
+    """
+    把 playurl_api 和 uploader_sync 中的接口地址指向模拟服务
+    """
+    import playurl_api
+    import uploader_sync
+    uploader_sync.NAV_URL = f'{service.base_url}/x/web-interface/nav'
+    uploader_sync.SPACE_VIDEOS_URL = f'{service.base_url}/x/space/wbi/arc/search'
+    uploader_sync.VIDEO_URL = f'{service.base_url}/video/{{bvid}}'
+    playurl_api.ARCHIVE_URL = f'{service.base_url}/x/web-interface/wbi/view'
+    playurl_api.UGC_PLAYURL_URL = f'{service.base_url}/x/player/playurl'
+
+
+def parse_bytes(value: str) -> int:
+    sys.path.insert(0, str(ROOT))
+    from tool import parse_size
+    return parse_size(value) or 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='启动本地模拟 Bilibili 服务')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--videos', type=int, default=1, help='生成的视频数量')
+    parser.add_argument('--size', default='16M', help='每个视频流的大小')
+    parser.add_argument('--duration', type=int, default=10, help='视频时长（秒）')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth', default='0', help='每个连接的带宽上限，例如 5M')
+    parser.add_argument('--slow-backup', action='store_true', help='备用镜像只有四分之一带宽')
+    parser.add_argument('--pages', nargs='*', default=[], help='回放保存的视频网页，文件名为 BV 号')
+    args = parser.parse_args()
+
+    service = FakeBilibili(args.latency, parse_bytes(args.bandwidth), args.slow_backup, port=args.port)
+    size = parse_bytes(args.size)
+    for i in range(args.videos):
+        print(service.add_video(f'BV1bench{i:04d}', f'基准测试视频{i}', size, size // 8, args.duration))
+    for page in args.pages:
+        path = Path(page)
+        print(service.add_page(path.stem, path.read_text(encoding='utf-8')))
+    print(f'模拟服务运行在 {service.base_url}，按 Ctrl+C 退出')
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
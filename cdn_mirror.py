@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Optional, Union
+from urllib.parse import urlsplit
+
+from log_config import app_logger
+from meta_cache import meta_cache
+from rate_limit import byte_limiter
+from session_pool import borrow_session, close_async_response
+
+# 探测每个镜像时下载的字节数，以及探测请求的超时时间（秒）
+PROBE_BYTES = 256 * 1024
+PROBE_TIMEOUT = 5
+
+# 距上次测速超过该时间（秒）的节点会重新探测，否则直接使用记录的排名
+PROBE_MAX_AGE = 3600
+
+# 测速结果的指数加权系数，越大越偏向最近一次的结果
+EWMA_ALPHA = 0.5
+
+
+def stream_mirrors(stream: dict) -> list[str]:
+    """
+    返回 DASH 流的所有候选地址：主地址在前，其后是 backupUrl 中的镜像
+    """
+    urls = [stream.get('baseUrl') or stream.get('base_url')]
+    urls += stream.get('backupUrl') or stream.get('backup_url') or []
+    return list(dict.fromkeys(url for url in urls if url))
+
+
+def mirror_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+class MirrorRanking:
+    """
+    记录各个 CDN 节点的测速结果，用于给镜像排序
+
+    每个节点保存吞吐量（字节/秒）、首包延迟（秒）的加权平均以及连续失败次数，
+    结果同时写入元数据缓存（kind 为 cdn_host），下次运行时可以直接复用。
+    """
+
+    def __init__(self):
+        self.stats: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def get(self, host: str) -> Optional[dict]:
+        with self.lock:
+            if host not in self.stats:
+                self.stats[host] = meta_cache.get('cdn_host', host)
+            return self.stats[host]
+
+    def record(self, host: str, throughput: Optional[float] = None, latency: Optional[float] = None,
+               failed: bool = False):
+        """
+        记录一次测速或下载的结果，failed 为 True 表示该节点出错或被判定为过慢
+        """
+        stats = dict(self.get(host) or {'throughput': 0.0, 'latency': None, 'failures': 0})
+        if failed:
+            stats['failures'] += 1
+        else:
+            stats['failures'] = 0
+            if throughput is not None:
+                stats['throughput'] = throughput if not stats['throughput'] else \
+                    EWMA_ALPHA * throughput + (1 - EWMA_ALPHA) * stats['throughput']
+            if latency is not None:
+                stats['latency'] = latency if stats['latency'] is None else \
+                    EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * stats['latency']
+        stats['updated_at'] = time.time()
+        with self.lock:
+            self.stats[host] = stats
+        meta_cache.set('cdn_host', host, stats)
+
+    def is_fresh(self, host: str) -> bool:
+        stats = self.get(host)
+        return bool(stats) and time.time() - stats['updated_at'] < PROBE_MAX_AGE
+
+    def score(self, host: str) -> float:
+        """
+        吞吐量越高分数越高，每次连续失败分数减半；没有记录的节点为 0
+        """
+        stats = self.get(host)
+        if not stats:
+            return 0.0
+        return stats['throughput'] / (2 ** stats['failures'])
+
+
+mirror_ranking = MirrorRanking()
+
+
+def probe_headers(headers: dict) -> dict:
+    probe_headers = dict(headers)
+    probe_headers['Range'] = f'bytes=0-{PROBE_BYTES - 1}'
+    return probe_headers
+
+
+def check_probe_response(resp):
+    resp.raise_for_status()
+    # 不支持 Range 的节点会返回整个文件，不能用来测速，也不适合分段下载
+    if resp.status_code != 206:
+        raise ValueError(f'镜像未按 Range 返回数据, status: {resp.status_code}')
+
+
+def probe_mirror(url: str, headers: dict) -> tuple[float, float]:
+    """
+    下载文件开头的一小段数据（最多 PROBE_BYTES 字节）来测速，读取的数据计入全局带宽限制
+
+    返回:
+        (首包延迟秒数, 吞吐量字节/秒)，限速等待的时间不计入测速时间
+    """
+    start = time.monotonic()
+    first_byte = None
+    received = 0
+    throttled = 0.0
+    with borrow_session(url) as session:
+        resp = session.get(url, headers=probe_headers(headers), stream=True, timeout=PROBE_TIMEOUT)
+        try:
+            check_probe_response(resp)
+            for chunk in resp.iter_content():
+                if first_byte is None:
+                    first_byte = time.monotonic()
+                received += len(chunk)
+                throttled += byte_limiter.acquire(len(chunk))
+                if received >= PROBE_BYTES:
+                    break
+        finally:
+            resp.close()
+    end = time.monotonic()
+    return (first_byte or end) - start, received / max(end - start - throttled, 1e-3)
+
+
+async def probe_mirror_async(session, url: str, headers: dict) -> tuple[float, float]:
+    """
+    probe_mirror 的协程版本，使用 AsyncSession 发起请求
+    """
+    start = time.monotonic()
+    first_byte = None
+    received = 0
+    throttled = 0.0
+    resp = await session.get(url, headers=probe_headers(headers), stream=True, timeout=PROBE_TIMEOUT)
+    try:
+        check_probe_response(resp)
+        async for chunk in resp.aiter_content():
+            if first_byte is None:
+                first_byte = time.monotonic()
+            received += len(chunk)
+            throttled += await byte_limiter.acquire_async(len(chunk))
+            if received >= PROBE_BYTES:
+                break
+    finally:
+        await close_async_response(resp)
+    end = time.monotonic()
+    return (first_byte or end) - start, received / max(end - start - throttled, 1e-3)
+
+
+def stale_mirrors(urls: list[str]) -> list[str]:
+    return [url for url in urls if not mirror_ranking.is_fresh(mirror_host(url))]
+
+
+def record_probe(url: str, result: Union[tuple[float, float], BaseException]):
+    """
+    记录一次探测的结果，result 为 (延迟, 吞吐量) 或探测时抛出的异常
+    """
+    host = mirror_host(url)
+    if isinstance(result, BaseException):
+        app_logger.debug(f'镜像测速失败: {host}, {result}')
+        mirror_ranking.record(host, failed=True)
+        return
+    latency, throughput = result
+    app_logger.debug(f'镜像测速: {host}, 延迟 {latency * 1000:.0f} ms, 吞吐 {throughput / 1024:.0f} KiB/s')
+    mirror_ranking.record(host, throughput=throughput, latency=latency)
+
+
+def sort_mirrors(urls: list[str]) -> list[str]:
+    ranked = sorted(urls, key=lambda url: mirror_ranking.score(mirror_host(url)), reverse=True)
+    app_logger.debug(f'镜像排序: {[mirror_host(url) for url in ranked]}')
+    return ranked
+
+
+def rank_mirrors(urls: list[str], headers: dict) -> list[str]:
+    """
+    按测速结果从快到慢排列候选地址
+
+    最近测过速的节点直接使用记录的结果，其余节点并发探测，探测失败的节点排在最后。
+    """
+    if len(urls) <= 1:
+        return list(urls)
+
+    def probe(url: str):
+        try:
+            record_probe(url, probe_mirror(url, headers))
+        except Exception as e:
+            record_probe(url, e)
+
+    stale = stale_mirrors(urls)
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            list(executor.map(probe, stale))
+    return sort_mirrors(urls)
+
+
+async def rank_mirrors_async(session, urls: list[str], headers: dict) -> list[str]:
+    """
+    rank_mirrors 的协程版本，所有探测请求在同一个事件循环中并发进行
+    """
+    if len(urls) <= 1:
+        return list(urls)
+
+    stale = stale_mirrors(urls)
+    results = await asyncio.gather(*(probe_mirror_async(session, url, headers) for url in stale),
+                                   return_exceptions=True)
+    for url, result in zip(stale, results):
+        record_probe(url, result)
+    return sort_mirrors(urls)
@@ -0,0 +1,270 @@
+import json
+import queue
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from download_sync import new_progress
+from log_config import app_logger
+from metrics import prometheus_text
+from scheduler import TaskScheduler
+from task import BiliTask
+from tool import clean_bili_url
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8730
+
+# 内存中最多保留的已结束任务数量，超出后丢弃最早结束的任务
+MAX_FINISHED_JOBS = 10000
+
+# 提交任务时可以覆盖的 BiliTask 参数
+JOB_OPTIONS = ('quality', 'codec', 'save', 'connections', 'resume', 'keep_m4s', 'force')
+
+CODECS = ('AVC', 'HEVC', 'AV1')
+
+
+def check_job_options(body: dict, save_root: Path) -> dict:
+    """
+    检查请求体中的任务参数（限制与命令行选项一致），返回要覆盖的参数，不合法时抛出 ValueError
+
+    save 只能是 save_root（启动时的保存目录，未指定时为当前目录）之下的目录
+    """
+    options = {key: body[key] for key in JOB_OPTIONS if body.get(key) is not None}
+    # bool 是 int 的子类，需要单独排除
+    for key in ('quality', 'connections'):
+        if key in options and (not isinstance(options[key], int) or isinstance(options[key], bool)):
+            raise ValueError(f'{key} 必须是整数')
+    if options.get('quality', 1) < 1:
+        raise ValueError('quality 必须大于 0')
+    if options.get('connections', 1) < 1:
+        raise ValueError('connections 不能小于 1')
+    if 'codec' in options:
+        if not isinstance(options['codec'], str) or options['codec'].upper() not in CODECS:
+            raise ValueError(f'codec 只能是 {" / ".join(CODECS)}')
+        options['codec'] = options['codec'].upper()
+    for key in ('resume', 'keep_m4s', 'force'):
+        if key in options and not isinstance(options[key], bool):
+            raise ValueError(f'{key} 必须是 true 或 false')
+    if 'save' in options:
+        if not isinstance(options['save'], str) or not options['save']:
+            raise ValueError('save 必须是非空字符串')
+        save = (save_root / options['save']).resolve()
+        if not save.is_relative_to(save_root):
+            raise ValueError(f'save 必须位于 {save_root} 之下')
+        options['save'] = str(save)
+    return options
+
+
+class Job:
+    """
+    守护进程中的一个下载任务
+    """
+
+    def __init__(self, task: BiliTask):
+        self.id = uuid.uuid4().hex[:12]
+        self.task = task
+        self.created_at = time.time()
+
+    def to_dict(self) -> dict:
+        metrics = self.task.metrics.to_dict()
+        plan = self.task.plan or {}
+        streams = list(metrics['streams'].values())
+        totals = [stream['total'] for stream in streams]
+        return {
+            'id': self.id,
+            'url': self.task.url,
+            'status': metrics['status'],
+            'error': metrics['error'],
+            'title': metrics['title'],
+            'output_path': str(plan['output_path']) if plan.get('output_path') else None,
+            # 两个流的大小都已知时才给出总大小
+            'progress': {
+                'bytes': sum(stream['bytes'] for stream in streams),
+                'total': sum(totals) if len(totals) == 2 and None not in totals else None,
+            },
+            'created_at': self.created_at,
+            'finished_at': metrics['finished_at'],
+            'metrics': metrics,
+        }
+
+
+class JobServer:
+    """
+    常驻的下载守护进程
+
+    启动时读取一次 cookie，之后所有任务共用连接池、元数据缓存、下载索引和同一个 TaskScheduler 流水线，
+    任务通过本地 HTTP/JSON 接口提交：
+
+        POST /jobs          {"url": ...} 或 {"urls": [...]}，可带 quality、codec、save 等参数，返回创建的任务
+        GET  /jobs          所有任务的状态，?status=failed 按状态过滤
+        GET  /jobs/<id>     单个任务的状态、进度和指标
+        POST /info          {"urls": [...]}，同步返回视频信息（同 --info --format json）
+        GET  /metrics       Prometheus 文本格式的任务指标
+        GET  /health        守护进程状态
+    """
+
+    def __init__(self, headers: dict, defaults: dict, jobs: int = 1, host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT):
+        self.headers = headers
+        self.defaults = defaults
+        self.save_root = Path(defaults.get('save') or '.').resolve()
+        self.scheduler = TaskScheduler(jobs=jobs)
+        self.queue: queue.Queue[str] = queue.Queue()
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.task_jobs: dict[BiliTask, str] = {}
+        self.finished: list[str] = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.started_at = time.time()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+
+    @property
+    def address(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def submit(self, url: str, options: dict) -> Job:
+        """
+        创建任务并加入流水线，options 为 check_job_options 检查过的参数
+        """
+        clean_url = clean_bili_url(url)
+        params = {'quality': None, 'codec': None, 'save': None, **self.defaults, **options}
+        task = BiliTask(url=clean_url, headers=dict(self.headers, Referer=clean_url), **params)
+        job = Job(task)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.task_jobs[task] = job.id
+        self.queue.put(job.id)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self, status: Optional[str] = None) -> list[Job]:
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job for job in jobs if status is None or job.task.metrics.status == status]
+
+    def next_task(self) -> Optional[BiliTask]:
+        while True:
+            try:
+                job_id = self.queue.get_nowait()
+            except queue.Empty:
+                return None
+            if job := self.get(job_id):
+                return job.task
+
+    def on_finish(self, task: BiliTask, ok: bool):
+        with self.lock:
+            self.finished.append(self.task_jobs.pop(task))
+            while len(self.finished) > MAX_FINISHED_JOBS:
+                self.jobs.pop(self.finished.pop(0), None)
+
+    def status(self) -> dict:
+        counts = {}
+        for job in self.list_jobs():
+            counts[job.task.metrics.status] = counts.get(job.task.metrics.status, 0) + 1
+        return {'status': 'stopping' if self.stop_event.is_set() else 'running',
+                'uptime': round(time.time() - self.started_at, 3), 'queued': self.queue.qsize(), 'jobs': counts}
+
+    def stop(self):
+        """
+        不再开始新的任务，已经开始的任务完成后 serve_forever 返回
+        """
+        self.stop_event.set()
+
+    def serve_forever(self):
+        threading.Thread(target=self.server.serve_forever, name='bilix-http', daemon=True).start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        app_logger.info(f'守护进程已启动: {self.address}')
+        try:
+            with new_progress() as progress:
+                self.scheduler.run_pipeline(self.next_task, self.on_finish, progress, self.stop_event)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            app_logger.info('守护进程已退出')
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, fmt, *args):
+                app_logger.debug(f'{self.address_string()} {fmt % args}')
+
+            def do_GET(self):
+                parsed = urlsplit(self.path)
+                path = parsed.path.rstrip('/')
+                if path == '/health':
+                    self.send_json(200, server.status())
+                elif path == '/jobs':
+                    status = parse_qs(parsed.query).get('status', [None])[0]
+                    self.send_json(200, {'jobs': [job.to_dict() for job in server.list_jobs(status)]})
+                elif path.startswith('/jobs/'):
+                    job = server.get(path[len('/jobs/'):])
+                    if job:
+                        self.send_json(200, job.to_dict())
+                    else:
+                        self.send_json(404, {'error': '任务不存在'})
+                elif path == '/metrics':
+                    text = prometheus_text([job.task.metrics for job in server.list_jobs()])
+                    self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8', text.encode('utf-8'))
+                else:
+                    self.send_json(404, {'error': '接口不存在'})
+
+            def do_POST(self):
+                path = urlsplit(self.path).path.rstrip('/')
+                try:
+                    body = self.read_json()
+                    urls = body.get('urls') or ([body['url']] if body.get('url') else [])
+                    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+                        raise ValueError('需要 url 或 urls')
+                    options = check_job_options(body, server.save_root) if path == '/jobs' else {}
+                except (ValueError, AttributeError) as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+
+                if path == '/jobs':
+                    if server.stop_event.is_set():
+                        self.send_json(503, {'error': '守护进程正在退出'})
+                        return
+                    jobs = [server.submit(url, options) for url in urls]
+                    app_logger.info(f'收到 {len(jobs)} 个下载任务')
+                    self.send_json(201, {'jobs': [job.to_dict() for job in jobs]})
+                elif path == '/info':
+                    from video_info import resolve_video_infos, video_info_dict
+                    results = resolve_video_infos([clean_bili_url(url) for url in urls], server.headers)
+                    self.send_json(200, [video_info_dict(url, result) for url, result in zip(urls, results)])
+                else:
+                    self.send_json(404, {'error': '接口不存在'})
+
+            def read_json(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(body, dict):
+                    raise ValueError('请求体需要是 JSON 对象')
+                return body
+
+            def send_json(self, status: int, data):
+                self.send_body(status, 'application/json; charset=utf-8',
+                               json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+            def send_body(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
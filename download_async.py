@@ -0,0 +1,172 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Optional
+
+from cdn_mirror import rank_mirrors_async
+from download_index import completed_entry, download_index, request_key
+from download_sync import check_completed, dash_from_parse, make_plan, merge_streams, new_progress, parse_result, \
+    skipped_plan
+from file_writer import StreamFile
+from log_config import app_logger
+from metrics import phase, record_bytes, record_total, run_metered_async
+from playurl_api import playurl_target, resolve_playurl_async
+from range_download import download_segmented_async, iter_resumable_async, probe_stream_async
+from rate_limit import byte_limiter
+from retry import DEFAULT_RETRY_BUDGET, RetryBudget, use_retry_budget
+from session_pool import session_pool
+from tool import fetch_page_async, shrink_title
+
+# 除音视频流的连接外，为接口请求和镜像测速预留的并发请求数
+EXTRA_CLIENTS = 8
+
+
+def session_clients(jobs: int, connections: int) -> int:
+    """
+    同时下载 jobs 个视频、每个流 connections 个连接时，AsyncSession 需要的并发请求数
+    """
+    return jobs * 2 * connections + EXTRA_CLIENTS
+
+
+async def prepare_download_async(
+        session,
+        url: str,
+        headers: dict,
+        quality: Optional[int] = None,
+        codec: Optional[str] = None,
+        save: str = None,
+        work_dir: Optional[str] = None,
+        force: bool = False,
+        max_size: Optional[int] = None,
+        max_bitrate: Optional[int] = None,
+) -> dict:
+    """
+    prepare_download 的协程版本，接口请求和网页回退都在事件循环中进行
+    """
+    request = request_key(playurl_target(url), quality, codec, save, max_size, max_bitrate)
+    if not force and request and (entry := completed_entry(download_index.lookup(request), save)):
+        return skipped_plan(url, headers, entry)
+
+    resolved = await resolve_playurl_async(session, url, headers, quality)
+    if resolved:
+        title, dash = resolved['title'], resolved['dash']
+    else:
+        app_logger.info(f'使用网页解析: {url}')
+        title, dash = dash_from_parse(url, parse_result(await fetch_page_async(session, url, headers)))
+        resolved = {}
+    plan = make_plan(url, headers, quality, codec, save, resolved, title, dash, work_dir, max_size, max_bitrate)
+    return check_completed(plan, request, force)
+
+
+async def download_stream_async(session, url: str, headers, filename: str, progress, connections: int = 1,
+                                resume: bool = False, mirrors: Optional[list[str]] = None):
+    """
+    download_stream 的协程版本，返回进度条任务 id
+    """
+    task = progress.add_task(f'{shrink_title(Path(filename).name)}', start=False)
+    urls = await rank_mirrors_async(session, [url] + mirrors, headers) if mirrors else [url]
+    url = urls[0]
+    if connections > 1 or resume or len(urls) > 1:
+        stream_info = await probe_stream_async(session, url, headers)
+        total = stream_info['size']
+        if stream_info['accept_ranges'] and total > 0:
+            progress.update(task, total=total)
+            record_total(total)
+            progress.start_task(task)
+            await download_segmented_async(session, urls, headers, filename, total, connections, progress, task,
+                                           resume=resume, etag=stream_info['etag'])
+            return task
+        app_logger.warning(f'{filename} 不支持 Range 请求，使用单连接下载')
+
+    with StreamFile(filename) as f:
+        def on_start(total: int):
+            progress.update(task, total=total)
+            record_total(total)
+            progress.start_task(task)
+            f.allocate(total)
+
+        async for chunk in iter_resumable_async(session, url, headers, filename, on_start):
+            f.write(chunk)
+            progress.update(task, advance=len(chunk))
+            await byte_limiter.acquire_async(len(chunk))
+            record_bytes(len(chunk))
+        f.complete()
+    return task
+
+
+async def fetch_streams_async(session, plan: dict, progress, connections: int = 1, resume: bool = False,
+                              remove_finished: bool = False):
+    """
+    fetch_streams 的协程版本，视频流和音频流作为两个协程并发下载
+
+    异步引擎不支持边下载边合并（依赖 FIFO 和阻塞写入），下载结束后由 merge_streams 合并
+    """
+    if plan.get('skipped'):
+        return
+    start = int(time.time() * 1000)
+    headers = plan['headers']
+    with phase('transfer'):
+        streams = [
+            asyncio.ensure_future(run_metered_async(
+                'video', download_stream_async, session, plan['video_url'], headers, plan['video_file'], progress,
+                connections, resume, plan.get('video_mirrors'))),
+            asyncio.ensure_future(run_metered_async(
+                'audio', download_stream_async, session, plan['audio_url'], headers, plan['audio_file'], progress,
+                connections, resume, plan.get('audio_mirrors'))),
+        ]
+        try:
+            tasks = await asyncio.gather(*streams)
+        except BaseException:
+            # 一个流失败时任务已经失败，取消另一个流并等它释放文件
+            for stream in streams:
+                stream.cancel()
+            await asyncio.gather(*streams, return_exceptions=True)
+            raise
+
+    if remove_finished:
+        for task in tasks:
+            progress.remove_task(task)
+
+    end = int(time.time() * 1000)
+    app_logger.info(f'{plan["title"]} 下载音视频共耗时: {end - start} ms')
+
+
+async def download_async(
+        url: str,
+        headers: dict,
+        quality: Optional[int] = None,
+        codec: Optional[str] = None,
+        save: str = None,
+        connections: int = 1,
+        resume: bool = False,
+        keep_m4s: bool = False,
+        merger: str = 'ffmpeg',
+        retries: int = DEFAULT_RETRY_BUDGET,
+        work_dir: Optional[str] = None,
+        force: bool = False,
+        max_size: Optional[int] = None,
+        max_bitrate: Optional[int] = None,
+        session=None,
+        progress=None,
+) -> dict:
+    """
+    download_sync 的协程版本，供在已有事件循环中使用的调用方直接 await，返回下载计划
+
+    多个视频可以在同一个事件循环中并发调用，传入同一个 session（AsyncSession）和 progress
+    即可共用连接和进度条；不传时为本次下载单独创建。合并在线程中进行，不阻塞事件循环。
+    """
+    if session is None:
+        async with session_pool.new_async_session(session_clients(1, connections)) as session:
+            return await download_async(url, headers, quality, codec, save, connections, resume, keep_m4s, merger,
+                                        retries, work_dir, force, max_size, max_bitrate, session, progress)
+    if progress is None:
+        with new_progress() as progress:
+            return await download_async(url, headers, quality, codec, save, connections, resume, keep_m4s, merger,
+                                        retries, work_dir, force, max_size, max_bitrate, session, progress)
+
+    with use_retry_budget(RetryBudget(retries)):
+        plan = await prepare_download_async(session, url, headers, quality, codec, save, work_dir, force, max_size,
+                                            max_bitrate)
+        await fetch_streams_async(session, plan, progress, connections, resume)
+    await asyncio.to_thread(merge_streams, plan, keep_m4s, merger)
+    return plan
@@ -0,0 +1,230 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from global_param import STATE_DIR
+from log_config import app_logger
+
+INDEX_FILE_NAME = 'bilix_index.db'
+
+# 计算校验和时每次读取的字节数
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+DOWNLOADS_TABLE = (
+    'CREATE TABLE IF NOT EXISTS downloads ('
+    'bvid TEXT NOT NULL, cid INTEGER NOT NULL, quality INTEGER NOT NULL, codec INTEGER NOT NULL, '
+    'save_dir TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+    'sha256 TEXT NOT NULL, finished_at REAL NOT NULL, PRIMARY KEY (bvid, cid, quality, codec, save_dir))'
+)
+
+
+def file_checksum(path: Path) -> str:
+    """
+    计算文件的 SHA-256
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadIndex:
+    """
+    已完成下载的本地索引
+
+    每个输出文件以 (bvid, cid, quality, codec, save_dir) 为主键，记录文件路径、大小、修改时间和 SHA-256，
+    同一个视频保存到多个目录时每个目录各有一条记录；
+    另外记录「请求 → 主键」的映射，请求由 URL 中的 bvid 与分P（或 ep_id/season_id）以及指定的清晰度、编码、保存目录组成，
+    重复运行时不需要任何网络请求就能判断任务是否已经完成。
+    与元数据缓存不同，索引没有有效期，也不会被淘汰。数据库在第一次读写时才会创建。
+    """
+
+    def __init__(self, path: Union[str, Path] = STATE_DIR / INDEX_FILE_NAME):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self._migrate()
+            self.conn.execute(DOWNLOADS_TABLE)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS requests ('
+                'request TEXT PRIMARY KEY, bvid TEXT NOT NULL, cid INTEGER NOT NULL, '
+                'quality INTEGER NOT NULL, codec INTEGER NOT NULL, save_dir TEXT NOT NULL)'
+            )
+            self.conn.commit()
+        return self.conn
+
+    def _migrate(self):
+        """
+        旧版本的索引没有 save_dir 列：已有的文件记录按所在目录补上 save_dir，
+        请求映射的格式已经变化（旧的请求标识不含保存目录），直接丢弃
+        """
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(downloads)')]
+        if not columns or 'save_dir' in columns:
+            return
+        rows = self.conn.execute(
+            'SELECT bvid, cid, quality, codec, path, size, mtime, sha256, finished_at FROM downloads'
+        ).fetchall()
+        self.conn.execute('DROP TABLE downloads')
+        self.conn.execute('DROP TABLE IF EXISTS requests')
+        self.conn.execute(DOWNLOADS_TABLE)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(*row[:4], str(Path(row[4]).parent), *row[4:]) for row in rows]
+        )
+        self.conn.commit()
+
+    def _entry(self, row) -> Optional[dict]:
+        if row is None:
+            return None
+        keys = ('bvid', 'cid', 'quality', 'codec', 'save_dir', 'path', 'size', 'mtime', 'sha256', 'finished_at')
+        return dict(zip(keys, row))
+
+    def get(self, bvid: str, cid: int, quality: int, codec: int, save: Optional[str]) -> Optional[dict]:
+        """
+        查找保存目录 save 中的下载记录
+        """
+        try:
+            with self.lock:
+                row = self._connect().execute(
+                    'SELECT bvid, cid, quality, codec, save_dir, path, size, mtime, sha256, finished_at FROM downloads '
+                    'WHERE bvid = ? AND cid = ? AND quality = ? AND codec = ? AND save_dir = ?',
+                    (bvid, cid, quality, codec, str(save_dir(save)))
+                ).fetchone()
+        except sqlite3.Error:
+            app_logger.warning(f'读取下载索引失败: {bvid} {cid}', exc_info=True)
+            return None
+        return self._entry(row)
+
+    def lookup(self, request: str) -> Optional[dict]:
+        """
+        按请求查找已完成的下载
+        """
+        try:
+            with self.lock:
+                row = self._connect().execute(
+                    'SELECT d.bvid, d.cid, d.quality, d.codec, d.save_dir, d.path, d.size, d.mtime, d.sha256, '
+                    'd.finished_at FROM requests r JOIN downloads d ON d.bvid = r.bvid AND d.cid = r.cid '
+                    'AND d.quality = r.quality AND d.codec = r.codec AND d.save_dir = r.save_dir '
+                    'WHERE r.request = ?', (request,)
+                ).fetchone()
+        except sqlite3.Error:
+            app_logger.warning(f'读取下载索引失败: {request}', exc_info=True)
+            return None
+        return self._entry(row)
+
+    def add(self, bvid: str, cid: int, quality: int, codec: int, path: Path, sha256: str,
+            request: Optional[str] = None):
+        """
+        记录一个已完成的输出文件（保存目录为文件所在目录），request 不为空时同时记录请求到该文件的映射
+        """
+        path = Path(path).resolve()
+        stat = path.stat()
+        try:
+            with self.lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO downloads (bvid, cid, quality, codec, save_dir, path, size, mtime, '
+                    'sha256, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (bvid, cid, quality, codec, str(path.parent), str(path), stat.st_size, stat.st_mtime, sha256,
+                     time.time())
+                )
+                if request:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO requests (request, bvid, cid, quality, codec, save_dir) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', (request, bvid, cid, quality, codec, str(path.parent))
+                    )
+                conn.commit()
+        except sqlite3.Error:
+            app_logger.warning(f'写入下载索引失败: {path}', exc_info=True)
+
+    def add_request(self, request: str, entry: dict):
+        """
+        记录请求到已有下载的映射，下次同样的请求不需要联网即可命中
+        """
+        try:
+            with self.lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO requests (request, bvid, cid, quality, codec, save_dir) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (request, entry['bvid'], entry['cid'], entry['quality'], entry['codec'], entry['save_dir'])
+                )
+                conn.commit()
+        except sqlite3.Error:
+            app_logger.warning(f'写入下载索引失败: {request}', exc_info=True)
+
+    def verify(self, entry: dict) -> bool:
+        """
+        检查索引中记录的文件是否仍然完好
+
+        文件大小和修改时间都没变时直接认为完好；修改时间变了（例如被复制或同步过）再比对校验和。
+        """
+        path = Path(entry['path'])
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        return file_checksum(path) == entry['sha256']
+
+
+download_index = DownloadIndex()
+
+
+def save_dir(save: Optional[str]) -> Path:
+    """
+    保存目录的绝对路径，未指定时为当前目录
+    """
+    return Path(save or '.').resolve()
+
+
+def completed_entry(entry: Optional[dict], save: Optional[str]) -> Optional[dict]:
+    """
+    entry 对应的文件在保存目录 save 中且仍然完好时返回 entry，否则返回 None
+
+    同一个视频保存到另一个目录时不算已下载，需要在新的目录中再下载一份。
+    """
+    if not entry:
+        return None
+    if entry['save_dir'] != str(save_dir(save)):
+        return None
+    if download_index.verify(entry):
+        return entry
+    app_logger.info(f'下载索引中的文件已变化或不存在，重新下载: {entry["path"]}')
+    return None
+
+
+def request_key(target: Optional[dict], quality: Optional[int], codec: Optional[str], save: Optional[str] = None,
+                max_size: Optional[int] = None, max_bitrate: Optional[int] = None) -> Optional[str]:
+    """
+    由 URL 解析出的目标（见 playurl_api.playurl_target）和指定的清晰度、编码、保存目录、大小和码率限制组成请求标识
+
+    无法从 URL 离线确定视频时返回 None。
+    """
+    if target is None:
+        return None
+    if target['kind'] == 'ugc':
+        video = f'{target["bvid"]}_p{target["page"]}'
+    elif target['ep_id']:
+        video = f'ep{target["ep_id"]}'
+    else:
+        video = f'ss{target["season_id"]}'
+    key = f'{video}|q{quality or 0}|{(codec or "AVC").upper()}|{save_dir(save)}'
+    if max_size:
+        key += f'|s{max_size}'
+    if max_bitrate:
+        key += f'|b{max_bitrate}'
+    return key
@@ -1,3 +1,4 @@
+import hashlib
 import math
 import sys
 import time
@@ -7,17 +8,26 @@ from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
-from curl_cffi import requests
-from curl_cffi.requests.exceptions import HTTPError, RequestException
 from rich.console import Console
 from rich.panel import Panel
 from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn, TimeRemainingColumn, TimeElapsedColumn, \
     FileSizeColumn, TotalFileSizeColumn, SpinnerColumn, TransferSpeedColumn
 from rich.text import Text
 
+from cdn_mirror import rank_mirrors, stream_mirrors
+from download_index import completed_entry, download_index, file_checksum, request_key
+from file_writer import StreamFile, move_into_place
 from log_config import app_logger
-from tool import extract_title, extract_playinfo_json, merge_m4s_ffmpeg, extract_initial_state_json, \
-    extract_playurl_ssr_data, format_bytes, shrink_title
+from metrics import current_metrics, phase, record_bytes, record_total, run_metered
+from mp4_mux import merge_m4s_native
+from playurl_api import get_bangumi_episode, playurl_target, resolve_playurl
+from range_download import probe_stream, download_segmented, iter_resumable
+from rate_limit import byte_limiter, request_limiter
+from retry import API_TIMEOUT, DEFAULT_RETRY_BUDGET, RetryBudget, submit_in_context, use_retry_budget
+from session_pool import borrow_session
+from stream_remux import stream_remux, stream_remux_supported
+from stream_select import select_in_budget
+from tool import merge_m4s_ffmpeg, format_bytes, shrink_title, fetch_page, sanitize_filename, get_ffmpeg_path
 
 # B 站视频编码
 codec_dict = {
@@ -48,19 +58,6 @@ quality_id_name_map = {
     127: '8K'
 }
 
-def get_bangumi_episode(md_id: str):
-    md_id = md_id.replace("md", "")
-    url1 = f'https://api.bilibili.com/pgc/review/user?media_id={md_id}'
-    resp1 = requests.get(url1, timeout=5)
-    resp1.raise_for_status()
-    season_id = resp1.json()['result']['media']['season_id']
-
-    url2 = f'https://api.bilibili.com/pgc/web/season/section?season_id={season_id}'
-    resp2 = requests.get(url2, timeout=5)
-    resp2.raise_for_status()
-    episodes = resp2.json()['result']['main_section']['episodes']
-    return episodes
-
 
 def get_video_info(url: str, header: dict):
     parse_res = parse(url, header)
@@ -178,7 +175,10 @@ def get_video_info(url: str, header: dict):
     text.append(f'{minutes} 分 {seconds} 秒' + "\n\n", style="bold magenta")
 
     if bvid != -1:
-        bvid_resp = requests.get('https://api.bilibili.com/x/web-interface/wbi/view', params={'bvid': bvid}, headers=header, timeout=5)
+        bvid_info_url = 'https://api.bilibili.com/x/web-interface/wbi/view'
+        request_limiter.acquire()
+        with borrow_session(bvid_info_url) as session:
+            bvid_resp = session.get(bvid_info_url, params={'bvid': bvid}, headers=header, timeout=API_TIMEOUT)
         bvid_resp_json = bvid_resp.json()
         bvid_data = bvid_resp_json['data']
         tname = bvid_data['tname']
@@ -235,54 +235,85 @@ def get_video_info(url: str, header: dict):
 
 
 
-def parse(url: str, headers: dict):
-    with requests.Session() as session:
-        try:
-            response = session.get(url=url, headers=headers, timeout=5)
-            response.raise_for_status()
-
-            html = response.text
-            title = extract_title(html)
-            playinfo = extract_playinfo_json(html)
-            initial_state = extract_initial_state_json(html)
-            playurl_ssr_data = extract_playurl_ssr_data(html)
-            return {
-                'title': title,
-                'playinfo': playinfo,
-                'initial_state': initial_state,
-                'playurl_ssr_data': playurl_ssr_data,
-            }
-        except HTTPError:
-            app_logger.exception(f'HTTP 错误')
-        except RequestException:
-            app_logger.exception(f'下载失败，网络请求错误')
-        except Exception:
-            app_logger.exception(f'未知错误')
-    return None
-
-
-def download_stream(url: str, headers, filename: str, progress):
-    task = progress.add_task(f'{shrink_title(filename)}', start=False)
-    with requests.Session() as session:
-        resp = session.get(url, headers=headers, stream=True, impersonate="chrome")
-        resp.raise_for_status()
-        total = int(resp.headers.get('Content-Length', 0))
-        progress.update(task, total=total)
-        progress.start_task(task)
-        with open(filename, 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=1024 * 1024):
-                f.write(chunk)
-                progress.update(task, advance=len(chunk))
+def parse(url: str, headers: dict) -> dict:
+    """
+    获取并解析视频页面，网络错误会按重试策略重试，重试失败后异常直接抛出，由调用方处理
+    """
+    return parse_result(fetch_page(url, headers))
+
+
+def parse_result(page: dict) -> dict:
+    return {
+        'title': sanitize_filename(page['title']) if page['title'] is not None else None,
+        'playinfo': page['playinfo'],
+        'initial_state': page['initial_state'],
+        'playurl_ssr_data': page['playurl_ssr_data'],
+    }
+
+
+def download_stream(url: str, headers, filename: str, progress, connections: int = 1, resume: bool = False,
+                    mirrors: Optional[list[str]] = None):
+    """
+    下载单个音视频流，返回进度条任务 id
+
+    mirrors 为 backupUrl 中的镜像地址，提供时先测速选出最快的节点，
+    下载过程中节点出错或变慢会切换到下一个镜像继续。
+    """
+    task = progress.add_task(f'{shrink_title(Path(filename).name)}', start=False)
+    urls = rank_mirrors([url] + mirrors, headers) if mirrors else [url]
+    url = urls[0]
+    if connections > 1 or resume or len(urls) > 1:
+        stream_info = probe_stream(url, headers)
+        total = stream_info['size']
+        if stream_info['accept_ranges'] and total > 0:
+            progress.update(task, total=total)
+            record_total(total)
+            progress.start_task(task)
+            download_segmented(urls, headers, filename, total, connections, progress, task,
+                               resume=resume, etag=stream_info['etag'])
+            return task
+        app_logger.warning(f'{filename} 不支持 Range 请求，使用单连接下载')
+
+    with StreamFile(filename) as f:
+        def on_start(total: int):
+            progress.update(task, total=total)
+            record_total(total)
+            progress.start_task(task)
+            f.allocate(total)
+
+        for chunk in iter_resumable(url, headers, filename, on_start):
+            f.write(chunk)
+            progress.update(task, advance=len(chunk))
+            byte_limiter.acquire(len(chunk))
+            record_bytes(len(chunk))
+        f.complete()
+    return task
+
+
+def new_progress(transient: bool = False) -> Progress:
+    return Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        TimeRemainingColumn(),
+        TimeElapsedColumn(),
+        # MofNCompleteColumn(),
+        FileSizeColumn(),
+        TotalFileSizeColumn(),
+        SpinnerColumn(),
+        TransferSpeedColumn(),
+        transient=transient,
+    )
 
 
-def download_sync(
-        url: str,
-        headers: dict,
-        quality: Optional[int] = None,
-        codec: Optional[str] = None,
-        save: str = None,
-):
-    parse_res = parse(url, headers)
+def dash_from_page(url: str, headers: dict) -> tuple[str, dict]:
+    """
+    从网页中解析标题和 DASH 音视频流（{'video', 'audio', 'duration'}），作为接口解析失败时的回退方案
+    """
+    return dash_from_parse(url, parse(url, headers))
+
+
+def dash_from_parse(url: str, parse_res: dict) -> tuple[str, dict]:
     title = parse_res.get('title')
     playinfo = parse_res.get('playinfo')
     playurl_info = parse_res.get('playurl_ssr_data')
@@ -296,84 +327,269 @@ def download_sync(
         if playurl_info_raw:
             dash = playurl_info_raw.get('data').get('video_info').get('dash')
         if not dash:
-            app_logger.error(f"无法获取该 URL : {url} 的播放信息, 请检查该视频地址的正确性或者该视频的下载需要大会员账号权限")
-            sys.exit(1)
+            raise ValueError(f"无法获取该 URL : {url} 的播放信息, 请检查该视频地址的正确性或者该视频的下载需要大会员账号权限")
         videos = dash.get('video', [])
         audios = dash.get('audio', [])
     else:
         if not playinfo or 'data' not in playinfo:
-            app_logger.error(f"无法获取该 URL : {url} 的播放信息, 请检查该视频地址的正确性或者该视频的下载需要大会员账号权限")
-            sys.exit(1)
+            raise ValueError(f"无法获取该 URL : {url} 的播放信息, 请检查该视频地址的正确性或者该视频的下载需要大会员账号权限")
 
         dash = playinfo['data'].get('dash', {})
         videos = dash.get('video', [])
         audios = dash.get('audio', [])
         if not videos or not audios:
-            app_logger.error("未检测到视频或音频流，退出。")
-            sys.exit(1)
+            raise ValueError("未检测到视频或音频流，退出。")
+    return title, {'video': videos, 'audio': audios, 'duration': dash.get('duration')}
+
 
-    # 获取目标 codec 的 codecid，如果无效则默认使用 AVC
-    target_codecid = codec_name_id_map.get(codec.upper(), 7) if codec else 7
-    # 选择视频流
-    selected = None
-    if quality:
-        # 优先匹配 id 和目标 codec
-        selected = next((v for v in videos if v['id'] == quality and v.get('codecid') == target_codecid), None)
+def prepare_download(
+        url: str,
+        headers: dict,
+        quality: Optional[int] = None,
+        codec: Optional[str] = None,
+        save: str = None,
+        work_dir: Optional[str] = None,
+        force: bool = False,
+        max_size: Optional[int] = None,
+        max_bitrate: Optional[int] = None,
+) -> dict:
+    """
+    解析阶段：获取页面信息并选择要下载的音视频流
+
+    返回下载计划，供 fetch_streams 和 merge_streams 使用。下载索引中已有完好的输出文件时
+    （force 为 False），返回的计划带有 skipped 标记，后续阶段直接跳过
+    """
+    request = request_key(playurl_target(url), quality, codec, save, max_size, max_bitrate)
+    if not force and request and (entry := completed_entry(download_index.lookup(request), save)):
+        return skipped_plan(url, headers, entry)
+
+    resolved = resolve_playurl(url, headers, quality)
+    if resolved:
+        title, dash = resolved['title'], resolved['dash']
+    else:
+        app_logger.info(f'使用网页解析: {url}')
+        title, dash = dash_from_page(url, headers)
+        resolved = {}
+    plan = make_plan(url, headers, quality, codec, save, resolved, title, dash, work_dir, max_size, max_bitrate)
+    return check_completed(plan, request, force)
+
+
+def skipped_plan(url: str, headers: dict, entry: dict) -> dict:
+    """
+    下载索引命中时的下载计划
+    """
+    output_path = Path(entry['path'])
+    app_logger.info(f'已下载过，跳过: {output_path}（使用 --force 重新下载）')
+    metrics = current_metrics()
+    if metrics:
+        metrics.title, metrics.bvid = output_path.stem, entry['bvid']
+    return {'url': url, 'headers': headers, 'title': output_path.stem, 'bvid': entry['bvid'], 'cid': entry['cid'],
+            'output_path': output_path, 'skipped': True}
+
+
+def check_completed(plan: dict, request: Optional[str], force: bool = False) -> dict:
+    """
+    解析完成后按 (bvid, cid, quality, codec, 保存目录) 再查一次下载索引，命中时跳过下载，
+    并记录该请求，下次同样的请求不需要联网即可命中
+    """
+    plan['request'] = request
+    if force or not plan['bvid'] or not plan['cid']:
+        return plan
+    save = str(plan['output_path'].parent)
+    entry = completed_entry(download_index.get(plan['bvid'], plan['cid'], plan['quality'], plan['codecid'], save),
+                            save)
+    if not entry:
+        return plan
+    if request:
+        download_index.add_request(request, entry)
+    return skipped_plan(plan['url'], plan['headers'], entry)
+
+
+def make_plan(url: str, headers: dict, quality: Optional[int], codec: Optional[str], save: Optional[str],
+              resolved: dict, title: str, dash: dict, work_dir: Optional[str] = None, max_size: Optional[int] = None,
+              max_bitrate: Optional[int] = None) -> dict:
+    """
+    从解析得到的音视频流中按清晰度和编码选择要下载的流，生成下载计划
+
+    指定了 max_size 或 max_bitrate 时由 select_in_budget 按预算选择音视频流，此时 quality 为清晰度上限，
+    没有指定 codec 时按 AV1 > HEVC > AVC 优先
+
+    中间的 m4s 文件和合并结果都放在 work_dir（默认当前目录，不指定 work_dir 时合并结果放在保存目录），
+    合并完成后再移动到保存目录
+    """
+    videos, audios = dash['video'], dash['audio']
+    with phase('select'):
+        # 获取目标 codec 的 codecid，如果无效则默认使用 AVC
+        target_codecid = codec_name_id_map.get(codec.upper(), 7) if codec else 7
+        # 选择视频流
+        selected = None
+        audio = None
+        if max_size or max_bitrate:
+            selected, audio = select_in_budget(videos, audios, dash.get('duration'), quality,
+                                               target_codecid if codec else None, max_size, max_bitrate)
+        elif quality:
+            # 优先匹配 id 和目标 codec
+            selected = next((v for v in videos if v['id'] == quality and v.get('codecid') == target_codecid), None)
+            if not selected:
+                app_logger.info(f"未找到 {codec or 'AVC'} 格式的清晰度 {quality}，使用该格式中最高质量。")
+
+        # 如果未指定 quality 或找不到对应流，就选该 codec 中 id 最大的
         if not selected:
-            app_logger.info(f"未找到 {codec or 'AVC'} 格式的清晰度 {quality}，使用该格式中最高质量。")
+            filtered_videos = [v for v in videos if v.get('codecid') == target_codecid]
+            if filtered_videos:
+                selected = max(filtered_videos, key=lambda v: v['id'])
+            else:
+                app_logger.warning(f"未找到 {codec or 'AVC'} 格式的视频，使用第一个可用视频流。")
+                selected = videos[0]
 
-    # 如果未指定 quality 或找不到对应流，就选该 codec 中 id 最大的
-    if not selected:
-        filtered_videos = [v for v in videos if v.get('codecid') == target_codecid]
-        if filtered_videos:
-            selected = max(filtered_videos, key=lambda v: v['id'])
-        else:
-            app_logger.warning(f"未找到 {codec or 'AVC'} 格式的视频，使用第一个可用视频流。")
-            selected = videos[0]
+        app_logger.info(f'选择下载的清晰度: {quality_id_name_map[selected["id"]]}, 格式: {codec_dict[selected["codecid"]]}')
+        app_logger.info(f'视频标题: {title}')
 
-    app_logger.info(f'选择下载的清晰度: {quality_id_name_map[selected["id"]]}, 格式: {codec_dict[selected["codecid"]]}')
-    app_logger.info(f'视频标题: {title}')
+        video_url, *video_mirrors = stream_mirrors(selected)
+        # 选择音频流（默认最高）
+        audio = audio or audios[0]
+        audio_url, *audio_mirrors = stream_mirrors(audio)
 
-    video_url = selected.get('baseUrl') or selected.get('base_url')
-    # 选择音频流（默认最高）
-    audio = audios[0]
-    audio_url = audio.get('baseUrl') or audio.get('base_url')
+    if save:
+        save_path = Path(save)
+        save_path.mkdir(parents=True, exist_ok=True)
+    else:
+        save_path = Path('.')  # 当前目录
+    output_path = save_path / f'{title}_{quality_id_name_map[selected["id"]]}_{codec_dict[selected["codecid"]]}.mp4'
 
-    video_file = f'{title}_v_{selected["id"]}.m4s'
-    audio_file = f'{title}_a_{selected["id"]}.m4s'
+    # 中间文件名带上任务的唯一标识，同名视频的并发任务不会互相覆盖；标识是确定的，断点续传时能找回原来的文件
+    key = hashlib.sha1(f'{url}|{selected["id"]}|{selected.get("codecid")}'.encode('utf-8')).hexdigest()[:10]
+    if work_dir:
+        work_path = Path(work_dir)
+        work_path.mkdir(parents=True, exist_ok=True)
+    else:
+        work_path = Path('.')
+    # 合并结果先写到临时文件，完成后再移动到 output_path，保存目录中不会出现写了一半的 mp4
+    merge_path = (work_path if work_dir else save_path) / f'{output_path.stem}.{key}.part.mp4'
+
+    plan = {
+        'url': url,
+        'headers': headers,
+        'title': title,
+        'bvid': resolved.get('bvid'),
+        'cid': resolved.get('cid'),
+        'quality': selected['id'],
+        'codecid': selected['codecid'],
+        'video_url': video_url,
+        'audio_url': audio_url,
+        'video_mirrors': video_mirrors,
+        'audio_mirrors': audio_mirrors,
+        'video_file': str(work_path / f'{title}_{key}_v_{selected["id"]}.m4s'),
+        'audio_file': str(work_path / f'{title}_{key}_a_{selected["id"]}.m4s'),
+        'merge_path': merge_path,
+        'output_path': output_path,
+    }
+    metrics = current_metrics()
+    if metrics:
+        metrics.title, metrics.bvid = plan['title'], plan['bvid']
+    return plan
+
+
+def fetch_streams(plan: dict, progress, connections: int = 1, resume: bool = False, remove_finished: bool = False,
+                  stream_merge: bool = False, keep_m4s: bool = False):
+    """
+    下载阶段：并发下载计划中的视频流和音频流
+
+    stream_merge 为 True 时边下载边合并，下载结束即得到 mp4，合并阶段会被跳过
+    """
+    if plan.get('skipped'):
+        return
     start = int(time.time() * 1000)
+    headers = plan['headers']
+    if stream_merge and not stream_remux_supported():
+        app_logger.warning('当前系统不支持边下载边合并，使用普通模式')
+        stream_merge = False
+    if stream_merge and not Path(get_ffmpeg_path()).exists():
+        app_logger.warning('未找到 ffmpeg，无法边下载边合并，使用普通模式')
+        stream_merge = False
+
+    with phase('transfer'):
+        if stream_merge:
+            tasks = stream_remux(plan, progress, keep_m4s)
+            plan['merged'] = True
+        else:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    submit_in_context(executor, run_metered, 'video', download_stream, plan['video_url'], headers,
+                                      plan['video_file'], progress, connections, resume, plan.get('video_mirrors')),
+                    submit_in_context(executor, run_metered, 'audio', download_stream, plan['audio_url'], headers,
+                                      plan['audio_file'], progress, connections, resume, plan.get('audio_mirrors')),
+                ]
+                tasks = [future.result() for future in futures]
+
+    if remove_finished:
+        for task in tasks:
+            progress.remove_task(task)
 
-    with Progress(
-        TextColumn("[progress.description]{task.description}"),
-        BarColumn(),
-        TaskProgressColumn(),
-        TimeRemainingColumn(),
-        TimeElapsedColumn(),
-        # MofNCompleteColumn(),
-        FileSizeColumn(),
-        TotalFileSizeColumn(),
-        SpinnerColumn(),
-        TransferSpeedColumn(),
-    ) as progress:
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            executor.submit(download_stream, video_url, headers, video_file, progress)
-            executor.submit(download_stream, audio_url, headers, audio_file, progress)
+    end = int(time.time() * 1000)
+    app_logger.info(f'{plan["title"]} 下载音视频共耗时: {end - start} ms')
 
 
-    end = int(time.time() * 1000)
-    app_logger.info(f'下载音视频共耗时: {end - start} ms')
+def merge_streams(plan: dict, keep_m4s: bool = False, merger: str = 'ffmpeg'):
+    """
+    合并阶段：使用 ffmpeg 或内置的 fMP4 合并器合并音视频（边下载边合并时已经合并好），
+    移动到保存目录并记入下载索引，最后删除中间文件
+    """
+    if plan.get('skipped'):
+        return
+    output_path = plan['output_path']
+    merge_path = plan['merge_path']
+    if not plan.get('merged'):
+        if output_path.exists():
+            app_logger.warning('目标MP4存在，合并完成后将被覆盖')
+
+        if merger == 'ffmpeg' and not Path(get_ffmpeg_path()).exists():
+            app_logger.warning('未找到 ffmpeg，使用内置合并器')
+            merger = 'native'
+
+        app_logger.info(f"所有流下载完成，使用 {merger} 合并音视频")
+        merge = merge_m4s_native if merger == 'native' else merge_m4s_ffmpeg
+        with phase('merge'):
+            # 上次合并被中断时可能留下同名的临时文件
+            merge_path.unlink(missing_ok=True)
+            if not merge(plan['video_file'], plan['audio_file'], str(merge_path)):
+                merge_path.unlink(missing_ok=True)
+                raise RuntimeError(f'合并失败: {output_path}')
+
+    with phase('publish'):
+        # 在工作目录中计算校验和，避免从保存目录（可能是网络存储）再读一遍
+        indexed = plan.get('bvid') and plan.get('cid')
+        sha256 = file_checksum(merge_path) if indexed else None
+        move_into_place(merge_path, output_path)
+        if indexed:
+            download_index.add(plan['bvid'], plan['cid'], plan['quality'], plan['codecid'], output_path, sha256,
+                               plan.get('request'))
+    app_logger.info(f'已保存到: {output_path}')
+    if not keep_m4s:
+        with phase('cleanup'):
+            Path.unlink(Path(plan['video_file']), missing_ok=True)
+            Path.unlink(Path(plan['audio_file']), missing_ok=True)
 
-    if save:
-        save_path = Path(save)
-        save_path.mkdir(parents=True, exist_ok=True)
-    else:
-        save_path = Path('.')  # 当前目录
-    output_path = save_path / f'{title}_{quality_id_name_map[selected["id"]]}_{codec_dict[target_codecid]}.mp4'
-    if output_path.exists():
-        app_logger.warning('目标MP4存在，进行删除')
-        output_path.unlink()
-
-    app_logger.info("所有流下载完成，使用 ffmpeg 合并音视频")
-    merge_m4s_ffmpeg(video_file, audio_file, str(output_path))
-    Path.unlink(Path(video_file), missing_ok=True)
-    Path.unlink(Path(audio_file), missing_ok=True)
\ No newline at end of file
+
+def download_sync(
+        url: str,
+        headers: dict,
+        quality: Optional[int] = None,
+        codec: Optional[str] = None,
+        save: str = None,
+        connections: int = 1,
+        resume: bool = False,
+        stream_merge: bool = False,
+        keep_m4s: bool = False,
+        merger: str = 'ffmpeg',
+        retries: int = DEFAULT_RETRY_BUDGET,
+        work_dir: Optional[str] = None,
+        force: bool = False,
+        max_size: Optional[int] = None,
+        max_bitrate: Optional[int] = None,
+):
+    with use_retry_budget(RetryBudget(retries)):
+        plan = prepare_download(url, headers, quality, codec, save, work_dir, force, max_size, max_bitrate)
+        with new_progress() as progress:
+            fetch_streams(plan, progress, connections, resume, stream_merge=stream_merge, keep_m4s=keep_m4s)
+    merge_streams(plan, keep_m4s, merger)
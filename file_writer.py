@@ -0,0 +1,231 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+from log_config import app_logger
+
+# 默认的写缓冲大小：网络上收到的小数据块先攒到缓冲区，满了再一次性写入文件
+DEFAULT_WRITE_BUFFER = 4 * 1024 * 1024
+
+
+class WriterConfig:
+    """
+    写文件的全局配置
+
+    buffer_size 为每个写入器的缓冲字节数，fsync 为 True 时文件下载完成后调用 fsync，
+    确保数据真正落盘（NAS、网络文件系统上可以避免断电或断网后得到不完整的文件）。
+    preallocate 为 False 时不预分配磁盘空间，只用 truncate 设置文件大小。
+    """
+
+    def __init__(self, buffer_size: int = DEFAULT_WRITE_BUFFER, fsync: bool = False, preallocate: bool = True):
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.preallocate = preallocate
+
+
+writer_config = WriterConfig()
+
+
+def configure_writer(buffer_size: Optional[int] = None, fsync: bool = False, preallocate: bool = True):
+    writer_config.buffer_size = buffer_size or DEFAULT_WRITE_BUFFER
+    writer_config.fsync = fsync
+    writer_config.preallocate = preallocate
+
+
+def linux_fallocate():
+    """
+    返回 libc 中的 fallocate(2)，不是 Linux 或者找不到时返回 None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    func.restype = ctypes.c_int
+    return func
+
+
+_fallocate = linux_fallocate()
+
+
+def allocate_space(fd: int, size: int):
+    """
+    为 fd 分配 size 字节的磁盘空间，文件系统不支持时抛出 OSError
+
+    Linux 上直接调用 fallocate(2)：glibc 的 posix_fallocate 在文件系统不支持时（例如 NFS、SMB）
+    会退化为逐块写零，相当于把整个文件先写一遍，而 fallocate(2) 会直接返回 EOPNOTSUPP。
+    """
+    if _fallocate is not None:
+        if _fallocate(fd, 0, 0, size) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    elif hasattr(os, 'posix_fallocate') and not sys.platform.startswith('linux'):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        raise OSError(errno.EOPNOTSUPP, '不支持预分配')
+
+
+def preallocate(filename: str, size: int):
+    """
+    创建（或清空）文件并预分配 size 字节
+
+    支持的文件系统上一次性分配好磁盘空间，减少边写边扩展文件导致的碎片和元数据更新；
+    文件系统不支持（例如部分网络文件系统）或者关闭了预分配时退回到 truncate 设置文件大小。
+    """
+    with open(filename, 'wb') as f:
+        if size <= 0:
+            return
+        if writer_config.preallocate:
+            try:
+                allocate_space(f.fileno(), size)
+                return
+            except OSError as e:
+                app_logger.debug(f'预分配失败，使用 truncate: {filename}, {e}')
+        f.truncate(size)
+
+
+def sync_file(filename: str):
+    """
+    把文件已写入的数据刷到磁盘
+    """
+    with open(filename, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+class FileWriter:
+    """
+    从 offset 处开始顺序写入文件的带缓冲写入器
+
+    写入的数据先放进缓冲区，缓冲区达到 buffer_size 时才写入文件，把大量小块写合并为少量大块写。
+    on_flush 在每次缓冲区写入文件后以 (起始偏移, 结束偏移) 调用，用于记录断点续传日志，
+    保证日志中记录的区间一定已经写入文件。文件需要事先创建好（见 preallocate）。
+    """
+
+    def __init__(self, filename: str, offset: int = 0, buffer_size: Optional[int] = None,
+                 on_flush: Optional[Callable[[int, int], None]] = None):
+        self.filename = filename
+        self.file = open(filename, 'r+b', buffering=0)
+        self.file.seek(offset)
+        self.pos = offset
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size or writer_config.buffer_size
+        self.on_flush = on_flush
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with memoryview(self.buffer) as view:
+            written = 0
+            while written < len(view):
+                written += self.file.write(view[written:])
+        start = self.pos
+        self.pos += len(self.buffer)
+        self.buffer.clear()
+        if self.on_flush:
+            self.on_flush(start, self.pos - 1)
+
+    def truncate(self):
+        """
+        把文件截断到当前写入位置，用于顺序下载时实际收到的数据比预分配的少的情况
+        """
+        self.flush()
+        self.file.truncate(self.pos)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def __enter__(self) -> 'FileWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StreamFile:
+    """
+    顺序下载的音视频流文件
+
+    收到响应、知道文件大小后调用 allocate 预分配空间（没有调用时在第一次写入时创建文件），
+    全部写完后调用 complete，把文件截断到实际写入的大小并按配置 fsync。
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.writer: Optional[FileWriter] = None
+
+    def allocate(self, size: int):
+        if self.writer:
+            self.writer.close()
+        preallocate(self.filename, size)
+        self.writer = FileWriter(self.filename)
+
+    def write(self, data: bytes):
+        if self.writer is None:
+            self.allocate(0)
+        self.writer.write(data)
+
+    def complete(self):
+        if self.writer is None:
+            self.allocate(0)
+        self.writer.truncate()
+        self.writer.close()
+        finish_file(self.filename)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    def __enter__(self) -> 'StreamFile':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def finish_file(filename: str):
+    """
+    文件下载完成后按配置决定是否 fsync
+    """
+    if writer_config.fsync:
+        sync_file(filename)
+
+
+def move_into_place(src: Path, dst: Path):
+    """
+    把工作目录中生成好的文件移动到 dst，dst 在任何时刻要么不存在（或是旧文件），要么是完整的新文件
+
+    同一文件系统上直接原子 rename；跨文件系统（例如工作目录在 tmpfs、保存目录在 NAS）时，
+    先顺序复制为 dst 所在目录中的唯一临时文件，完成后再 rename 为 dst。
+    """
+    try:
+        os.replace(src, dst)
+        finish_file(str(dst))
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_path = dst.with_name(f'.{dst.name}.{uuid.uuid4().hex[:8]}.part')
+    try:
+        shutil.copyfile(src, tmp_path)
+        finish_file(str(tmp_path))
+        os.replace(tmp_path, dst)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    Path(src).unlink()
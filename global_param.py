@@ -1,5 +1,31 @@
+import os
+from pathlib import Path
+
+# 每个任务默认的重试次数上限，所有请求共用
+DEFAULT_RETRY_BUDGET = 20
+
+# 指标文件支持的格式
+METRICS_FORMATS = ('json', 'prometheus')
+
+
+def state_dir() -> Path:
+    """
+    本地状态（元数据缓存、下载索引、同步状态、任务队列）所在的目录，不随运行目录变化
+
+    可以用环境变量 BILIX_STATE_DIR 指定；默认 Windows 为 %LOCALAPPDATA%\\bilix，
+    其他系统为 $XDG_STATE_HOME/bilix（未设置时为 ~/.local/state/bilix）。目录在第一次写入时才会创建。
+    """
+    if custom := os.environ.get('BILIX_STATE_DIR'):
+        return Path(custom)
+    if os.name == 'nt' and (local_app_data := os.environ.get('LOCALAPPDATA')):
+        return Path(local_app_data) / 'bilix'
+    return Path(os.environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state') / 'bilix'
+
+
+STATE_DIR = state_dir()
+
 codec_id_name_map = {
     7: 'AVC(H.264)',
     12: 'HEVC(H.265)',
     13: 'AV1',
-}
\ No newline at end of file
+}
@@ -0,0 +1,255 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from log_config import app_logger
+
+QUEUE_FILE_NAME = 'bilix_queue.db'
+
+# 任务状态：queued 等待执行，running 已被某个进程领取，其余为最终状态
+JOB_STATES = ('queued', 'running', 'succeeded', 'skipped', 'failed')
+
+# 领取任务的进程每隔 HEARTBEAT_INTERVAL 秒刷新一次心跳，队列文件被其他机器共用时，
+# 超过 LEASE_TIMEOUT 秒没有心跳的任务视为进程已退出
+HEARTBEAT_INTERVAL = 15
+LEASE_TIMEOUT = 90
+
+# 失败的任务在重新运行队列时最多再尝试到这个次数
+MAX_ATTEMPTS = 3
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    本机上 pid 对应的进程是否仍在运行
+    """
+    if os.name == 'nt':
+        # Windows 上 os.kill 会直接结束进程，改用 OpenProcess 查询
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    基于 SQLite（WAL 模式）的持久化下载队列
+
+    每个任务记录 url、清晰度、编码、保存目录、状态、尝试次数和各个时间点。同样的 (url, 清晰度, 编码, 保存目录)
+    只会入队一次，重复运行同一个 URL 列表时已完成的任务不会再次解析。
+    任务在 BEGIN IMMEDIATE 事务中领取，多个线程或进程共用一个队列文件时同一任务只会被领取一次；
+    进程被杀死后，下次运行时它领取的任务重新回到 queued 状态（见 recover），从中断处继续。
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.claimed: dict[object, int] = {}
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # isolation_level=None 时由我们自己控制事务，领取任务需要 BEGIN IMMEDIATE
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, quality INTEGER, codec TEXT, save TEXT, '
+                'state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, output_path TEXT, owner TEXT, '
+                'created_at REAL NOT NULL, updated_at REAL NOT NULL, claimed_at REAL, heartbeat_at REAL, '
+                'finished_at REAL)'
+            )
+            self.conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_request ON jobs "
+                "(url, IFNULL(quality, 0), IFNULL(codec, ''), IFNULL(save, ''))"
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id)')
+        return self.conn
+
+    def add(self, jobs: list[tuple[str, Optional[int], Optional[str], Optional[str]]]) -> int:
+        """
+        把 (url, 清晰度, 编码, 保存目录) 加入队列，已经在队列中的跳过，返回新加入的数量
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            before = conn.total_changes
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO jobs (url, quality, codec, save, state, created_at, updated_at) '
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    [(url, quality, codec, save, now, now) for url, quality, codec, save in jobs]
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            return conn.total_changes - before
+
+    def recover(self, max_attempts: int = MAX_ATTEMPTS) -> int:
+        """
+        把领取它的进程已经退出的任务，以及尝试次数未到 max_attempts 的失败任务放回队列，返回数量
+
+        本机进程领取的任务检查进程是否存在且心跳没有过期，其他机器上的进程只按心跳是否过期判断。
+        """
+        now = time.time()
+        host = socket.gethostname()
+        with self.lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                stale = []
+                for row in conn.execute("SELECT id, owner, heartbeat_at FROM jobs WHERE state = 'running'"):
+                    owner_host, _, pid = (row['owner'] or '').rpartition(':')
+                    lease_valid = (row['heartbeat_at'] or 0) >= now - LEASE_TIMEOUT
+                    if owner_host == host and pid.isdigit():
+                        # pid 可能已被其他进程复用（例如容器或系统重启后），心跳过期同样视为已退出
+                        alive = int(pid) != os.getpid() and pid_alive(int(pid)) and lease_valid
+                    else:
+                        alive = lease_valid
+                    if not alive:
+                        stale.append((now, row['id']))
+                conn.executemany("UPDATE jobs SET state = 'queued', owner = NULL, updated_at = ? WHERE id = ?", stale)
+                failed = conn.execute(
+                    "UPDATE jobs SET state = 'queued', updated_at = ? WHERE state = 'failed' AND attempts < ?",
+                    (now, max_attempts)
+                ).rowcount
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        if stale:
+            app_logger.info(f'恢复 {len(stale)} 个中断的任务')
+        if failed:
+            app_logger.info(f'重试 {failed} 个失败的任务')
+        return len(stale) + failed
+
+    def claim(self) -> Optional[sqlite3.Row]:
+        """
+        领取最早入队的一个任务，没有可领取的任务时返回 None
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, owner = ?, claimed_at = ?, "
+                    'heartbeat_at = ?, updated_at = ? WHERE id = ?', (self.owner, now, now, now, row['id'])
+                )
+                job = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return job
+
+    def finish(self, job_id: int, state: str, error: Optional[str] = None, output_path: Optional[str] = None):
+        now = time.time()
+        with self.lock:
+            self._connect().execute(
+                'UPDATE jobs SET state = ?, error = ?, output_path = ?, owner = NULL, updated_at = ?, finished_at = ? '
+                'WHERE id = ?', (state, error, output_path, now, now, job_id)
+            )
+
+    def heartbeat(self):
+        now = time.time()
+        with self.lock:
+            self._connect().execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND state = 'running'", (now, self.owner)
+            )
+
+    def counts(self) -> dict[str, int]:
+        with self.lock:
+            rows = self._connect().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {state: count for state, count in rows}
+
+    def finished_urls(self, urls: list[str], quality: Optional[int], codec: Optional[str],
+                      save: Optional[str]) -> set[str]:
+        """
+        urls 中以相同的清晰度、编码和保存目录下载成功（或因为已下载而跳过）的 URL
+
+        和队列的唯一索引使用相同的键，用其他参数下载过的 URL 不算下载完成。
+        """
+        finished = set()
+        with self.lock:
+            conn = self._connect()
+            # 分批查询，避免超过 SQLite 的参数数量上限
+            for i in range(0, len(urls), 500):
+                batch = urls[i:i + 500]
+                finished.update(url for url, in conn.execute(
+                    f"SELECT url FROM jobs WHERE state IN ('succeeded', 'skipped') "
+                    f"AND url IN ({', '.join('?' * len(batch))}) AND IFNULL(quality, 0) = IFNULL(?, 0) "
+                    f"AND IFNULL(codec, '') = IFNULL(?, '') AND IFNULL(save, '') = IFNULL(?, '')",
+                    [*batch, quality, codec, save]
+                ))
+        return finished
+
+    def iter_tasks(self, make_task: Callable[[sqlite3.Row], object]) -> Iterator:
+        """
+        依次领取任务并用 make_task 创建下载任务，调度器需要新任务时才领取下一个；
+        任务结束后调用 finish_task 记录结果
+        """
+        while (job := self.claim()) is not None:
+            task = make_task(job)
+            with self.lock:
+                self.claimed[task] = job['id']
+            yield task
+
+    def finish_task(self, task, ok: bool):
+        """
+        记录 iter_tasks 创建的任务的结果，可直接作为调度器的 on_finish
+        """
+        with self.lock:
+            job_id = self.claimed.pop(task)
+        plan = task.plan or {}
+        output_path = str(plan['output_path']) if ok and plan.get('output_path') else None
+        self.finish(job_id, task.metrics.status, task.metrics.error, output_path)
+
+    def _heartbeat_loop(self):
+        while not self.heartbeat_stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+            except sqlite3.Error:
+                app_logger.warning('刷新任务队列心跳失败', exc_info=True)
+
+    def __enter__(self) -> 'JobQueue':
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='bilix-queue-heartbeat',
+                                                 daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.heartbeat_stop.set()
+        self.heartbeat_thread.join()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
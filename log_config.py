@@ -1,4 +1,5 @@
 import logging.config
+import sys
 
 log_config_dict = {
     'version': 1,
@@ -33,4 +34,13 @@ def log_init():
     logging.config.dictConfig(log_config_dict)
 
 
-app_logger = logging.getLogger('bilix')
\ No newline at end of file
+app_logger = logging.getLogger('bilix')
+
+
+def log_to_stderr():
+    """
+    日志改为输出到 stderr，标准输出只保留机器可读的结果（例如 --info --format json）
+    """
+    for handler in app_logger.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(sys.stderr)
\ No newline at end of file
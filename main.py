@@ -1,4 +1,5 @@
 import copy
+import json
 import sys
 import time
 from pathlib import Path
@@ -7,16 +8,13 @@ from typing import Annotated, Optional, List
 import typer
 from typer import Option, Argument
 
-from download_sync import download_sync, parse, get_bangumi_episode
-from log_config import app_logger, log_init
-from login import qrcode_img, get_cookie
-from tool import load_urls_from_file, clean_bili_url, parse_page_input
-from update import update_exe
-from user import get_user_info
+from global_param import DEFAULT_RETRY_BUDGET, METRICS_FORMATS, STATE_DIR
+from log_config import app_logger, log_init, log_to_stderr
 
-__version__ = "v1.2.2"
+# 下载、登录、更新等功能依赖的模块（curl_cffi、rich、qrcode 等）导入较慢，只在用到时才导入，
+# 使 --version、--logout 等不需要网络的命令能立即返回
 
-from video_info import create_bili_video
+__version__ = "v1.2.2"
 
 
 def version_callback(value: bool):
@@ -25,21 +23,52 @@ def version_callback(value: bool):
         raise typer.Exit()
 
 app = typer.Typer()
+serve_app = typer.Typer()
+sync_app = typer.Typer()
 
 download_headers = {
     'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
 }
 
-class BiliTask:
-    def __init__(self, url: str, headers: dict, quality: int, codec:str, save: str):
-        self.url = url
-        self.headers = headers
-        self.quality = quality
-        self.codec = codec
-        self.save = save
+def load_cookie():
+    if Path('cookie.txt').is_file():
+        app_logger.info(f'找到 cookie.txt 文件')
+        download_headers['Cookie'] = open('cookie.txt', 'r', encoding='utf-8').read()
+    else:
+        app_logger.warning(f'未找到 cookie.txt 文件')
+
+
+def new_scheduler(engine: str, jobs: int, connections: int):
+    from scheduler import AsyncTaskScheduler, TaskScheduler
+    if engine == 'async':
+        return AsyncTaskScheduler(jobs=jobs, connections=connections)
+    return TaskScheduler(jobs=jobs)
 
-    def download(self):
-        download_sync(self.url, self.headers, self.quality, self.codec, self.save)
+
+def run_job_queue(queue_file: str, entries: list, scheduler, task_options: dict):
+    """
+    把 (url, 清晰度, 编码, 保存目录) 加入持久化队列，再从队列中逐个领取任务执行，返回 (成功的任务, 失败的任务)
+    """
+    from job_queue import JobQueue
+    from task import BiliTask
+
+    def make_task(job) -> BiliTask:
+        return BiliTask(url=job['url'], headers=dict(download_headers, Referer=job['url']), quality=job['quality'], codec=job['codec'], save=job['save'], **task_options)
+
+    with JobQueue(queue_file) as job_queue:
+        added = job_queue.add(entries)
+        job_queue.recover()
+        app_logger.info(f'任务队列: {queue_file}, 新加入: {added} 个, 当前状态: {job_queue.counts()}')
+        return scheduler.run(job_queue.iter_tasks(make_task), job_queue.finish_task)
+
+
+def report_results(succeeded: list, failed: list):
+    skipped = sum(1 for task in succeeded if task.skipped)
+    app_logger.info(f'下载结束, 成功: {len(succeeded) - skipped}, 跳过: {skipped}, 失败: {len(failed)}')
+    if failed:
+        for task in failed:
+            app_logger.error(f'下载失败: {task.url}')
+        sys.exit(1)
 
 
 @app.command()
@@ -50,10 +79,34 @@ def download(
         save:    Optional[str] = Option(None, "-s", "--save", help="指定下载结果保存目录路径"),
         page:    Optional[str] = Option(None, "-p", "--page", help="指定要下载的集数，例如 -p 3、-p 1,4,9、-p 4-12；不指定值表示下载全部"),
         info:    bool          = Option(False, "-i", "--info", is_flag=True, help="是否仅获取视频信息"),
+        output_format: str     = Option("text", "--format", help="--info 的输出格式 | text: 信息面板 | json: JSON 数组，日志输出到 stderr |"),
+        info_jobs: int         = Option(8, "--info-jobs", min=1, help="--info 同时获取信息的视频数量"),
         login:   bool          = Option(False, "-l", "--login", is_flag=True, help="登录账号"),
         logout:  bool          = Option(False, "--logout", is_flag=True, help="退出账号"),
         user:    bool          = Option(False, "-u", "--user", is_flag=True, help="当前账号信息"),
         codec:   Optional[str] = Option(None, "--codec", help="指定下载视频的编码格式 | AVC | HEVC | AV1 |"),
+        max_size: Optional[str] = Option(None, "--max-size", help="每个视频（音视频合计）的预计大小上限，例如 500M、1.5G，在上限内选择最好的音视频流"),
+        max_bitrate: Optional[int] = Option(None, "--max-bitrate", min=1, help="音视频合计的码率上限（kbps），在上限内选择最好的音视频流"),
+        connections: int       = Option(4, "-c", "--connections", min=1, help="每个音视频流的并发连接数"),
+        resume:  bool          = Option(False, "--resume", is_flag=True, help="断点续传，继续上次未完成的下载"),
+        jobs:    int           = Option(1, "-j", "--jobs", min=1, help="同时下载的视频数量"),
+        max_rate: Optional[str] = Option(None, "--max-rate", help="下载总带宽上限，例如 512K、10M"),
+        max_rps: Optional[float] = Option(None, "--max-rps", min=0, help="API 请求频率上限（次/秒）"),
+        pool_size: int         = Option(8, "--pool-size", min=1, help="每个 host 保留的 HTTP 连接会话数量"),
+        work_dir: Optional[str] = Option(None, "--work-dir", help="中间文件和合并结果的工作目录（例如本地 SSD），完成后再移动到保存目录"),
+        write_buffer: Optional[str] = Option(None, "--write-buffer", help="写文件的缓冲区大小，例如 1M、8M，默认 4M"),
+        fsync:   bool          = Option(False, "--fsync", is_flag=True, help="每个文件下载完成后调用 fsync，确保数据写入磁盘"),
+        no_preallocate: bool   = Option(False, "--no-preallocate", is_flag=True, help="下载前不预分配磁盘空间"),
+        stream_merge: bool     = Option(False, "--stream-merge", is_flag=True, help="边下载边合并，不落地中间的 m4s 文件"),
+        keep_m4s: bool         = Option(False, "--keep-m4s", is_flag=True, help="合并后保留中间的 m4s 文件"),
+        merger:  str           = Option("ffmpeg", "--merger", help="音视频合并方式 | ffmpeg | native |"),
+        engine:  str           = Option("thread", "--engine", help="下载引擎 | thread: 线程池 | async: 单个事件循环中的协程，适合大量并发 |"),
+        retries: int           = Option(DEFAULT_RETRY_BUDGET, "--retries", min=0, help="每个视频任务最多重试的请求次数"),
+        metrics_file: Optional[str] = Option(None, "--metrics-file", help="把每个任务的阶段耗时、吞吐量等指标写入该文件"),
+        metrics_format: str    = Option("json", "--metrics-format", help="指标文件格式 | json: JSON Lines | prometheus: Prometheus 文本格式 |"),
+        force:   bool          = Option(False, "--force", is_flag=True, help="忽略下载索引，重新下载已下载过的视频"),
+        queue_file: Optional[str] = Option(None, "--queue", help="把任务存入持久化队列文件（SQLite），中断后再次运行即从中断处继续"),
+        no_cache: bool         = Option(False, "--no-cache", is_flag=True, help="不使用本地元数据缓存"),
         update:  bool          = Option(False, "--update", is_flag=True, help="更新程序"),
         version: Annotated[Optional[bool], typer.Option("-v", "--version", callback=version_callback, is_eager=True, help="查看软件版本信息"),] = None,
 ) -> None:
@@ -62,6 +115,7 @@ def download(
     """
 
     if update:
+        from update import update_exe
         update_exe(__version__)
         return
 
@@ -70,6 +124,7 @@ def download(
         if cookie_file.is_file():
             h = copy.deepcopy(download_headers)
             h['cookie'] = cookie_file.read_text()
+            from user import get_user_info
             get_user_info(h)
             return
         else:
@@ -77,6 +132,7 @@ def download(
         return
 
     if login:
+        from login import qrcode_img, get_cookie
         qrcode_key_res = qrcode_img()
         cookie = get_cookie(qrcode_key_res)
         with open('cookie.txt', 'w', encoding='utf-8') as f:
@@ -93,31 +149,74 @@ def download(
             app_logger.warning('用户未登录, 登录请使用 --login 选项')
         return
 
-    if not urls and not origin:
+    if not urls and not origin and not queue_file:
         app_logger.error('请提供一个视频 URL 进行下载，或者查看 --help 帮助信息')
         sys.exit(1)
 
-    if Path('cookie.txt').is_file():
-        app_logger.info(f'找到 cookie.txt 文件')
-        download_headers['Cookie'] = open('cookie.txt', 'r', encoding='utf-8').read()
-    else:
-        app_logger.warning(f'未找到 cookie.txt 文件')
+    if output_format not in ('text', 'json'):
+        raise typer.BadParameter("输出格式只能是 text 或 json")
+    if info and output_format == 'json':
+        log_to_stderr()
+
+    load_cookie()
+
+    if merger not in ('ffmpeg', 'native'):
+        raise typer.BadParameter("合并方式只能是 ffmpeg 或 native")
+    if engine not in ('thread', 'async'):
+        raise typer.BadParameter("下载引擎只能是 thread 或 async")
+    if metrics_format not in METRICS_FORMATS:
+        raise typer.BadParameter("指标文件格式只能是 json 或 prometheus")
+    if stream_merge and merger == 'native':
+        app_logger.warning('边下载边合并依赖 ffmpeg，--merger native 时不可用')
+        stream_merge = False
+    if stream_merge and engine == 'async':
+        app_logger.warning('边下载边合并依赖线程，--engine async 时不可用')
+        stream_merge = False
+
+    from file_writer import configure_writer
+    from meta_cache import meta_cache
+    from rate_limit import configure_rate_limit, report_throttle
+    from session_pool import session_pool
+    from tool import load_urls_from_file, clean_bili_url, parse_page_input, parse_size
+
+    configure_rate_limit(parse_size(max_rate), max_rps)
+    configure_writer(parse_size(write_buffer), fsync, not no_preallocate)
+    session_pool.configure(size=pool_size)
+    meta_cache.enabled = not no_cache
+    max_size_bytes = parse_size(max_size)
 
     start = int(time.time() * 1000)
     try:
-        if info:
-            app_logger.info(f"获取 {len(urls)} 个视频信息")
-            for url in urls:
-                h = copy.deepcopy(download_headers)
-                h['Referer'] = url
-                # get_video_info(url, h)
-                create_bili_video(url, h).show()
-            return
-
         if origin:
             app_logger.info(f'用户指定URL文件: {origin}')
             urls = load_urls_from_file(origin)
+        urls = urls or []
+
+        if info:
+            from video_info import resolve_video_infos, video_info_dict
+            app_logger.info(f"获取 {len(urls)} 个视频信息")
+            results = resolve_video_infos(urls, download_headers, info_jobs)
+            if output_format == 'json':
+                print(json.dumps([video_info_dict(url, result) for url, result in zip(urls, results)],
+                                 ensure_ascii=False, indent=2))
+            else:
+                for result in results:
+                    if not isinstance(result, Exception):
+                        result.show()
+            failed = sum(1 for result in results if isinstance(result, Exception))
+            if failed:
+                app_logger.error(f'获取视频信息失败: {failed} 个')
+                sys.exit(1)
+            return
         app_logger.info(f'开始下载, 共计: {len(urls)} 个任务')
+        from download_sync import parse
+        from playurl_api import get_bangumi_episode
+        from metrics import write_metrics
+        from task import BiliTask
+        task_options = dict(connections=connections, resume=resume, stream_merge=stream_merge, keep_m4s=keep_m4s,
+                            merger=merger, retries=retries, work_dir=work_dir, force=force,
+                            max_size=max_size_bytes, max_bitrate=max_bitrate and max_bitrate * 1000)
+        tasks = []
 
         if len(urls) == 1 and page:
             page_parsed = parse_page_input(page)
@@ -137,7 +236,7 @@ def download(
 
                 app_logger.info(f'检测到番剧集合, 待下载总数: {len(episodes)}')
                 for episode in episodes:
-                    BiliTask(url=episode['share_url'], headers=h, quality=quality, codec=codec, save=save).download()
+                    tasks.append(BiliTask(url=episode['share_url'], headers=h, quality=quality, codec=codec, save=save, **task_options))
             # 下载普通多集视频
             else:
                 app_logger.info(f'准备下载视频集合, page={page_parsed}')
@@ -149,22 +248,171 @@ def download(
                     download_page_nums = page_nums if page_parsed == 'all' else page_parsed
                     app_logger.info(f'检测到视频集合, 待下载总数: {len(download_page_nums)}, 集数: {download_page_nums}')
                     for page in download_page_nums:
-                        BiliTask(url=f'{url}?p={page}', headers=h, quality=quality, codec=codec, save=save).download()
+                        tasks.append(BiliTask(url=f'{url}?p={page}', headers=h, quality=quality, codec=codec, save=save, **task_options))
         else:
             for url in urls:
                 clean_url = clean_bili_url(url)
                 h = copy.deepcopy(download_headers)
                 h['Referer'] = clean_url
-                BiliTask(url=clean_url, headers=h, quality=quality, codec=codec, save=save).download()
+                tasks.append(BiliTask(url=clean_url, headers=h, quality=quality, codec=codec, save=save, **task_options))
+
+        scheduler = new_scheduler(engine, jobs, connections)
+        if queue_file:
+            succeeded, failed = run_job_queue(queue_file, [(task.url, task.quality, task.codec, task.save) for task in tasks],
+                                              scheduler, task_options)
+            tasks = succeeded + failed
+        else:
+            succeeded, failed = scheduler.run(tasks)
+        if metrics_file:
+            write_metrics(metrics_file, metrics_format, [task.metrics for task in tasks])
+        report_results(succeeded, failed)
 
     except Exception:
         app_logger.exception(f"下载过程中出现错误")
         sys.exit(1)
     finally:
+        report_throttle()
+        end = int(time.time() * 1000)
+        app_logger.info(f'总耗时: {end - start} ms')
+
+
+@serve_app.command()
+def serve(
+        host:    str           = Option("127.0.0.1", "--host", help="监听地址，默认只接受本机请求"),
+        port:    int           = Option(8730, "--port", help="监听端口"),
+        quality: Optional[int] = Option(None, "-q", "--quality", help="任务未指定清晰度时使用的清晰度"),
+        codec:   Optional[str] = Option(None, "--codec", help="任务未指定编码时使用的编码格式 | AVC | HEVC | AV1 |"),
+        max_size: Optional[str] = Option(None, "--max-size", help="每个视频（音视频合计）的预计大小上限，例如 500M、1.5G"),
+        max_bitrate: Optional[int] = Option(None, "--max-bitrate", min=1, help="音视频合计的码率上限（kbps）"),
+        save:    Optional[str] = Option(None, "-s", "--save", help="任务未指定保存目录时使用的保存目录"),
+        connections: int       = Option(4, "-c", "--connections", min=1, help="每个音视频流的并发连接数"),
+        jobs:    int           = Option(2, "-j", "--jobs", min=1, help="同时下载的视频数量"),
+        max_rate: Optional[str] = Option(None, "--max-rate", help="下载总带宽上限，例如 512K、10M"),
+        max_rps: Optional[float] = Option(None, "--max-rps", min=0, help="API 请求频率上限（次/秒）"),
+        pool_size: int         = Option(8, "--pool-size", min=1, help="每个 host 保留的 HTTP 连接会话数量"),
+        work_dir: Optional[str] = Option(None, "--work-dir", help="中间文件和合并结果的工作目录，完成后再移动到保存目录"),
+        write_buffer: Optional[str] = Option(None, "--write-buffer", help="写文件的缓冲区大小，例如 1M、8M，默认 4M"),
+        fsync:   bool          = Option(False, "--fsync", is_flag=True, help="每个文件下载完成后调用 fsync"),
+        no_preallocate: bool   = Option(False, "--no-preallocate", is_flag=True, help="下载前不预分配磁盘空间"),
+        merger:  str           = Option("ffmpeg", "--merger", help="音视频合并方式 | ffmpeg | native |"),
+        retries: int           = Option(DEFAULT_RETRY_BUDGET, "--retries", min=0, help="每个视频任务最多重试的请求次数"),
+        no_cache: bool         = Option(False, "--no-cache", is_flag=True, help="不使用本地元数据缓存"),
+) -> None:
+    """
+    以守护进程方式运行，通过本地 HTTP/JSON 接口接收下载和信息查询任务，连接、缓存和调度器在任务之间复用
+    """
+    if merger not in ('ffmpeg', 'native'):
+        raise typer.BadParameter("合并方式只能是 ffmpeg 或 native")
+
+    from daemon import JobServer
+    from file_writer import configure_writer
+    from meta_cache import meta_cache
+    from rate_limit import configure_rate_limit
+    from session_pool import session_pool
+    from tool import parse_size
+
+    load_cookie()
+    configure_rate_limit(parse_size(max_rate), max_rps)
+    configure_writer(parse_size(write_buffer), fsync, not no_preallocate)
+    session_pool.configure(size=pool_size)
+    meta_cache.enabled = not no_cache
+
+    defaults = dict(quality=quality, codec=codec, save=save, connections=connections, merger=merger,
+                    retries=retries, work_dir=work_dir, max_size=parse_size(max_size),
+                    max_bitrate=max_bitrate and max_bitrate * 1000)
+    JobServer(download_headers, defaults, jobs, host, port).serve_forever()
+
+
+@sync_app.command()
+def sync(
+        mids:    List[int]     = Option(None, "--mid", help="UP 主的 mid，可以多次指定"),
+        seasons: List[str]     = Option(None, "--season", help="追更的番剧，番剧 URL 或 md/ss/ep 号，可以多次指定"),
+        queue_file: Optional[str] = Option(None, "--queue", help="新投稿加入的持久化队列文件，默认为本地状态目录中的 bilix_queue.db"),
+        quality: Optional[int] = Option(None, "-q", "--quality", help="视频清晰度 | 120: 4K | 112: 1080P+ | 80: 1080P | 64: 720P | 32: 480P | 16: 360P |"),
+        codec:   Optional[str] = Option(None, "--codec", help="指定下载视频的编码格式 | AVC | HEVC | AV1 |"),
+        max_size: Optional[str] = Option(None, "--max-size", help="每个视频（音视频合计）的预计大小上限，例如 500M、1.5G，在上限内选择最好的音视频流"),
+        max_bitrate: Optional[int] = Option(None, "--max-bitrate", min=1, help="音视频合计的码率上限（kbps），在上限内选择最好的音视频流"),
+        save:    Optional[str] = Option(None, "-s", "--save", help="指定下载结果保存目录路径"),
+        full:    bool          = Option(False, "--full", is_flag=True, help="忽略上次同步的位置，重新检查全部投稿（已在队列中的不会重复加入）"),
+        page_jobs: int         = Option(4, "--page-jobs", min=1, help="同时请求的投稿列表页数"),
+        enqueue_only: bool     = Option(False, "--enqueue-only", is_flag=True, help="只把新投稿加入队列，不下载"),
+        connections: int       = Option(4, "-c", "--connections", min=1, help="每个音视频流的并发连接数"),
+        resume:  bool          = Option(False, "--resume", is_flag=True, help="断点续传，继续上次未完成的下载"),
+        jobs:    int           = Option(1, "-j", "--jobs", min=1, help="同时下载的视频数量"),
+        max_rate: Optional[str] = Option(None, "--max-rate", help="下载总带宽上限，例如 512K、10M"),
+        max_rps: Optional[float] = Option(None, "--max-rps", min=0, help="API 请求频率上限（次/秒）"),
+        work_dir: Optional[str] = Option(None, "--work-dir", help="中间文件和合并结果的工作目录，完成后再移动到保存目录"),
+        merger:  str           = Option("ffmpeg", "--merger", help="音视频合并方式 | ffmpeg | native |"),
+        engine:  str           = Option("thread", "--engine", help="下载引擎 | thread | async |"),
+        retries: int           = Option(DEFAULT_RETRY_BUDGET, "--retries", min=0, help="每个视频任务最多重试的请求次数"),
+        no_cache: bool         = Option(False, "--no-cache", is_flag=True, help="不使用本地元数据缓存"),
+) -> None:
+    """
+    同步 UP 主的投稿和追更的番剧：只把上次同步之后的新投稿、新剧集加入任务队列并下载
+    """
+    if not mids and not seasons:
+        raise typer.BadParameter("需要指定 --mid 或 --season")
+    if merger not in ('ffmpeg', 'native'):
+        raise typer.BadParameter("合并方式只能是 ffmpeg 或 native")
+    if engine not in ('thread', 'async'):
+        raise typer.BadParameter("下载引擎只能是 thread 或 async")
+
+    from job_queue import QUEUE_FILE_NAME, JobQueue
+    from meta_cache import meta_cache
+    from rate_limit import configure_rate_limit, report_throttle
+    from season_sync import follow_season
+    from sync_state import SyncState
+    from tool import parse_size
+    from uploader_sync import sync_uploader
+
+    load_cookie()
+    configure_rate_limit(parse_size(max_rate), max_rps)
+    meta_cache.enabled = not no_cache
+    max_size_bytes = parse_size(max_size)
+    queue_file = queue_file or str(STATE_DIR / QUEUE_FILE_NAME)
+
+    start = int(time.time() * 1000)
+    try:
+        sync_failed = False
+        sync_state = SyncState()
+        with JobQueue(queue_file) as job_queue:
+            for mid in mids or []:
+                try:
+                    sync_uploader(mid, download_headers, sync_state, job_queue, quality, codec, save, full, page_jobs)
+                except Exception:
+                    app_logger.exception(f'同步 UP 主 {mid} 失败')
+                    sync_failed = True
+            for season in seasons or []:
+                try:
+                    follow_season(season, download_headers, sync_state, job_queue, quality, codec, save)
+                except Exception:
+                    app_logger.exception(f'同步番剧 {season} 失败')
+                    sync_failed = True
+
+        if not enqueue_only:
+            task_options = dict(connections=connections, resume=resume, merger=merger, retries=retries,
+                                work_dir=work_dir, max_size=max_size_bytes,
+                                max_bitrate=max_bitrate and max_bitrate * 1000)
+            succeeded, failed = run_job_queue(queue_file, [], new_scheduler(engine, jobs, connections), task_options)
+            report_results(succeeded, failed)
+        if sync_failed:
+            sys.exit(1)
+    finally:
+        report_throttle()
         end = int(time.time() * 1000)
         app_logger.info(f'总耗时: {end - start} ms')
 
 
+# 子命令，不带子命令时为下载命令
+commands = {
+    'serve': serve_app,
+    'sync': sync_app,
+}
+
+
 if __name__ == '__main__':
     log_init()
-    app()
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv.pop(1)]()
+    else:
+        app()
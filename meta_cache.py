@@ -0,0 +1,140 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from global_param import STATE_DIR
+from log_config import app_logger
+
+CACHE_FILE_NAME = 'bilix_cache.db'
+
+# 各类缓存条目的有效期（秒）
+# page 中包含有时效的音视频流地址，只做短期缓存；标题、选集、番剧列表等元数据变化很少
+CACHE_TTL = {
+    'page': 30 * 60,
+    'archive': 24 * 3600,
+    'season_id': 30 * 24 * 3600,
+    'section': 6 * 3600,
+    'season': 6 * 3600,
+    'cdn_host': 7 * 24 * 3600,
+    # WBI 签名用的密钥每天更换
+    'wbi_keys': 6 * 3600,
+}
+
+
+class MetaCache:
+    """
+    基于 SQLite 的元数据缓存
+
+    每个条目由 (kind, key) 标识，kind 决定有效期（见 CACHE_TTL），
+    总大小超过 max_bytes 时按最近访问时间淘汰（LRU）。
+    数据库在第一次读写时才会创建。
+    """
+
+    def __init__(self, path: Union[str, Path] = STATE_DIR / CACHE_FILE_NAME, max_bytes: int = 64 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (kind, key))'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_accessed_at ON cache (accessed_at)')
+            self.conn.commit()
+        return self.conn
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self.lock:
+                conn = self._connect()
+                row = conn.execute(
+                    'SELECT value, created_at FROM cache WHERE kind = ? AND key = ?', (kind, key)
+                ).fetchone()
+                if row is None:
+                    return None
+                if now - row[1] > CACHE_TTL.get(kind, 0):
+                    conn.execute('DELETE FROM cache WHERE kind = ? AND key = ?', (kind, key))
+                    conn.commit()
+                    return None
+                conn.execute('UPDATE cache SET accessed_at = ? WHERE kind = ? AND key = ?', (now, kind, key))
+                conn.commit()
+            app_logger.debug(f'命中缓存: {kind} {key}')
+            return json.loads(row[0])
+        except (sqlite3.Error, json.JSONDecodeError):
+            app_logger.warning(f'读取缓存失败: {kind} {key}', exc_info=True)
+            return None
+
+    def set(self, kind: str, key: str, value: Any):
+        if not self.enabled or value is None:
+            return
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        try:
+            with self.lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache (kind, key, value, size, created_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (kind, key, data, len(data), now, now)
+                )
+                self._evict(conn)
+                conn.commit()
+        except sqlite3.Error:
+            app_logger.warning(f'写入缓存失败: {kind} {key}', exc_info=True)
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute('SELECT kind, key, size FROM cache ORDER BY accessed_at').fetchall()
+        for kind, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM cache WHERE kind = ? AND key = ?', (kind, key))
+            total -= size
+
+    def get_or_load(self, kind: str, key: str, loader: Callable[[], Any]) -> Any:
+        """
+        优先读取缓存，未命中时调用 loader 获取并写入缓存
+        """
+        value = self.get(kind, key)
+        if value is None:
+            value = loader()
+            self.set(kind, key, value)
+        return value
+
+    async def get_or_load_async(self, kind: str, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        get_or_load 的协程版本，loader 返回一个可等待对象
+        """
+        value = self.get(kind, key)
+        if value is None:
+            value = await loader()
+            self.set(kind, key, value)
+        return value
+
+
+def page_cache_key(url: str, headers: dict) -> str:
+    """
+    页面内容与登录状态相关（可选清晰度不同），缓存 key 中带上 cookie 的摘要
+    """
+    cookie = headers.get('Cookie') or headers.get('cookie') or ''
+    return f'{url}|{hashlib.sha1(cookie.encode("utf-8")).hexdigest()[:12]}'
+
+
+meta_cache = MetaCache()
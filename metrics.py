@@ -0,0 +1,296 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from global_param import METRICS_FORMATS
+from log_config import app_logger
+
+# 各阶段名称：页面/接口请求、JSON 提取、选择音视频流、传输、合并、移动到保存目录、清理中间文件，以及重试前的等待
+PHASES = ('page_fetch', 'extract', 'select', 'transfer', 'merge', 'publish', 'cleanup', 'retry_wait')
+
+# 计算峰值吞吐量的统计窗口（秒）
+PEAK_WINDOW = 1.0
+
+
+class StreamMeter:
+    """
+    统计单个音视频流的传输字节数、耗时、平均/峰值吞吐量以及使用过的 CDN 节点
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        # 流的总大小，收到响应或探测到大小后才知道
+        self.total: Optional[int] = None
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.peak = 0.0
+        self.window_start = 0.0
+        self.window_bytes = 0
+        self.hosts: list[str] = []
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            if self.start is None:
+                self.start = self.window_start = self.end = time.monotonic()
+
+    def add(self, size: int):
+        self.begin()
+        with self.lock:
+            now = time.monotonic()
+            self.bytes += size
+            self.window_bytes += size
+            self.end = now
+            if now - self.window_start >= PEAK_WINDOW:
+                self.peak = max(self.peak, self.window_bytes / (now - self.window_start))
+                self.window_start, self.window_bytes = now, 0
+
+    def use_host(self, host: str):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts.append(host)
+
+    def to_dict(self) -> dict:
+        seconds = self.end - self.start if self.start is not None else 0.0
+        average = self.bytes / seconds if seconds > 0 else 0.0
+        return {
+            'bytes': self.bytes,
+            'total': self.total,
+            'seconds': round(seconds, 3),
+            'avg_bps': round(average),
+            # 传输时间不足一个统计窗口时，峰值取平均值
+            'peak_bps': round(max(self.peak, average)),
+            'hosts': list(self.hosts),
+        }
+
+
+class TaskMetrics:
+    """
+    单个下载任务的指标：各阶段耗时（秒）、音视频流传输统计、重试次数和最终状态
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.title: Optional[str] = None
+        self.bvid: Optional[str] = None
+        self.status = 'pending'
+        self.error: Optional[str] = None
+        self.phases: dict[str, float] = defaultdict(float)
+        self.streams: dict[str, StreamMeter] = {}
+        self.retries: dict[str, int] = defaultdict(int)
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def add_retry(self, kind: str):
+        with self.lock:
+            self.retries[kind] += 1
+
+    def stream(self, kind: str) -> StreamMeter:
+        with self.lock:
+            if kind not in self.streams:
+                self.streams[kind] = StreamMeter()
+            return self.streams[kind]
+
+    def finish(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            'url': self.url,
+            'title': self.title,
+            'bvid': self.bvid,
+            'status': self.status,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'phases': {name: round(self.phases[name], 3) for name in PHASES if name in self.phases},
+            'streams': {kind: meter.to_dict() for kind, meter in self.streams.items()},
+            'retries': dict(self.retries),
+        }
+
+
+_current_metrics: contextvars.ContextVar[Optional[TaskMetrics]] = contextvars.ContextVar('metrics', default=None)
+_current_meter: contextvars.ContextVar[Optional[StreamMeter]] = contextvars.ContextVar('stream_meter', default=None)
+# 当前所在阶段，值为一个列表，记录其中嵌套的子阶段已经占用的时间
+_current_phase: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar('phase', default=None)
+
+
+@contextmanager
+def use_metrics(metrics: Optional[TaskMetrics]):
+    """
+    在该上下文中记录的阶段耗时、传输字节数和重试次数都计入 metrics
+    """
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+def current_metrics() -> Optional[TaskMetrics]:
+    return _current_metrics.get()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    记录一个阶段的耗时
+
+    阶段可以嵌套（例如页面请求中包含 JSON 提取），嵌套的子阶段耗时会从外层扣除，
+    各阶段的耗时相加即为任务的总耗时。
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    parent = _current_phase.get()
+    frame = [0.0]
+    token = _current_phase.set(frame)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        _current_phase.reset(token)
+        metrics.add_phase(name, elapsed - frame[0])
+        if parent is not None:
+            parent[0] += elapsed
+
+
+@contextmanager
+def meter_stream(kind: str):
+    """
+    该上下文中通过 record_bytes 记录的字节都计入 kind（video / audio）流
+    """
+    metrics = _current_metrics.get()
+    meter = metrics.stream(kind) if metrics else None
+    if meter:
+        meter.begin()
+    token = _current_meter.set(meter)
+    try:
+        yield
+    finally:
+        _current_meter.reset(token)
+
+
+def record_bytes(size: int):
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.add(size)
+
+
+def record_total(size: int):
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.total = size
+
+
+def record_host(host: str):
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.use_host(host)
+
+
+def record_retry(kind: str):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_retry(kind)
+
+
+def run_metered(kind: str, fn, *args, **kwargs):
+    """
+    调用 fn，其中传输的字节计入 kind 流，用于提交到线程池
+    """
+    with meter_stream(kind):
+        return fn(*args, **kwargs)
+
+
+async def run_metered_async(kind: str, fn, *args, **kwargs):
+    """
+    run_metered 的协程版本，需要在独立的 asyncio Task 中运行（例如交给 asyncio.gather），
+    各个流的统计才不会互相覆盖
+    """
+    with meter_stream(kind):
+        return await fn(*args, **kwargs)
+
+
+def write_json_lines(path: Path, metrics_list: list[TaskMetrics]):
+    """
+    每个任务一行 JSON，追加写入，便于多次运行的结果汇总分析
+    """
+    with open(path, 'a', encoding='utf-8') as f:
+        for metrics in metrics_list:
+            f.write(json.dumps(metrics.to_dict(), ensure_ascii=False) + '\n')
+
+
+def prometheus_text(metrics_list: list[TaskMetrics]) -> str:
+    """
+    把本次运行的指标汇总为 Prometheus 文本格式，可交给 node_exporter 的 textfile collector 采集
+    """
+    tasks = defaultdict(int)
+    phases = defaultdict(float)
+    stream_bytes = defaultdict(int)
+    stream_seconds = defaultdict(float)
+    peak = defaultdict(float)
+    host_bytes = defaultdict(int)
+    retries = defaultdict(int)
+    for metrics in metrics_list:
+        tasks[metrics.status] += 1
+        for name, seconds in metrics.phases.items():
+            phases[name] += seconds
+        for kind, meter in metrics.streams.items():
+            data = meter.to_dict()
+            stream_bytes[kind] += data['bytes']
+            stream_seconds[kind] += data['seconds']
+            peak[kind] = max(peak[kind], data['peak_bps'])
+            # 切换过镜像的流，字节数计入最后使用的节点
+            if data['hosts']:
+                host_bytes[data['hosts'][-1]] += data['bytes']
+        for kind, count in metrics.retries.items():
+            retries[kind] += count
+
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: dict, label: Optional[str] = None):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(samples.items()):
+            labels = f'{{{label}="{key}"}}' if label else ''
+            lines.append(f'{name}{labels} {value:g}' if isinstance(value, float) else f'{name}{labels} {value}')
+
+    metric('bilix_tasks_total', 'counter', 'Number of download tasks by status.', tasks, 'status')
+    metric('bilix_phase_seconds_total', 'counter', 'Time spent in each phase.', phases, 'phase')
+    metric('bilix_stream_bytes_total', 'counter', 'Bytes transferred per stream kind.', stream_bytes, 'stream')
+    metric('bilix_stream_seconds_total', 'counter', 'Transfer time per stream kind.', stream_seconds, 'stream')
+    metric('bilix_stream_peak_bytes_per_second', 'gauge', 'Peak throughput per stream kind.', peak, 'stream')
+    metric('bilix_cdn_bytes_total', 'counter', 'Bytes transferred per CDN host.', host_bytes, 'host')
+    metric('bilix_retries_total', 'counter', 'Retried requests by error class.', retries, 'kind')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: str, fmt: str, metrics_list: list[TaskMetrics]):
+    """
+    写出指标文件，fmt 为 json（JSON Lines，追加）或 prometheus（文本格式，覆盖）
+    """
+    path = Path(path)
+    if fmt == 'prometheus':
+        # 先写临时文件再替换，避免采集到写了一半的文件
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(prometheus_text(metrics_list), encoding='utf-8')
+        os.replace(tmp_path, path)
+    else:
+        write_json_lines(path, metrics_list)
+    app_logger.info(f'指标已写入: {path}')
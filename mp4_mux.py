@@ -0,0 +1,345 @@
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+from log_config import app_logger
+
+# 需要递归解析子 box 的容器
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'moof', b'traf', b'edts', b'dinf'}
+
+VIDEO_TRACK_ID = 1
+AUDIO_TRACK_ID = 2
+
+
+class MuxError(Exception):
+    pass
+
+
+class Box:
+    def __init__(self, box_type: bytes, offset: int, size: int, header_size: int):
+        self.type = box_type
+        self.offset = offset
+        self.size = size
+        self.header_size = header_size
+
+    @property
+    def payload_offset(self) -> int:
+        return self.offset + self.header_size
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+
+def iter_boxes(data, start: int = 0, end: Optional[int] = None) -> Iterator[Box]:
+    """
+    遍历 data[start:end] 中同一层级的 box，data 可以是 bytes 或 mmap
+    """
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise MuxError(f'box {box_type!r} 大小异常, offset: {pos}')
+        yield Box(box_type, pos, size, header_size)
+        pos += size
+
+
+def find_box(data, parent: Box, box_type: bytes) -> Optional[Box]:
+    return next((b for b in iter_boxes(data, parent.payload_offset, parent.end) if b.type == box_type), None)
+
+
+def make_box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def rebuild(data, box: Box, patch) -> bytes:
+    """
+    复制一个 box，容器会递归处理子 box；patch(box, payload) 可以返回修改后的 payload
+    """
+    if box.type in CONTAINER_BOXES:
+        payload = b''.join(rebuild(data, child, patch) for child in iter_boxes(data, box.payload_offset, box.end))
+    else:
+        payload = bytes(data[box.payload_offset:box.end])
+    payload = patch(box, payload)
+    return make_box(box.type, payload) if payload is not None else b''
+
+
+def set_track_id(box: Box, payload: bytes, track_id: int) -> bytes:
+    """
+    修改 tkhd / trex / tfhd 中的 track_ID
+    """
+    if box.type == b'tkhd':
+        offset = 4 + (16 if payload[0] == 1 else 8)
+    elif box.type in (b'trex', b'tfhd'):
+        offset = 4
+    else:
+        return payload
+    return payload[:offset] + struct.pack('>I', track_id) + payload[offset + 4:]
+
+
+class TrackFile:
+    """
+    一个 DASH m4s 文件：记录 moov 位置以及每个 moof+mdat 分片的位置和起始时间
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file: BinaryIO = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ftyp: Optional[Box] = None
+        self.moov: Optional[Box] = None
+        self.fragments: list[tuple[Box, Box, float]] = []
+        self.track_id = 0
+        self.timescale = 1
+        self.duration = 0
+        self.default_sample_duration = 0
+        self.parse()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def parse(self):
+        pending_moof = None
+        for box in iter_boxes(self.data):
+            if box.type == b'ftyp':
+                self.ftyp = box
+            elif box.type == b'moov':
+                self.moov = box
+                self.parse_moov()
+            elif box.type == b'moof':
+                pending_moof = box
+            elif box.type == b'mdat' and pending_moof:
+                start = self.parse_moof(pending_moof)
+                self.fragments.append((pending_moof, box, start / self.timescale))
+                pending_moof = None
+        if not self.moov or not self.fragments:
+            raise MuxError(f'{self.path} 不是 fragmented MP4')
+
+    def parse_moov(self):
+        traks = [b for b in iter_boxes(self.data, self.moov.payload_offset, self.moov.end) if b.type == b'trak']
+        if len(traks) != 1:
+            raise MuxError(f'{self.path} 包含 {len(traks)} 个轨道, 只支持单轨道文件')
+        tkhd = find_box(self.data, traks[0], b'tkhd')
+        version = self.data[tkhd.payload_offset]
+        self.track_id = struct.unpack_from('>I', self.data, tkhd.payload_offset + 4 + (16 if version == 1 else 8))[0]
+
+        mdhd = find_box(self.data, find_box(self.data, traks[0], b'mdia'), b'mdhd')
+        version = self.data[mdhd.payload_offset]
+        self.timescale = struct.unpack_from('>I', self.data, mdhd.payload_offset + 4 + (16 if version == 1 else 8))[0]
+
+        mvex = find_box(self.data, self.moov, b'mvex')
+        trex = find_box(self.data, mvex, b'trex') if mvex else None
+        if trex:
+            self.default_sample_duration = struct.unpack_from('>I', self.data, trex.payload_offset + 12)[0]
+
+    def parse_moof(self, moof: Box) -> int:
+        """
+        解析分片的起始解码时间，并累加分片内所有采样的时长，返回起始时间（媒体时间单位）
+        """
+        start = self.duration
+        for traf in iter_boxes(self.data, moof.payload_offset, moof.end):
+            if traf.type != b'traf':
+                continue
+            default_duration = self.default_sample_duration
+            for box in iter_boxes(self.data, traf.payload_offset, traf.end):
+                p = box.payload_offset
+                flags = struct.unpack_from('>I', self.data, p)[0] & 0xFFFFFF
+                if box.type == b'tfhd':
+                    if flags & 0x01:
+                        # 绝对文件偏移在合并后会失效
+                        raise MuxError(f'{self.path} 使用了 base_data_offset, 不支持')
+                    pos = p + 8 + (4 if flags & 0x02 else 0)
+                    if flags & 0x08:
+                        default_duration = struct.unpack_from('>I', self.data, pos)[0]
+                elif box.type == b'tfdt':
+                    version = self.data[p]
+                    start = struct.unpack_from('>Q' if version == 1 else '>I', self.data, p + 4)[0]
+                    self.duration = start
+                elif box.type == b'trun':
+                    count = struct.unpack_from('>I', self.data, p + 4)[0]
+                    pos = p + 8 + (4 if flags & 0x01 else 0) + (4 if flags & 0x04 else 0)
+                    if not flags & 0x100:
+                        self.duration += count * default_duration
+                        continue
+                    sample_size = 4 * bin(flags & 0xF00).count('1')
+                    for i in range(count):
+                        self.duration += struct.unpack_from('>I', self.data, pos + i * sample_size)[0]
+        return start
+
+
+def copy_range(src: BinaryIO, dst: BinaryIO, offset: int, length: int):
+    """
+    把 src 中 [offset, offset + length) 的数据追加到 dst，优先使用 sendfile 零拷贝
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    if hasattr(os, 'sendfile'):
+        try:
+            while length > 0:
+                sent = os.sendfile(dst_fd, src_fd, offset, length)
+                if sent == 0:
+                    raise MuxError('sendfile 提前结束')
+                offset += sent
+                length -= sent
+            return
+        except OSError:
+            # 部分平台 / 文件系统不支持文件到文件的 sendfile，回退到普通拷贝
+            pass
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(length, 8 * 1024 * 1024))
+        if not chunk:
+            raise MuxError('源文件提前结束')
+        os.write(dst_fd, chunk)
+        length -= len(chunk)
+
+
+def mvhd_timescale(data, moov: Box) -> int:
+    mvhd = find_box(data, moov, b'mvhd')
+    version = data[mvhd.payload_offset]
+    return struct.unpack_from('>I', data, mvhd.payload_offset + 4 + (16 if version == 1 else 8))[0]
+
+
+def rescale_edit_list(payload: bytes, src_timescale: int, dst_timescale: int) -> bytes:
+    """
+    elst 的 segment_duration 以所在文件 mvhd 的时间单位计，搬到另一个文件时需要换算到新的 mvhd 时间单位；
+    media_time 以轨道自身（mdhd）的时间单位计，保持不变
+    """
+    if src_timescale == dst_timescale:
+        return payload
+    version = payload[0]
+    count = struct.unpack_from('>I', payload, 4)[0]
+    entry_size, fmt, limit = (20, '>Q', 0xFFFFFFFFFFFFFFFF) if version == 1 else (12, '>I', 0xFFFFFFFF)
+    out = bytearray(payload)
+    for i in range(count):
+        pos = 8 + i * entry_size
+        duration = struct.unpack_from(fmt, payload, pos)[0]
+        struct.pack_into(fmt, out, pos, min(duration * dst_timescale // src_timescale, limit))
+    return bytes(out)
+
+
+def build_moov(video: TrackFile, audio: TrackFile) -> bytes:
+    """
+    以视频的 moov 为基础，加入改写 track_ID 之后的音频 trak 和 trex，并写入总时长
+    """
+    movie_timescale = mvhd_timescale(video.data, video.moov)
+    audio_movie_timescale = mvhd_timescale(audio.data, audio.moov)
+    durations = {
+        VIDEO_TRACK_ID: video.duration * movie_timescale // video.timescale,
+        AUDIO_TRACK_ID: audio.duration * movie_timescale // audio.timescale,
+    }
+    movie_duration = max(durations.values())
+
+    def patch_duration(payload: bytes, offset_v0: int, offset_v1: int, value: int) -> bytes:
+        if payload[0] == 1:
+            return payload[:offset_v1] + struct.pack('>Q', value) + payload[offset_v1 + 8:]
+        return payload[:offset_v0] + struct.pack('>I', min(value, 0xFFFFFFFF)) + payload[offset_v0 + 4:]
+
+    def audio_patch(box: Box, payload: bytes) -> bytes:
+        payload = set_track_id(box, payload, AUDIO_TRACK_ID)
+        if box.type == b'tkhd':
+            payload = patch_duration(payload, 20, 28, durations[AUDIO_TRACK_ID])
+        elif box.type == b'elst':
+            payload = rescale_edit_list(payload, audio_movie_timescale, movie_timescale)
+        return payload
+
+    def video_patch(box: Box, payload: bytes) -> Optional[bytes]:
+        payload = set_track_id(box, payload, VIDEO_TRACK_ID)
+        if box.type == b'tkhd':
+            payload = patch_duration(payload, 20, 28, durations[VIDEO_TRACK_ID])
+        elif box.type == b'mvhd':
+            payload = patch_duration(payload, 16, 24, movie_duration)
+            # next_track_ID 位于 mvhd 末尾
+            payload = payload[:-4] + struct.pack('>I', AUDIO_TRACK_ID + 1)
+        elif box.type == b'mehd':
+            return None
+        return payload
+
+    audio_trak = next(b for b in iter_boxes(audio.data, audio.moov.payload_offset, audio.moov.end) if b.type == b'trak')
+    audio_mvex = find_box(audio.data, audio.moov, b'mvex')
+    audio_trex = find_box(audio.data, audio_mvex, b'trex') if audio_mvex else None
+
+    children = []
+    for box in iter_boxes(video.data, video.moov.payload_offset, video.moov.end):
+        if box.type == b'mvex':
+            mehd = make_box(b'mehd', struct.pack('>IQ', 1 << 24, movie_duration))
+            trexs = [rebuild(video.data, b, video_patch) for b in iter_boxes(video.data, box.payload_offset, box.end)]
+            if audio_trex:
+                trexs.append(rebuild(audio.data, audio_trex, audio_patch))
+            children.append(make_box(b'mvex', mehd + b''.join(trexs)))
+        elif box.type == b'trak':
+            children.append(rebuild(video.data, box, video_patch))
+            children.append(rebuild(audio.data, audio_trak, audio_patch))
+        else:
+            children.append(rebuild(video.data, box, video_patch))
+    return make_box(b'moov', b''.join(children))
+
+
+def merge_m4s_native(video_file, audio_file, output_file) -> bool:
+    """
+    不依赖 ffmpeg，直接在 box 层面合并视频和音频 m4s 文件
+
+    B 站的 DASH 音视频流都是 fragmented MP4（ftyp, moov, sidx, moof/mdat...），
+    moof 里 trun 的 data_offset 都是相对 moof 起始位置的，因此只要成对地搬运 moof+mdat，
+    并改写其中的 track_ID 和序号，就可以在不重写采样表的情况下得到一个包含两个轨道的 fMP4 文件，
+    效果等同于 `ffmpeg -c copy`。mdat 的数据通过 sendfile 直接在内核中拷贝。
+
+    Returns:
+        bool: True 如果合并成功，False 如果失败。
+    """
+    if not Path(video_file).exists():
+        app_logger.error("无法找到 video m4s 文件")
+        return False
+    if not Path(audio_file).exists():
+        app_logger.error("无法找到 audio m4s 文件")
+        return False
+
+    video = audio = None
+    try:
+        video = TrackFile(str(video_file))
+        audio = TrackFile(str(audio_file))
+
+        # 按起始时间交错排列音视频分片，播放器可以顺序读取
+        fragments = [(start, 0, i, video) for i, (_, _, start) in enumerate(video.fragments)]
+        fragments += [(start, 1, i, audio) for i, (_, _, start) in enumerate(audio.fragments)]
+        fragments.sort(key=lambda f: (f[0], f[1], f[2]))
+
+        # 不使用缓冲，保证普通写入和 sendfile 写入的顺序一致
+        with open(output_file, 'wb', buffering=0) as out:
+            out.write(bytes(video.data[video.ftyp.offset:video.ftyp.end]) if video.ftyp else b'')
+            out.write(build_moov(video, audio))
+
+            for sequence, (_, _, index, track) in enumerate(fragments, start=1):
+                moof, mdat, _ = track.fragments[index]
+                track_id = AUDIO_TRACK_ID if track is audio else VIDEO_TRACK_ID
+
+                def moof_patch(box: Box, payload: bytes) -> bytes:
+                    if box.type == b'mfhd':
+                        return payload[:4] + struct.pack('>I', sequence)
+                    return set_track_id(box, payload, track_id)
+
+                new_moof = rebuild(track.data, moof, moof_patch)
+                if len(new_moof) != moof.size:
+                    raise MuxError('moof 大小发生变化')
+                out.write(new_moof)
+                copy_range(track.file, out, mdat.offset, mdat.size)
+
+        app_logger.info(f"成功合并到: {output_file}")
+        return True
+    except (MuxError, struct.error, OSError, ValueError):
+        app_logger.exception("合并失败")
+        Path(output_file).unlink(missing_ok=True)
+        return False
+    finally:
+        for track in (video, audio):
+            if track:
+                track.close()
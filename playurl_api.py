@@ -0,0 +1,266 @@
+import re
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+
+from log_config import app_logger
+from meta_cache import meta_cache
+from metrics import phase
+from rate_limit import request_limiter
+from retry import API_TIMEOUT, retryable
+from session_pool import borrow_session
+from tool import sanitize_filename
+
+ARCHIVE_URL = 'https://api.bilibili.com/x/web-interface/wbi/view'
+SEASON_URL = 'https://api.bilibili.com/pgc/view/web/season'
+UGC_PLAYURL_URL = 'https://api.bilibili.com/x/player/playurl'
+PGC_PLAYURL_URL = 'https://api.bilibili.com/pgc/player/web/playurl'
+
+# 16(DASH) | 64(HDR) | 128(4K) | 256(杜比音频) | 512(杜比视界) | 1024(8K) | 2048(AV1)
+DASH_FNVAL = 4048
+# 不指定清晰度时请求最高清晰度，实际返回的流受账号权限限制
+MAX_QN = 127
+
+
+def check_api_response(url: str, resp) -> dict:
+    resp.raise_for_status()
+    resp_json = resp.json()
+    if resp_json.get('code') != 0:
+        raise ValueError(f'接口返回错误: {url}, code: {resp_json.get("code")}, message: {resp_json.get("message")}')
+    return resp_json
+
+
+@retryable
+def api_get(url: str, headers: dict, params: dict) -> dict:
+    """
+    请求 Bilibili 的 JSON 接口，接口返回的 code 不为 0 时抛出 ValueError
+    """
+    request_limiter.acquire()
+    with phase('page_fetch'):
+        with borrow_session(url) as session:
+            resp = session.get(url, headers=headers, params=params, timeout=API_TIMEOUT)
+        return check_api_response(url, resp)
+
+
+@retryable
+async def api_get_async(session, url: str, headers: dict, params: dict) -> dict:
+    """
+    api_get 的协程版本，session 为 AsyncSession
+    """
+    await request_limiter.acquire_async()
+    with phase('page_fetch'):
+        resp = await session.get(url, headers=headers, params=params, timeout=API_TIMEOUT)
+        return check_api_response(url, resp)
+
+
+def season_query(ep_id: Optional[str] = None, season_id: Optional[str] = None) -> tuple[str, dict]:
+    """
+    返回剧集信息的缓存 key 和请求参数
+    """
+    if ep_id:
+        return f'ep{ep_id}', {'ep_id': ep_id}
+    return f'ss{season_id}', {'season_id': season_id}
+
+
+@retryable
+def get_bangumi_season_id(md_id: str):
+    url1 = f'https://api.bilibili.com/pgc/review/user?media_id={md_id}'
+    request_limiter.acquire()
+    with borrow_session(url1) as session:
+        resp1 = session.get(url1, timeout=API_TIMEOUT)
+    resp1.raise_for_status()
+    return resp1.json()['result']['media']['season_id']
+
+
+@retryable
+def get_season_episodes(season_id):
+    url2 = f'https://api.bilibili.com/pgc/web/season/section?season_id={season_id}'
+    request_limiter.acquire()
+    with borrow_session(url2) as session:
+        resp2 = session.get(url2, timeout=API_TIMEOUT)
+    resp2.raise_for_status()
+    return resp2.json()['result']['main_section']['episodes']
+
+
+def get_bangumi_episode(md_id: str):
+    md_id = md_id.replace("md", "")
+    season_id = meta_cache.get_or_load('season_id', md_id, lambda: get_bangumi_season_id(md_id))
+    episodes = meta_cache.get_or_load('section', str(season_id), lambda: get_season_episodes(season_id))
+    return episodes
+
+
+def get_archive(bvid: str, headers: dict) -> dict:
+    """
+    获取稿件信息（标题、分P、UP 主等），结果会被缓存
+    """
+    return meta_cache.get_or_load(
+        'archive', bvid, lambda: api_get(ARCHIVE_URL, headers, {'bvid': bvid})['data']
+    )
+
+
+async def get_archive_async(session, bvid: str, headers: dict) -> dict:
+    async def load():
+        return (await api_get_async(session, ARCHIVE_URL, headers, {'bvid': bvid}))['data']
+    return await meta_cache.get_or_load_async('archive', bvid, load)
+
+
+def get_season(headers: dict, ep_id: Optional[str] = None, season_id: Optional[str] = None) -> dict:
+    """
+    通过 ep_id 或 season_id 获取剧集信息，结果会被缓存
+    """
+    key, params = season_query(ep_id, season_id)
+    return meta_cache.get_or_load('season', key, lambda: api_get(SEASON_URL, headers, params)['result'])
+
+
+async def get_season_async(session, headers: dict, ep_id: Optional[str] = None,
+                           season_id: Optional[str] = None) -> dict:
+    key, params = season_query(ep_id, season_id)
+
+    async def load():
+        return (await api_get_async(session, SEASON_URL, headers, params))['result']
+    return await meta_cache.get_or_load_async('season', key, load)
+
+
+def playurl_params(quality: Optional[int], **ids) -> dict:
+    return {**ids, 'qn': quality or MAX_QN, 'fnval': DASH_FNVAL, 'fnver': 0, 'fourk': 1}
+
+
+class PageNotFoundError(ValueError):
+    """
+    稿件中没有请求的分P
+    """
+
+
+def ugc_page(archive: dict, page: int) -> tuple[int, str]:
+    """
+    返回稿件中第 page 集的 (cid, 标题)，稿件中没有这一集时抛出 ValueError
+    """
+    pages = archive.get('pages') or []
+    current = next((p for p in pages if p.get('page') == page), None)
+    if current is None and (pages or page != 1):
+        raise PageNotFoundError(f'稿件中没有第 {page} 集, bvid: {archive.get("bvid")}, 共 {len(pages)} 集')
+    cid = current['cid'] if current else archive['cid']
+    title = archive['title']
+    if len(pages) > 1 and current:
+        # 多 P 视频每一集的文件名需要区分开
+        title = f'{title}_p{page}_{current.get("part", "")}'
+    return cid, title
+
+
+def pgc_episode(season: dict, ep_id: Optional[str] = None, season_id: Optional[str] = None) -> tuple[dict, str]:
+    """
+    返回剧集中对应的单集及其标题，没有指定 ep_id 时取第一集
+    """
+    episodes = season.get('episodes') or []
+    if ep_id:
+        episode = next((e for e in episodes if str(e.get('ep_id') or e.get('id')) == str(ep_id)), None)
+    else:
+        episode = episodes[0] if episodes else None
+    if not episode:
+        raise ValueError(f'剧集中没有找到对应的单集, ep_id: {ep_id}, season_id: {season_id}')
+
+    name = episode.get('show_title') or episode.get('long_title') or episode.get('title') or ''
+    title = f'{season.get("season_title") or season.get("title", "")}_{name}'.strip('_')
+    return episode, title
+
+
+def resolve_ugc(bvid: str, page: int, headers: dict, quality: Optional[int]) -> dict:
+    cid, title = ugc_page(get_archive(bvid, headers), page)
+    data = api_get(UGC_PLAYURL_URL, headers, playurl_params(quality, bvid=bvid, cid=cid))['data']
+    return {'title': sanitize_filename(title), 'bvid': bvid, 'cid': cid, 'dash': data.get('dash')}
+
+
+async def resolve_ugc_async(session, bvid: str, page: int, headers: dict, quality: Optional[int]) -> dict:
+    cid, title = ugc_page(await get_archive_async(session, bvid, headers), page)
+    data = (await api_get_async(session, UGC_PLAYURL_URL, headers, playurl_params(quality, bvid=bvid, cid=cid)))['data']
+    return {'title': sanitize_filename(title), 'bvid': bvid, 'cid': cid, 'dash': data.get('dash')}
+
+
+def resolve_pgc(headers: dict, quality: Optional[int], ep_id: Optional[str] = None,
+                season_id: Optional[str] = None) -> dict:
+    episode, title = pgc_episode(get_season(headers, ep_id=ep_id, season_id=season_id), ep_id, season_id)
+    params = playurl_params(quality, ep_id=episode.get('ep_id') or episode.get('id'), cid=episode['cid'])
+    result = api_get(PGC_PLAYURL_URL, headers, params)['result']
+    return {'title': sanitize_filename(title), 'bvid': episode.get('bvid'), 'cid': episode['cid'],
+            'dash': result.get('dash')}
+
+
+async def resolve_pgc_async(session, headers: dict, quality: Optional[int], ep_id: Optional[str] = None,
+                            season_id: Optional[str] = None) -> dict:
+    season = await get_season_async(session, headers, ep_id=ep_id, season_id=season_id)
+    episode, title = pgc_episode(season, ep_id, season_id)
+    params = playurl_params(quality, ep_id=episode.get('ep_id') or episode.get('id'), cid=episode['cid'])
+    result = (await api_get_async(session, PGC_PLAYURL_URL, headers, params))['result']
+    return {'title': sanitize_filename(title), 'bvid': episode.get('bvid'), 'cid': episode['cid'],
+            'dash': result.get('dash')}
+
+
+def playurl_target(url: str) -> Optional[dict]:
+    """
+    识别 URL 对应的接口解析方式，返回 {'kind': 'ugc', 'bvid', 'page'} 或
+    {'kind': 'pgc', 'ep_id', 'season_id'}，不支持的 URL（包括分P 参数不是数字的）返回 None
+    """
+    parsed = urlsplit(url)
+    if match := re.search(r'/video/(BV[0-9A-Za-z]+)', parsed.path):
+        page = parse_qs(parsed.query).get('p', ['1'])[0].strip()
+        if not page.isdigit():
+            return None
+        return {'kind': 'ugc', 'bvid': match.group(1), 'page': int(page)}
+    if match := re.search(r'/bangumi/play/ep(\d+)', parsed.path):
+        return {'kind': 'pgc', 'ep_id': match.group(1), 'season_id': None}
+    if match := re.search(r'/bangumi/play/ss(\d+)', parsed.path):
+        return {'kind': 'pgc', 'ep_id': None, 'season_id': match.group(1)}
+    return None
+
+
+def check_dash(url: str, resolved: dict) -> Optional[dict]:
+    dash = resolved.get('dash')
+    if not dash or not dash.get('video') or not dash.get('audio'):
+        app_logger.warning(f'接口未返回 DASH 音视频流: {url}')
+        return None
+    return resolved
+
+
+def resolve_playurl(url: str, headers: dict, quality: Optional[int] = None) -> Optional[dict]:
+    """
+    直接通过 JSON 接口把视频 URL 解析为 DASH 音视频流，不请求网页
+
+    返回 {'title', 'bvid', 'cid', 'dash'}，不支持的 URL 或者接口解析失败时返回 None，
+    调用方可以回退到网页解析。
+    """
+    target = playurl_target(url)
+    if target is None:
+        return None
+    try:
+        if target['kind'] == 'ugc':
+            resolved = resolve_ugc(target['bvid'], target['page'], headers, quality)
+        else:
+            resolved = resolve_pgc(headers, quality, ep_id=target['ep_id'], season_id=target['season_id'])
+    except PageNotFoundError:
+        # 分P 不存在时网页解析也只会得到第一集，直接报错
+        raise
+    except Exception as e:
+        app_logger.warning(f'接口解析失败: {url}, {e}')
+        return None
+    return check_dash(url, resolved)
+
+
+async def resolve_playurl_async(session, url: str, headers: dict, quality: Optional[int] = None) -> Optional[dict]:
+    """
+    resolve_playurl 的协程版本
+    """
+    target = playurl_target(url)
+    if target is None:
+        return None
+    try:
+        if target['kind'] == 'ugc':
+            resolved = await resolve_ugc_async(session, target['bvid'], target['page'], headers, quality)
+        else:
+            resolved = await resolve_pgc_async(session, headers, quality, ep_id=target['ep_id'],
+                                               season_id=target['season_id'])
+    except PageNotFoundError:
+        # 分P 不存在时网页解析也只会得到第一集，直接报错
+        raise
+    except Exception as e:
+        app_logger.warning(f'接口解析失败: {url}, {e}')
+        return None
+    return check_dash(url, resolved)
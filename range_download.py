@@ -0,0 +1,548 @@
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, Optional, Union
+
+from curl_cffi.requests.exceptions import RequestException
+
+from cdn_mirror import mirror_host, mirror_ranking
+from file_writer import FileWriter, finish_file, preallocate
+from log_config import app_logger
+from metrics import record_bytes, record_host
+from rate_limit import TransferCancelled, byte_limiter
+from retry import API_TIMEOUT, STREAM_TIMEOUT, Retrier, retryable, submit_in_context
+from session_pool import borrow_session, close_async_response
+
+# 每个分段的最小字节数，避免小文件被切得过碎
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+# 断点续传日志的后缀，以及写盘的最小间隔（秒）
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_FLUSH_INTERVAL = 1.0
+
+# 镜像测速的统计窗口（秒），窗口速度低于最快窗口的 SLOW_RATIO 时切换镜像
+SPEED_WINDOW = 3.0
+SLOW_RATIO = 0.25
+
+
+def probe_headers(headers: dict) -> dict:
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    return probe_headers
+
+
+def parse_probe(resp) -> dict:
+    resp.raise_for_status()
+    etag = resp.headers.get('ETag')
+    content_range = resp.headers.get('Content-Range', '')
+    if resp.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        if total.isdigit():
+            return {'size': int(total), 'accept_ranges': True, 'etag': etag}
+    return {'size': int(resp.headers.get('Content-Length', 0)), 'accept_ranges': False, 'etag': etag}
+
+
+@retryable
+def probe_stream(url: str, headers: dict) -> dict:
+    """
+    探测远程文件的大小、ETag 以及是否支持 Range 请求
+
+    返回:
+        {'size': 文件总字节数, 'accept_ranges': 是否支持 Range, 'etag': ETag 或 None}
+    """
+    with borrow_session(url) as session:
+        resp = session.get(url, headers=probe_headers(headers), stream=True, timeout=API_TIMEOUT)
+        try:
+            return parse_probe(resp)
+        finally:
+            resp.close()
+
+
+@retryable
+async def probe_stream_async(session, url: str, headers: dict) -> dict:
+    """
+    probe_stream 的协程版本
+    """
+    resp = await session.get(url, headers=probe_headers(headers), stream=True, timeout=API_TIMEOUT)
+    try:
+        return parse_probe(resp)
+    finally:
+        await close_async_response(resp)
+
+
+def split_ranges(total: int, connections: int, min_size: int = MIN_SEGMENT_SIZE) -> list[tuple[int, int]]:
+    """
+    把 [0, total) 切分为若干个闭区间 (start, end)，数量不超过 connections
+    """
+    count = max(1, min(connections, total // min_size))
+    size = math.ceil(total / count)
+    return [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+
+
+class RangeJournal:
+    """
+    断点续传日志，记录某个文件已经写入完成的字节区间
+
+    日志以 JSON 形式保存在 `{filename}.journal`，同时记录远程文件的大小和 ETag，
+    重启时只有两者都与远程一致才会继续使用已下载的数据。
+    """
+
+    def __init__(self, filename: str, size: int, etag: Optional[str], done: list[list[int]] = None):
+        self.path = Path(filename + JOURNAL_SUFFIX)
+        self.size = size
+        self.etag = etag
+        self.done = done or []
+        self.lock = threading.Lock()
+        self.last_flush = 0.0
+
+    @classmethod
+    def load(cls, filename: str, size: int, etag: Optional[str]) -> Optional['RangeJournal']:
+        """
+        读取已有的日志，如果日志不存在、损坏或者与远程文件不一致，返回 None
+        """
+        path = Path(filename + JOURNAL_SUFFIX)
+        if not path.is_file() or not Path(filename).is_file():
+            return None
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, json.JSONDecodeError):
+            app_logger.warning(f'断点续传日志损坏: {path}')
+            return None
+        if data.get('size') != size or data.get('etag') != etag:
+            app_logger.warning(f'远程文件已变化，放弃断点续传: {filename}')
+            return None
+        if Path(filename).stat().st_size != size:
+            return None
+        return cls(filename, size, etag, data.get('done'))
+
+    def add(self, start: int, end: int):
+        """
+        记录 [start, end] 区间已写入完成，并按时间间隔写盘
+        """
+        with self.lock:
+            merged = []
+            for s, e in sorted(self.done + [[start, end]]):
+                if merged and s <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], e)
+                else:
+                    merged.append([s, e])
+            self.done = merged
+            if time.monotonic() - self.last_flush >= JOURNAL_FLUSH_INTERVAL:
+                self._flush()
+
+    def completed(self) -> int:
+        return sum(e - s + 1 for s, e in self.done)
+
+    def missing(self) -> list[tuple[int, int]]:
+        """
+        返回尚未完成的区间
+        """
+        gaps = []
+        pos = 0
+        for s, e in self.done:
+            if s > pos:
+                gaps.append((pos, s - 1))
+            pos = max(pos, e + 1)
+        if pos < self.size:
+            gaps.append((pos, self.size - 1))
+        return gaps
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        tmp_path.write_text(json.dumps({'size': self.size, 'etag': self.etag, 'done': self.done}), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+        self.last_flush = time.monotonic()
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+class SlowMirrorError(Exception):
+    """
+    当前镜像的吞吐量明显下降，需要切换到下一个镜像
+    """
+
+
+class IncompleteRangeError(RequestException):
+    """
+    连接正常关闭，但收到的数据比请求的区间短（或长），按读取错误重试，从已写入的位置继续
+    """
+
+
+class SpeedWatch:
+    """
+    按 SPEED_WINDOW 统计单个连接的速度，最近一个窗口的速度低于最快窗口的 SLOW_RATIO 时抛出 SlowMirrorError
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.best_rate = 0.0
+
+    def add(self, size: int):
+        self.window_bytes += size
+        now = time.monotonic()
+        if now - self.window_start < SPEED_WINDOW:
+            return
+        rate = self.window_bytes / (now - self.window_start)
+        self.best_rate = max(self.best_rate, rate)
+        # 开启限速时变慢是预期行为，不作为切换依据
+        if self.enabled and rate < self.best_rate * SLOW_RATIO and not byte_limiter.rate:
+            raise SlowMirrorError(f'速度从 {self.best_rate / 1024:.0f} KiB/s 降到 {rate / 1024:.0f} KiB/s')
+        self.window_start, self.window_bytes = now, 0
+
+
+def range_headers(headers: dict, start: int, end: int) -> dict:
+    range_headers = dict(headers)
+    range_headers['Range'] = f'bytes={start}-{end}'
+    return range_headers
+
+
+def check_range_response(resp):
+    resp.raise_for_status()
+    if resp.status_code != 206:
+        raise ValueError(f'服务器未按 Range 返回数据, status: {resp.status_code}')
+
+
+def check_range_end(pos: int, end: int):
+    if pos != end + 1:
+        raise IncompleteRangeError(f'区间数据不完整，期望写到 {end + 1}，实际写到 {pos}')
+
+
+def record_range_speed(url: str, size: int, begin: float):
+    elapsed = time.monotonic() - begin
+    if size >= MIN_SEGMENT_SIZE and elapsed > 0:
+        mirror_ranking.record(mirror_host(url), throughput=size / elapsed)
+
+
+def fetch_range(url: str, headers: dict, filename: str, start: int, end: int, progress, task,
+                journal: Optional[RangeJournal], state: dict, check_speed: bool):
+    """
+    从单个地址下载 [start, end] 区间，state['pos'] 记录已写入到的位置
+
+    check_speed 为 True 时，若最近一个统计窗口的速度低于该连接最快窗口的 SLOW_RATIO，
+    抛出 SlowMirrorError，由调用方切换镜像后从 state['pos'] 继续。
+    """
+    record_host(mirror_host(url))
+    with borrow_session(url) as session:
+        resp = session.get(url, headers=range_headers(headers, start, end), stream=True, timeout=STREAM_TIMEOUT)
+        try:
+            check_range_response(resp)
+            begin = time.monotonic()
+            watch = SpeedWatch(check_speed)
+            # 写入器的缓冲区写入文件后才记日志，保证日志里的区间一定已经写入
+            with FileWriter(filename, start, on_flush=journal.add if journal else None) as writer:
+                pos = start
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    writer.write(chunk)
+                    pos += len(chunk)
+                    state['pos'] = pos
+                    progress.update(task, advance=len(chunk))
+                    byte_limiter.acquire(len(chunk))
+                    record_bytes(len(chunk))
+                    watch.add(len(chunk))
+            check_range_end(pos, end)
+            record_range_speed(url, pos - start, begin)
+        finally:
+            resp.close()
+
+
+async def fetch_range_async(session, url: str, headers: dict, filename: str, start: int, end: int, progress, task,
+                            journal: Optional[RangeJournal], state: dict, check_speed: bool):
+    """
+    fetch_range 的协程版本
+
+    写文件仍在事件循环中同步进行，写入器攒满缓冲区才写一次，数据进入页缓存，通常不会阻塞
+    """
+    record_host(mirror_host(url))
+    resp = await session.get(url, headers=range_headers(headers, start, end), stream=True, timeout=STREAM_TIMEOUT)
+    try:
+        check_range_response(resp)
+        begin = time.monotonic()
+        watch = SpeedWatch(check_speed)
+        with FileWriter(filename, start, on_flush=journal.add if journal else None) as writer:
+            pos = start
+            async for chunk in resp.aiter_content():
+                writer.write(chunk)
+                pos += len(chunk)
+                state['pos'] = pos
+                progress.update(task, advance=len(chunk))
+                await byte_limiter.acquire_async(len(chunk))
+                record_bytes(len(chunk))
+                watch.add(len(chunk))
+        check_range_end(pos, end)
+        record_range_speed(url, pos - start, begin)
+    finally:
+        await close_async_response(resp)
+
+
+def range_failed(url: str, error: Exception, retrier: Retrier, progressed: bool, untried: bool) -> bool:
+    """
+    处理某个镜像上的一次区间下载失败，返回是否需要按重试策略等待
+
+    取得过进展时清零重试计数；非变慢导致的失败会记入节点的失败次数，
+    还有没试过的镜像时直接切换，否则需要等待（不可重试的错误由等待时抛出）。
+    """
+    if isinstance(error, TransferCancelled):
+        raise error
+    if progressed:
+        retrier.reset()
+    if isinstance(error, SlowMirrorError):
+        return False
+    mirror_ranking.record(mirror_host(url), failed=True)
+    return not untried
+
+
+def log_switch(urls: list[str], index: int, url: str, error: Exception, state: dict):
+    if len(urls) > 1:
+        app_logger.warning(f'镜像 {mirror_host(url)} 异常({error})，切换到 {mirror_host(urls[index % len(urls)])}，'
+                           f'从 {state["pos"]} 字节继续')
+
+
+def download_range(urls: Union[str, list[str]], headers: dict, filename: str, start: int, end: int, progress, task,
+                   journal: Optional[RangeJournal] = None):
+    """
+    下载 [start, end] 区间的数据，并写入到文件对应的偏移处
+
+    urls 为按优先级排好序的镜像地址，当前镜像出错或明显变慢时，
+    切换到下一个镜像并从已写入的位置继续下载；所有镜像都试过之后，
+    按重试策略退避后继续轮换，直到重试次数用完。
+    """
+    urls = [urls] if isinstance(urls, str) else urls
+    state = {'pos': start}
+    retrier = Retrier(f'{filename} [{start}-{end}]')
+    index = 0
+    while True:
+        url = urls[index % len(urls)]
+        last_pos = state['pos']
+        try:
+            fetch_range(url, headers, filename, state['pos'], end, progress, task, journal, state, len(urls) > 1)
+            return
+        except Exception as e:
+            if range_failed(url, e, retrier, state['pos'] > last_pos, index + 1 < len(urls)):
+                retrier.wait(e)
+            index += 1
+            log_switch(urls, index, url, e, state)
+
+
+async def download_range_async(session, urls: Union[str, list[str]], headers: dict, filename: str, start: int,
+                               end: int, progress, task, journal: Optional[RangeJournal] = None):
+    """
+    download_range 的协程版本
+    """
+    urls = [urls] if isinstance(urls, str) else urls
+    state = {'pos': start}
+    retrier = Retrier(f'{filename} [{start}-{end}]')
+    index = 0
+    while True:
+        url = urls[index % len(urls)]
+        last_pos = state['pos']
+        try:
+            await fetch_range_async(session, url, headers, filename, state['pos'], end, progress, task, journal,
+                                    state, len(urls) > 1)
+            return
+        except Exception as e:
+            if range_failed(url, e, retrier, state['pos'] > last_pos, index + 1 < len(urls)):
+                await retrier.wait_async(e)
+            index += 1
+            log_switch(urls, index, url, e, state)
+
+
+def resume_headers(headers: dict, pos: int) -> dict:
+    request_headers = dict(headers)
+    if pos:
+        request_headers['Range'] = f'bytes={pos}-'
+    return request_headers
+
+
+def check_resume_response(resp, pos: int, total: Optional[int], description: str,
+                          on_start: Callable[[int], None]) -> Optional[int]:
+    """
+    检查顺序下载的响应，返回文件总字节数（未知时为 None）
+
+    第一次请求时调用 on_start；从 pos 继续时要求服务器按 Range 从 pos 开始返回数据。
+    """
+    resp.raise_for_status()
+    if not pos:
+        size = int(resp.headers.get('Content-Length', 0))
+        on_start(size)
+        return size or None
+    if resp.status_code != 206:
+        raise ValueError(f'服务器不支持 Range 请求，无法从断开处继续: {description}')
+    match = re.fullmatch(r'bytes (\d+)-\d+/(\d+|\*)', resp.headers.get('Content-Range', '').strip())
+    if match and int(match.group(1)) != pos:
+        raise ValueError(f'服务器返回的区间起点 {match.group(1)} 与请求的 {pos} 不一致: {description}')
+    return total
+
+
+def check_stream_end(pos: int, total: Optional[int]):
+    if total and pos != total:
+        raise IncompleteRangeError(f'数据不完整，期望 {total} 字节，实际收到 {pos} 字节')
+
+
+def iter_resumable(url: str, headers: dict, description: str, on_start: Callable[[int], None]) -> Iterator[bytes]:
+    """
+    顺序读取整个文件，连接中断时按重试策略用 Range 从已收到的位置继续
+
+    on_start 在第一次收到响应时以文件大小为参数调用。
+    """
+    retrier = Retrier(description)
+    record_host(mirror_host(url))
+    pos = 0
+    total = None
+    while True:
+        last_pos = pos
+        try:
+            with borrow_session(url) as session:
+                resp = session.get(url, headers=resume_headers(headers, pos), stream=True, timeout=STREAM_TIMEOUT)
+                try:
+                    total = check_resume_response(resp, pos, total, description, on_start)
+                    for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                        pos += len(chunk)
+                        yield chunk
+                finally:
+                    resp.close()
+            # 连接正常关闭但数据不完整时按读取错误重试，从 pos 继续
+            check_stream_end(pos, total)
+            return
+        except Exception as e:
+            if pos > last_pos:
+                retrier.reset()
+            retrier.wait(e)
+
+
+async def iter_resumable_async(session, url: str, headers: dict, description: str,
+                               on_start: Callable[[int], None]) -> AsyncIterator[bytes]:
+    """
+    iter_resumable 的协程版本
+    """
+    retrier = Retrier(description)
+    record_host(mirror_host(url))
+    pos = 0
+    total = None
+    while True:
+        last_pos = pos
+        try:
+            resp = await session.get(url, headers=resume_headers(headers, pos), stream=True, timeout=STREAM_TIMEOUT)
+            try:
+                total = check_resume_response(resp, pos, total, description, on_start)
+                async for chunk in resp.aiter_content():
+                    pos += len(chunk)
+                    yield chunk
+            finally:
+                await close_async_response(resp)
+            check_stream_end(pos, total)
+            return
+        except Exception as e:
+            if pos > last_pos:
+                retrier.reset()
+            await retrier.wait_async(e)
+
+
+def plan_segments(filename: str, total: int, connections: int, progress, task, resume: bool = False,
+                  etag: Optional[str] = None) -> tuple[Optional[RangeJournal], list[tuple[int, int]]]:
+    """
+    预分配目标文件并切分待下载的区间，resume 为 True 时只返回日志中缺失的区间
+
+    返回:
+        (断点续传日志或 None, 待下载的区间列表)
+    """
+    journal = RangeJournal.load(filename, total, etag) if resume else None
+    if journal:
+        app_logger.info(f'断点续传: {filename}, 已完成 {journal.completed()} / {total} 字节')
+        progress.update(task, completed=journal.completed())
+    else:
+        preallocate(filename, total)
+        if resume:
+            journal = RangeJournal(filename, total, etag)
+            journal.flush()
+
+    missing = journal.missing() if journal else [(0, total - 1)]
+    ranges = []
+    for gap_start, gap_end in missing:
+        for start, end in split_ranges(gap_end - gap_start + 1, connections):
+            ranges.append((gap_start + start, gap_start + end))
+
+    app_logger.debug(f'{filename} 分为 {len(ranges)} 段下载')
+    return journal, ranges
+
+
+def finish_journal(filename: str, journal: Optional[RangeJournal]):
+    """
+    所有区间下载完成后落盘并删除断点续传日志；日志中还有缺失的区间时保留日志并报错，不把不完整的文件当作完成
+    """
+    if journal and (missing := journal.missing()):
+        journal.flush()
+        raise RuntimeError(f'{filename} 仍有 {len(missing)} 个区间未下载完成: {missing[:3]}')
+    finish_file(filename)
+    if journal:
+        journal.remove()
+
+
+def download_segmented(urls: Union[str, list[str]], headers: dict, filename: str, total: int, connections: int, progress, task,
+                       resume: bool = False, etag: Optional[str] = None):
+    """
+    使用多个并发 Range 请求下载同一个文件
+
+    先把目标文件预分配到 total 字节（见 file_writer.preallocate），再由各个连接把自己负责的区间写到对应偏移处，
+    所有区间完成后文件即为完整内容，无需额外拼接。
+    resume 为 True 时，会读取 `{filename}.journal` 只下载缺失的区间。
+    urls 可以是单个地址，也可以是按优先级排好序的镜像列表。
+    """
+    journal, ranges = plan_segments(filename, total, connections, progress, task, resume, etag)
+    try:
+        if ranges:
+            with ThreadPoolExecutor(max_workers=min(connections, len(ranges))) as executor:
+                futures = [
+                    submit_in_context(executor, download_range, urls, headers, filename, start, end, progress, task, journal)
+                    for start, end in ranges
+                ]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        # 下载中断时把最新的进度写盘，下次启动可以从这里继续
+        if journal:
+            journal.flush()
+        raise
+
+    finish_journal(filename, journal)
+
+
+async def download_segmented_async(session, urls: Union[str, list[str]], headers: dict, filename: str, total: int,
+                                   connections: int, progress, task, resume: bool = False,
+                                   etag: Optional[str] = None):
+    """
+    download_segmented 的协程版本，每个区间是事件循环中的一个协程，不占用线程
+    """
+    journal, ranges = plan_segments(filename, total, connections, progress, task, resume, etag)
+    # 断点续传时缺失的区间可能多于 connections，同时进行的区间数与线程版本保持一致
+    semaphore = asyncio.Semaphore(connections)
+
+    async def worker(start: int, end: int):
+        async with semaphore:
+            await download_range_async(session, urls, headers, filename, start, end, progress, task, journal)
+
+    workers = [asyncio.ensure_future(worker(start, end)) for start, end in ranges]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # 一个区间失败时取消其余区间，等它们退出后再写盘
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if journal:
+            journal.flush()
+        raise
+
+    finish_journal(filename, journal)
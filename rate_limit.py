@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from log_config import app_logger
+
+
+class TransferCancelled(Exception):
+    """
+    传输已被取消（例如用户按下 Ctrl+C），正在进行的下载和请求应当尽快退出
+    """
+
+
+# 设置后所有限速器的 acquire 和重试等待都会抛出 TransferCancelled，见 cancel_transfers
+transfer_cancelled = threading.Event()
+
+
+def check_cancelled():
+    if transfer_cancelled.is_set():
+        raise TransferCancelled('传输已取消')
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶限速器
+
+    rate 为每秒补充的令牌数，rate <= 0 表示不限速。
+    acquire 允许令牌数暂时为负（预支），调用方按欠下的令牌数休眠，
+    这样即使一次申请的令牌数超过桶容量（例如 1 MiB 的数据块）也能平滑限速。
+    所有传输每收到一块数据都会申请令牌，取消传输之后申请令牌会抛出 TransferCancelled，借此让传输线程停下来。
+    """
+
+    def __init__(self, name: str, rate: float = 0, capacity: Optional[float] = None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.throttled_count = 0
+        self.configure(rate, capacity)
+
+    def configure(self, rate: float, capacity: Optional[float] = None):
+        with self.lock:
+            self.rate = rate or 0
+            # 默认容量为 1 秒的令牌数，允许短时间的突发
+            self.capacity = capacity or self.rate
+            self.tokens = self.capacity
+            self.updated_at = time.monotonic()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        预支 tokens 个令牌但不休眠，返回调用方需要等待的秒数
+        """
+        check_cancelled()
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait_seconds > 0:
+                self.throttled_seconds += wait_seconds
+                self.throttled_count += 1
+        return wait_seconds
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        申请 tokens 个令牌，必要时阻塞，返回本次等待的秒数
+        """
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0 and transfer_cancelled.wait(wait_seconds):
+            check_cancelled()
+        return wait_seconds
+
+    async def acquire_async(self, tokens: float = 1) -> float:
+        """
+        acquire 的协程版本，等待期间不阻塞事件循环
+        """
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+
+# 全局共享的限速器：下载带宽（字节/秒）与 API 请求频率（次/秒）
+byte_limiter = TokenBucket('带宽')
+request_limiter = TokenBucket('请求')
+
+
+def configure_rate_limit(max_rate: Optional[int] = None, max_rps: Optional[float] = None):
+    byte_limiter.configure(max_rate or 0)
+    request_limiter.configure(max_rps or 0, capacity=1 if max_rps else None)
+
+
+def cancel_transfers():
+    """
+    让所有正在进行的下载和接口请求在下一次申请令牌或重试等待时退出
+    """
+    transfer_cancelled.set()
+
+
+def report_throttle():
+    """
+    输出各限速器累计的限速等待时间
+    """
+    for limiter in (byte_limiter, request_limiter):
+        if limiter.throttled_count:
+            app_logger.info(
+                f'{limiter.name}限速: 共等待 {limiter.throttled_seconds:.2f} 秒, 触发 {limiter.throttled_count} 次'
+            )
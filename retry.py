@@ -0,0 +1,213 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import random
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from curl_cffi.requests.exceptions import ConnectionError, HTTPError, ProxyError, RequestException
+
+from global_param import DEFAULT_RETRY_BUDGET
+from log_config import app_logger
+from metrics import phase, record_retry
+from rate_limit import check_cancelled, transfer_cancelled
+
+# 接口请求的超时（连接, 读取）秒数；流式下载的读取超时表示多久没有收到数据就判定为卡住
+API_TIMEOUT = (5, 10)
+STREAM_TIMEOUT = (10, 30)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    某一类错误的重试策略：最多尝试 max_attempts 次，等待时间按指数增长并加入随机抖动
+    """
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+
+    def delay(self, attempt: int) -> float:
+        # full jitter：在 [0, 指数退避上限] 中随机取值，避免大量连接同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+# connect: 建连失败、DNS 解析失败；read: 读取超时、连接中断
+# throttle: 412/429 风控限流，需要等待更久；server: 5xx 服务端错误
+RETRY_POLICIES = {
+    'connect': RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=8),
+    'read': RetryPolicy(max_attempts=5, base_delay=1, max_delay=16),
+    'throttle': RetryPolicy(max_attempts=4, base_delay=5, max_delay=60),
+    'server': RetryPolicy(max_attempts=4, base_delay=1, max_delay=16),
+}
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """
+    返回错误对应的重试策略名称，不可重试的错误返回 None
+    """
+    if isinstance(error, HTTPError) and getattr(error, 'response', None) is not None:
+        status = error.response.status_code
+        if status in (412, 429):
+            return 'throttle'
+        if status >= 500:
+            return 'server'
+        if status >= 400:
+            return None
+    if isinstance(error, (ConnectionError, ProxyError)):
+        return 'connect'
+    if isinstance(error, RequestException):
+        return 'read'
+    return None
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    读取响应中的 Retry-After（秒），没有时返回 None
+    """
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if value and value.isdigit():
+        return float(value)
+    return None
+
+
+class RetryBudget:
+    """
+    单个任务的重试预算，任务内所有请求共用，用完后不再重试，避免一个任务无休止地重试
+    """
+
+    def __init__(self, limit: int = DEFAULT_RETRY_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+
+_current_budget: contextvars.ContextVar[Optional[RetryBudget]] = contextvars.ContextVar('retry_budget', default=None)
+
+
+@contextmanager
+def use_retry_budget(budget: Optional[RetryBudget]):
+    """
+    在该上下文中发起的请求共用同一个重试预算
+
+    线程池中的子任务需要通过 submit_in_context 提交，才能继承当前的预算。
+    """
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+def submit_in_context(executor, fn: Callable, *args, **kwargs):
+    """
+    向线程池提交任务，并把当前线程的上下文（重试预算等）带到工作线程中
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class Retrier:
+    """
+    记录一次操作各类错误的重试次数，决定是否重试以及等待多久
+    """
+
+    def __init__(self, description: str):
+        self.description = description
+        self.attempts = defaultdict(int)
+
+    def reset(self):
+        """
+        操作取得进展（例如收到了新的数据）后清零计数，只有连续失败才会耗尽次数
+        """
+        self.attempts.clear()
+
+    def next_delay(self, error: BaseException) -> float:
+        """
+        error 可以重试时计入重试次数并返回需要等待的秒数，否则直接抛出 error
+        """
+        kind = classify_error(error)
+        if kind is None:
+            raise error
+        policy = RETRY_POLICIES[kind]
+        self.attempts[kind] += 1
+        if self.attempts[kind] >= policy.max_attempts:
+            raise error
+        budget = _current_budget.get()
+        if budget is not None and not budget.take():
+            app_logger.warning(f'任务重试次数已用完({budget.limit})，放弃: {self.description}')
+            raise error
+        record_retry(kind)
+        delay = retry_after(error) or policy.delay(self.attempts[kind])
+        app_logger.warning(f'{self.description} 第 {self.attempts[kind]} 次重试({kind})，'
+                           f'{delay:.1f} 秒后重试: {error}')
+        return delay
+
+    def wait(self, error: BaseException):
+        """
+        error 可以重试时按策略等待后返回，否则直接抛出 error
+        """
+        delay = self.next_delay(error)
+        with phase('retry_wait'):
+            # 等待期间传输被取消时立即退出
+            if transfer_cancelled.wait(delay):
+                check_cancelled()
+
+    async def wait_async(self, error: BaseException):
+        """
+        wait 的协程版本，等待期间不阻塞事件循环
+        """
+        delay = self.next_delay(error)
+        with phase('retry_wait'):
+            await asyncio.sleep(delay)
+        check_cancelled()
+
+
+def call_with_retry(fn: Callable, *args, description: Optional[str] = None, **kwargs):
+    """
+    调用 fn，遇到可重试的网络错误时按策略重试
+    """
+    retrier = Retrier(description or getattr(fn, '__name__', str(fn)))
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            retrier.wait(e)
+
+
+async def call_with_retry_async(fn: Callable, *args, description: Optional[str] = None, **kwargs):
+    """
+    call_with_retry 的协程版本，fn 为协程函数
+    """
+    retrier = Retrier(description or getattr(fn, '__name__', str(fn)))
+    while True:
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            await retrier.wait_async(e)
+
+
+def retryable(fn: Callable) -> Callable:
+    """
+    装饰器：被装饰的函数遇到可重试的网络错误时自动重试，同时支持普通函数和协程函数
+    """
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            return await call_with_retry_async(fn, *args, description=fn.__name__, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return call_with_retry(fn, *args, description=fn.__name__, **kwargs)
+    return wrapper
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from download_async import session_clients
+from download_sync import new_progress
+from log_config import app_logger
+from rate_limit import cancel_transfers
+from session_pool import session_pool
+from task import BiliTask
+
+
+class TaskScheduler:
+    """
+    批量下载任务调度器
+
+    每个任务被拆成 解析(prepare) -> 下载(fetch) -> 合并(merge) 三个阶段，
+    每个阶段有独立的线程池，前一个任务合并的同时，后面的任务可以继续解析和下载。
+    jobs 限制同时处于解析/下载阶段的任务数量。
+    """
+
+    def __init__(self, jobs: int = 1, merge_jobs: int = None):
+        self.jobs = max(1, jobs)
+        self.merge_jobs = merge_jobs or self.jobs
+        # 解析结果中的流地址会过期，解析阶段最多只比下载阶段提前 jobs 个任务
+        self.max_in_flight = self.jobs * 2
+
+    def run(self, tasks: Iterable[BiliTask],
+            on_finish: Optional[Callable[[BiliTask, bool], None]] = None) -> tuple[list[BiliTask], list[BiliTask]]:
+        """
+        执行所有任务，返回 (成功的任务, 失败的任务)
+
+        tasks 只在有空闲位置时才取下一个，on_finish 在每个任务结束时以 (任务, 是否成功) 调用
+        """
+        tasks = iter(tasks)
+        succeeded, failed = [], []
+
+        def finish(task: BiliTask, ok: bool):
+            (succeeded if ok else failed).append(task)
+            if on_finish:
+                on_finish(task, ok)
+
+        with new_progress() as progress:
+            self.run_pipeline(lambda: next(tasks, None), finish, progress)
+        return succeeded, failed
+
+    def run_pipeline(self, next_task: Callable[[], Optional[BiliTask]], on_finish: Callable[[BiliTask, bool], None],
+                     progress, stop: Optional[threading.Event] = None, poll: float = 0.5):
+        """
+        按流水线执行 next_task 提供的任务，每个任务结束时调用 on_finish(task, 是否成功)
+
+        next_task 返回 None 表示暂时没有新任务。stop 为 None 时，没有新任务且已有任务全部结束后返回；
+        否则一直运行（守护进程模式），每隔 poll 秒检查一次新任务，直到 stop 被设置且已有任务全部结束。
+        """
+        pending = {}
+        in_flight = 0
+
+        prepare_pool = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='bilix-prepare')
+        fetch_pool = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='bilix-fetch')
+        merge_pool = ThreadPoolExecutor(max_workers=self.merge_jobs, thread_name_prefix='bilix-merge')
+
+        try:
+            while True:
+                # 补充新任务到解析阶段
+                while in_flight < self.max_in_flight and not (stop and stop.is_set()):
+                    task = next_task()
+                    if task is None:
+                        break
+                    pending[prepare_pool.submit(task.prepare)] = (task, 'prepare')
+                    in_flight += 1
+
+                if not pending:
+                    if stop is None or stop.is_set():
+                        break
+                    stop.wait(poll)
+                    continue
+
+                done, _ = wait(pending, timeout=poll if stop else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, stage = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        app_logger.exception(f'任务失败 [{stage}]: {task.url}')
+                        task.metrics.finish('failed', f'{stage}: {e}')
+                        on_finish(task, False)
+                        if stage != 'merge':
+                            in_flight -= 1
+                        continue
+
+                    if stage == 'prepare':
+                        pending[fetch_pool.submit(task.fetch, progress, self.jobs > 1)] = (task, 'fetch')
+                    elif stage == 'fetch':
+                        in_flight -= 1
+                        pending[merge_pool.submit(task.merge)] = (task, 'merge')
+                    else:
+                        task.metrics.finish('skipped' if task.skipped else 'succeeded')
+                        on_finish(task, True)
+        except KeyboardInterrupt:
+            # 通知正在下载的线程在收到下一块数据时退出（断点续传日志会在退出前写盘），
+            # 而不是等所有下载完成
+            app_logger.warning('已中断，正在停止进行中的下载')
+            cancel_transfers()
+            raise
+        finally:
+            for pool in (prepare_pool, fetch_pool, merge_pool):
+                pool.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncTaskScheduler:
+    """
+    基于 asyncio 的批量下载任务调度器
+
+    所有任务的接口请求、镜像测速和分段下载都是同一个事件循环中的协程，共用一个 AsyncSession，
+    并发的传输数量不再受线程数限制。jobs 限制同时下载的任务数量，解析阶段最多提前 jobs 个任务；
+    合并是本地的 CPU/磁盘操作，放到线程中执行，最多同时合并 merge_jobs 个。
+    """
+
+    def __init__(self, jobs: int = 1, connections: int = 1, merge_jobs: int = None):
+        self.jobs = max(1, jobs)
+        self.connections = max(1, connections)
+        self.merge_jobs = merge_jobs or self.jobs
+        self.max_in_flight = self.jobs * 2
+
+    def run(self, tasks: Iterable[BiliTask],
+            on_finish: Optional[Callable[[BiliTask, bool], None]] = None) -> tuple[list[BiliTask], list[BiliTask]]:
+        """
+        在新的事件循环中执行所有任务，返回 (成功的任务, 失败的任务)，参数同 TaskScheduler.run
+        """
+        return asyncio.run(self.run_async(tasks, on_finish))
+
+    async def run_async(self, tasks: Iterable[BiliTask],
+                        on_finish: Optional[Callable[[BiliTask, bool], None]] = None
+                        ) -> tuple[list[BiliTask], list[BiliTask]]:
+        succeeded, failed = [], []
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        fetching = asyncio.Semaphore(self.jobs)
+        merging = asyncio.Semaphore(self.merge_jobs)
+
+        async def run_task(task: BiliTask, session, progress):
+            # 进入时已经占用了 in_flight 的一个位置，下载结束后释放
+            stage = 'prepare'
+            try:
+                try:
+                    await task.prepare_async(session)
+                    stage = 'fetch'
+                    async with fetching:
+                        await task.fetch_async(session, progress, self.jobs > 1)
+                finally:
+                    in_flight.release()
+                stage = 'merge'
+                async with merging:
+                    await asyncio.to_thread(task.merge)
+            except Exception as e:
+                app_logger.exception(f'任务失败 [{stage}]: {task.url}')
+                task.metrics.finish('failed', f'{stage}: {e}')
+                failed.append(task)
+                ok = False
+            else:
+                task.metrics.finish('skipped' if task.skipped else 'succeeded')
+                succeeded.append(task)
+                ok = True
+            if on_finish:
+                on_finish(task, ok)
+
+        async with session_pool.new_async_session(session_clients(self.jobs, self.connections)) as session:
+            with new_progress() as progress:
+                tasks = iter(tasks)
+                running = set()
+                while True:
+                    # 有空闲位置时才取下一个任务
+                    await in_flight.acquire()
+                    task = next(tasks, None)
+                    if task is None:
+                        in_flight.release()
+                        break
+                    running.add(future := asyncio.ensure_future(run_task(task, session, progress)))
+                    future.add_done_callback(running.discard)
+                await asyncio.gather(*running)
+
+        return succeeded, failed
@@ -0,0 +1,53 @@
+import re
+from typing import Optional
+
+from job_queue import JobQueue
+from log_config import app_logger
+from meta_cache import meta_cache
+from playurl_api import get_bangumi_season_id, get_season, get_season_episodes
+from sync_state import SyncState
+
+
+def resolve_season_id(season: str, headers: dict) -> int:
+    """
+    把番剧 URL 或 md/ss/ep 号解析为 season_id，纯数字视为 season_id
+    """
+    if season.isdigit():
+        return int(season)
+    match = re.search(r'(md|ss|ep)(\d+)', season)
+    if not match:
+        raise ValueError(f'无法识别的番剧: {season}')
+    kind, value = match.groups()
+    if kind == 'ss':
+        return int(value)
+    if kind == 'md':
+        return int(meta_cache.get_or_load('season_id', value, lambda: get_bangumi_season_id(value)))
+    return int(get_season(headers, ep_id=value)['season_id'])
+
+
+def follow_season(season: str, headers: dict, sync_state: SyncState, job_queue: JobQueue, quality: Optional[int],
+                  codec: Optional[str], save: Optional[str]) -> int:
+    """
+    追更番剧：把新更新的剧集和之前没有下载完成的剧集加入下载队列，返回新加入队列的数量
+
+    剧集列表只需要一次请求，且每次都重新获取（不使用元数据缓存，否则缓存有效期内看不到新剧集）；
+    已经下载完成的剧集不会再创建任务，也不会再解析播放地址。
+    """
+    season_id = resolve_season_id(season, headers)
+    episodes = [{'ep_id': episode['id'], 'url': episode['share_url'],
+                 'title': episode.get('long_title') or episode.get('title')}
+                for episode in get_season_episodes(season_id)]
+    known = sync_state.season_episodes(season_id)
+    new = [episode for episode in episodes if episode['ep_id'] not in known]
+    sync_state.add_episodes(season_id, new)
+
+    # 根据队列中的结果更新下载状态，其余剧集（包括之前下载失败或被中断的）重新加入队列，队列会忽略重复的任务
+    pending = [episode for episode in episodes if not known.get(episode['ep_id'], {}).get('downloaded')]
+    finished = job_queue.finished_urls([episode['url'] for episode in pending], quality, codec, save)
+    sync_state.mark_downloaded(season_id, [episode['ep_id'] for episode in pending if episode['url'] in finished])
+    pending = [episode for episode in pending if episode['url'] not in finished]
+
+    added = job_queue.add([(episode['url'], quality, codec, save) for episode in pending])
+    app_logger.info(f'番剧 ss{season_id}: 共 {len(episodes)} 集，新剧集 {len(new)} 集，'
+                    f'未下载 {len(pending)} 集，加入队列 {added} 集')
+    return added
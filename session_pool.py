@@ -0,0 +1,97 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from curl_cffi import requests
+
+# 默认模拟的浏览器指纹
+DEFAULT_IMPERSONATE = 'chrome'
+
+
+class SessionPool:
+    """
+    按 host 分组的 HTTP Session 池
+
+    curl_cffi 的 Session 不是线程安全的，因此每次请求从池中借出一个独占的 Session，
+    用完后归还，后续同一 host 的请求可以复用已有的 TLS 连接（keep-alive / HTTP2）。
+    size 为每个 host 最多保留的空闲 Session 数量，并发超过 size 时会临时创建新的 Session，
+    归还时多余的会被关闭。
+    """
+
+    def __init__(self, size: int = 8, impersonate: str = DEFAULT_IMPERSONATE):
+        self.size = size
+        self.impersonate = impersonate
+        self.lock = threading.Lock()
+        self.idle: dict[str, list[requests.Session]] = defaultdict(list)
+
+    def configure(self, size: int = None, impersonate: str = None):
+        if size is not None:
+            self.size = size
+        if impersonate is not None and impersonate != self.impersonate:
+            self.impersonate = impersonate
+            self.close()
+
+    def new_session(self) -> requests.Session:
+        return requests.Session(impersonate=self.impersonate)
+
+    @contextmanager
+    def borrow(self, url: str):
+        host = urlsplit(url).netloc
+        with self.lock:
+            idle = self.idle[host]
+            session = idle.pop() if idle else None
+        if session is None:
+            session = self.new_session()
+
+        try:
+            yield session
+        except BaseException:
+            # 出错的连接状态未知，直接丢弃
+            session.close()
+            raise
+
+        with self.lock:
+            idle = self.idle[host]
+            if len(idle) < self.size:
+                idle.append(session)
+                session = None
+        if session is not None:
+            session.close()
+
+    def new_async_session(self, max_clients: int = 10) -> requests.AsyncSession:
+        """
+        创建一个与池中 Session 使用相同浏览器指纹的 AsyncSession
+
+        AsyncSession 在同一个事件循环中复用连接，max_clients 为同时进行的请求数上限，
+        超出的请求会排队等待。
+        """
+        return requests.AsyncSession(impersonate=self.impersonate, max_clients=max_clients)
+
+    def close(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle.clear()
+        for session in sessions:
+            session.close()
+
+
+session_pool = SessionPool()
+
+
+async def close_async_response(resp: requests.Response):
+    """
+    关闭 AsyncSession 发起的流式响应
+
+    提前停止读取时需要先通知 curl 停止接收，否则 aclose 会一直等到整个响应体接收完
+    """
+    if resp.quit_now is not None:
+        resp.quit_now.set()
+    await resp.aclose()
+
+
+def borrow_session(url: str):
+    """
+    从全局 Session 池中借出一个与 url 的 host 对应的 Session
+    """
+    return session_pool.borrow(url)
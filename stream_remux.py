@@ -0,0 +1,137 @@
+import errno
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import FIRST_EXCEPTION, wait
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Optional
+
+from cdn_mirror import rank_mirrors
+from file_writer import StreamFile
+from log_config import app_logger
+from metrics import record_bytes, record_total, run_metered
+from range_download import iter_resumable
+from rate_limit import byte_limiter
+from retry import submit_in_context
+from tool import get_ffmpeg_path, shrink_title
+
+
+def stream_remux_supported() -> bool:
+    """
+    边下载边合并依赖命名管道，目前只支持类 Unix 系统
+    """
+    return hasattr(os, 'mkfifo')
+
+
+def open_fifo_for_write(path: str, process: subprocess.Popen):
+    """
+    以写模式打开命名管道
+
+    直接 open 会一直阻塞到 ffmpeg 打开读端为止，如果 ffmpeg 提前退出就会永远卡住，
+    所以这里用非阻塞方式轮询，同时检查 ffmpeg 是否还在运行。
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if process.poll() is not None:
+            raise RuntimeError(f'ffmpeg 已退出，无法写入: {path}')
+        time.sleep(0.05)
+    os.set_blocking(fd, True)
+    return os.fdopen(fd, 'wb')
+
+
+def pipe_stream(url: str, headers: dict, fifo_path: str, process: subprocess.Popen, progress,
+                description: str, keep_file: Optional[str] = None):
+    """
+    顺序下载一个流并写入命名管道，keep_file 不为空时同时保存一份到本地文件
+
+    连接中断时从已写入管道的位置继续下载，ffmpeg 读到的仍是连续的数据。
+    """
+    task = progress.add_task(shrink_title(Path(description).name), start=False)
+
+    with open_fifo_for_write(fifo_path, process) as pipe, \
+            (StreamFile(keep_file) if keep_file else nullcontext()) as f:
+        def on_start(total: int):
+            record_total(total)
+            progress.update(task, total=total)
+            progress.start_task(task)
+            if f:
+                f.allocate(total)
+
+        for chunk in iter_resumable(url, headers, description, on_start):
+            pipe.write(chunk)
+            if f:
+                f.write(chunk)
+            progress.update(task, advance=len(chunk))
+            byte_limiter.acquire(len(chunk))
+            record_bytes(len(chunk))
+        if f:
+            f.complete()
+    return task
+
+
+def stream_remux(plan: dict, progress, keep_m4s: bool = False) -> list:
+    """
+    边下载边合并：音视频流分别写入两个命名管道，ffmpeg 直接从管道读取并封装为 mp4
+
+    不落地中间的 m4s 文件（keep_m4s 为 True 时除外），省去合并时的额外一次读写，
+    峰值磁盘占用约为视频大小的一倍。合并结果写到 plan['merge_path']，由 merge_streams 移动到保存目录。
+    返回进度条任务 id 列表。
+    """
+    output_path = Path(plan['output_path'])
+    merge_path = Path(plan['merge_path'])
+    if output_path.exists():
+        app_logger.warning('目标MP4存在，合并完成后将被覆盖')
+
+    with tempfile.TemporaryDirectory(prefix='bilix-') as tmp_dir:
+        video_fifo = os.path.join(tmp_dir, 'video.m4s')
+        audio_fifo = os.path.join(tmp_dir, 'audio.m4s')
+        os.mkfifo(video_fifo)
+        os.mkfifo(audio_fifo)
+        # ffmpeg 的错误输出写到临时文件：用管道的话下载期间没有人读取，输出多了会把 ffmpeg 阻塞住；
+        # 无论 ffmpeg 是否启动成功都要先关闭它，临时目录才能被删除
+        with open(os.path.join(tmp_dir, 'ffmpeg.log'), 'w+b') as stderr_file:
+            command = [get_ffmpeg_path(), '-nostdin', '-loglevel', 'error', '-y',
+                       '-i', video_fifo, '-i', audio_fifo, '-c', 'copy', str(merge_path)]
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr_file)
+
+            # 管道只能顺序写入，无法中途切换镜像，这里只选出测速最快的节点
+            executor = ThreadPoolExecutor(max_workers=2)
+            try:
+                video_url = rank_mirrors([plan['video_url']] + plan.get('video_mirrors', []), plan['headers'])[0]
+                audio_url = rank_mirrors([plan['audio_url']] + plan.get('audio_mirrors', []), plan['headers'])[0]
+                futures = [
+                    submit_in_context(executor, run_metered, 'video', pipe_stream, video_url, plan['headers'], video_fifo,
+                                      process, progress, plan['video_file'], plan['video_file'] if keep_m4s else None),
+                    submit_in_context(executor, run_metered, 'audio', pipe_stream, audio_url, plan['headers'], audio_fifo,
+                                      process, progress, plan['audio_file'], plan['audio_file'] if keep_m4s else None),
+                ]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+                tasks = [future.result() for future in futures]
+            except BaseException:
+                # 先结束 ffmpeg，另一个仍在写管道的线程会因为 BrokenPipe 退出
+                process.kill()
+                process.wait()
+                executor.shutdown(wait=True, cancel_futures=True)
+                merge_path.unlink(missing_ok=True)
+                raise
+            executor.shutdown(wait=True)
+
+            process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        if process.returncode != 0:
+            merge_path.unlink(missing_ok=True)
+            raise RuntimeError(f'ffmpeg 合并失败: {stderr.decode("utf-8", errors="replace")}')
+
+    app_logger.info(f"成功合并到: {merge_path}")
+    return tasks
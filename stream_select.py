@@ -0,0 +1,58 @@
+from typing import Optional
+
+from log_config import app_logger
+from tool import estimate_size, format_bytes
+
+# 清晰度相同时优先选择的编码，越靠前同等画质下体积越小：AV1 > HEVC > AVC
+CODEC_PREFERENCE = (13, 12, 7)
+
+
+def codec_rank(stream: dict) -> int:
+    codecid = stream.get('codecid')
+    return len(CODEC_PREFERENCE) - CODEC_PREFERENCE.index(codecid) if codecid in CODEC_PREFERENCE else 0
+
+
+def pair_size(video: dict, audio: dict, duration: Optional[float]) -> Optional[float]:
+    """
+    按 DASH 流的 bandwidth 和时长估算合并后的文件大小（字节），时长未知时返回 None
+    """
+    if not duration:
+        return None
+    return estimate_size(video.get('bandwidth', 0) + audio.get('bandwidth', 0), duration)
+
+
+def select_in_budget(videos: list, audios: list, duration: Optional[float], quality: Optional[int],
+                     codecid: Optional[int], max_size: Optional[int] = None,
+                     max_bitrate: Optional[int] = None) -> tuple[dict, dict]:
+    """
+    在 max_size（字节）和 max_bitrate（bps，音视频合计）的预算内选择画质最好的视频流和音频流
+
+    quality 为清晰度上限，codecid 不为 None 时只在该编码中选择（没有该编码的流时不限编码）。
+    满足预算的组合中依次比较：清晰度、编码（见 CODEC_PREFERENCE）、音频码率、视频码率；
+    没有满足预算的组合时使用估算体积最小的组合。
+    """
+    candidates = [v for v in videos if not quality or v['id'] <= quality] or videos
+    if codecid is not None:
+        candidates = [v for v in candidates if v.get('codecid') == codecid] or candidates
+    if max_size and not duration:
+        app_logger.warning('无法获取视频时长，忽略 --max-size')
+        max_size = None
+
+    def total_bitrate(pair) -> int:
+        return pair[0].get('bandwidth', 0) + pair[1].get('bandwidth', 0)
+
+    pairs = [(video, audio) for video in candidates for audio in audios]
+    fitted = [pair for pair in pairs
+              if (not max_bitrate or total_bitrate(pair) <= max_bitrate)
+              and (not max_size or pair_size(*pair, duration) <= max_size)]
+    if fitted:
+        video, audio = max(fitted, key=lambda pair: (pair[0]['id'], codec_rank(pair[0]),
+                                                     pair[1].get('bandwidth', 0), pair[0].get('bandwidth', 0)))
+    else:
+        video, audio = min(pairs, key=total_bitrate)
+        app_logger.warning('没有满足大小或码率限制的音视频流，使用体积最小的组合')
+
+    size = pair_size(video, audio, duration)
+    app_logger.info(f'按预算选择: 码率 {total_bitrate((video, audio)) // 1000} kbps'
+                    + (f', 预计大小 {format_bytes(size)}' if size else ''))
+    return video, audio
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from global_param import STATE_DIR
+
+SYNC_FILE_NAME = 'bilix_sync.db'
+
+
+class SyncState:
+    """
+    增量同步的本地状态
+
+    每个 UP 主记录一条水位线：已同步的最新投稿的发布时间，以及发布时间等于它的投稿 bvid（同一秒发布多个时用来去重）。
+    下次同步时只有比水位线新的投稿才会加入下载队列。
+    追更的番剧按 (season_id, ep_id) 记录见过的每一集，以及确认下载完成的时间。数据库在第一次读写时才会创建。
+    """
+
+    def __init__(self, path: Union[str, Path] = STATE_DIR / SYNC_FILE_NAME):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploaders ('
+                'mid INTEGER PRIMARY KEY, pubdate INTEGER NOT NULL, bvids TEXT NOT NULL, videos INTEGER NOT NULL, '
+                'synced_at REAL NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS season_episodes ('
+                'season_id INTEGER NOT NULL, ep_id INTEGER NOT NULL, url TEXT NOT NULL, title TEXT, '
+                'seen_at REAL NOT NULL, downloaded_at REAL, PRIMARY KEY (season_id, ep_id))'
+            )
+            self.conn.commit()
+        return self.conn
+
+    def watermark(self, mid: int) -> Optional[dict]:
+        """
+        返回 {'pubdate': 发布时间, 'bvids': [...]}，没有同步过时返回 None
+        """
+        with self.lock:
+            row = self._connect().execute('SELECT pubdate, bvids FROM uploaders WHERE mid = ?', (mid,)).fetchone()
+        if row is None:
+            return None
+        return {'pubdate': row[0], 'bvids': json.loads(row[1])}
+
+    def set_watermark(self, mid: int, watermark: dict, added: int):
+        """
+        更新水位线，added 为本次新加入下载队列的投稿数量，累计到 videos 中
+        """
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT INTO uploaders (mid, pubdate, bvids, videos, synced_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (mid) DO UPDATE SET pubdate = excluded.pubdate, bvids = excluded.bvids, '
+                'videos = videos + excluded.videos, synced_at = excluded.synced_at',
+                (mid, watermark['pubdate'], json.dumps(watermark['bvids']), added, time.time())
+            )
+            conn.commit()
+
+    def season_episodes(self, season_id: int) -> dict[int, dict]:
+        """
+        番剧已经见过的剧集，键为 ep_id，值为 {'url', 'title', 'downloaded'}
+        """
+        with self.lock:
+            rows = self._connect().execute(
+                'SELECT ep_id, url, title, downloaded_at FROM season_episodes WHERE season_id = ?', (season_id,)
+            ).fetchall()
+        return {ep_id: {'url': url, 'title': title, 'downloaded': downloaded_at is not None}
+                for ep_id, url, title, downloaded_at in rows}
+
+    def add_episodes(self, season_id: int, episodes: list[dict]):
+        """
+        记录新见到的剧集，episodes 中的每一项为 {'ep_id', 'url', 'title'}
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.executemany(
+                'INSERT OR IGNORE INTO season_episodes (season_id, ep_id, url, title, seen_at) VALUES (?, ?, ?, ?, ?)',
+                [(season_id, episode['ep_id'], episode['url'], episode['title'], now) for episode in episodes]
+            )
+            conn.commit()
+
+    def mark_downloaded(self, season_id: int, ep_ids: list[int]):
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.executemany(
+                'UPDATE season_episodes SET downloaded_at = ? WHERE season_id = ? AND ep_id = ? AND downloaded_at IS NULL',
+                [(now, season_id, ep_id) for ep_id in ep_ids]
+            )
+            conn.commit()
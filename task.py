@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+from typing import Optional
+
+from download_async import fetch_streams_async, prepare_download_async
+from download_sync import download_sync, prepare_download, fetch_streams, merge_streams
+from metrics import TaskMetrics, use_metrics
+from retry import DEFAULT_RETRY_BUDGET, RetryBudget, use_retry_budget
+
+
+class BiliTask:
+    def __init__(self, url: str, headers: dict, quality: int, codec:str, save: str, connections: int = 1,
+                 resume: bool = False, stream_merge: bool = False, keep_m4s: bool = False,
+                 merger: str = 'ffmpeg', retries: int = DEFAULT_RETRY_BUDGET, work_dir: Optional[str] = None,
+                 force: bool = False, max_size: Optional[int] = None, max_bitrate: Optional[int] = None):
+        self.url = url
+        self.headers = headers
+        self.quality = quality
+        self.codec = codec
+        self.save = save
+        self.connections = connections
+        self.resume = resume
+        self.stream_merge = stream_merge
+        self.keep_m4s = keep_m4s
+        self.merger = merger
+        self.retries = retries
+        self.work_dir = work_dir
+        self.force = force
+        self.max_size = max_size
+        self.max_bitrate = max_bitrate
+        # 准备和下载阶段的所有请求共用同一个重试预算
+        self.retry_budget = RetryBudget(retries)
+        self.metrics = TaskMetrics(url)
+        self.plan: Optional[dict] = None
+
+    @property
+    def skipped(self) -> bool:
+        """
+        下载索引中已有该任务完好的输出文件，任务被跳过
+        """
+        return bool(self.plan and self.plan.get('skipped'))
+
+    def download(self):
+        download_sync(self.url, self.headers, self.quality, self.codec, self.save, self.connections, self.resume,
+                      self.stream_merge, self.keep_m4s, self.merger, self.retries, self.work_dir,
+                      self.force, self.max_size, self.max_bitrate)
+
+    @contextmanager
+    def context(self):
+        """
+        任务各阶段执行时的上下文：共用重试预算，并把耗时等指标记录到 self.metrics
+        """
+        with use_retry_budget(self.retry_budget), use_metrics(self.metrics):
+            yield
+
+    # 以下三个方法对应流水线的三个阶段，由 TaskScheduler 分别调度
+    def prepare(self):
+        self.metrics.status = 'preparing'
+        with self.context():
+            self.plan = prepare_download(self.url, self.headers, self.quality, self.codec, self.save, self.work_dir,
+                                         self.force, self.max_size, self.max_bitrate)
+
+    def fetch(self, progress, remove_finished: bool = False):
+        self.metrics.status = 'fetching'
+        with self.context():
+            fetch_streams(self.plan, progress, self.connections, self.resume, remove_finished,
+                          self.stream_merge, self.keep_m4s)
+
+    def merge(self):
+        self.metrics.status = 'merging'
+        with self.context():
+            merge_streams(self.plan, self.keep_m4s, self.merger)
+
+    # 异步引擎（AsyncTaskScheduler）使用的协程版本，所有任务共用同一个 AsyncSession
+    async def prepare_async(self, session):
+        self.metrics.status = 'preparing'
+        with self.context():
+            self.plan = await prepare_download_async(session, self.url, self.headers, self.quality, self.codec,
+                                                     self.save, self.work_dir, self.force, self.max_size,
+                                                     self.max_bitrate)
+
+    async def fetch_async(self, session, progress, remove_finished: bool = False):
+        self.metrics.status = 'fetching'
+        with self.context():
+            await fetch_streams_async(session, self.plan, progress, self.connections, self.resume, remove_finished)
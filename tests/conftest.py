@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 项目是平铺的模块，测试时把项目根目录加入导入路径；benchmark 中的 fake_bilibili 用于生成测试用的 m4s 文件
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmark'))
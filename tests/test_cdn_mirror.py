@@ -0,0 +1,60 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cdn_mirror import probe_mirror, stream_mirrors
+
+FILE_SIZE = 64 * 1024 * 1024
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """
+    /range 按 Range 返回数据，/full 忽略 Range 返回整个文件
+    """
+    def do_GET(self):
+        header = self.headers.get('Range')
+        if self.path == '/range' and header:
+            start, end = map(int, header[len('bytes='):].split('-'))
+            size = end - start + 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{FILE_SIZE}')
+        else:
+            size = FILE_SIZE
+            self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = b'\0' * (64 * 1024)
+        try:
+            for offset in range(0, size, len(block)):
+                self.wfile.write(block[:size - offset])
+        except OSError:
+            # 探测方读够数据后会关闭连接
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mirror_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MirrorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_probe_reads_only_probe_bytes(mirror_server):
+    latency, throughput = probe_mirror(f'{mirror_server}/range', {})
+    assert latency >= 0 and throughput > 0
+
+
+def test_probe_rejects_mirror_ignoring_range(mirror_server):
+    with pytest.raises(ValueError):
+        probe_mirror(f'{mirror_server}/full', {})
+
+
+def test_stream_mirrors_deduplicates():
+    stream = {'baseUrl': 'https://a/x.m4s', 'backupUrl': ['https://b/x.m4s', 'https://a/x.m4s']}
+    assert stream_mirrors(stream) == ['https://a/x.m4s', 'https://b/x.m4s']
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+import download_async
+
+
+def test_failed_stream_cancels_sibling(monkeypatch):
+    cancelled = []
+
+    async def fake_download(session, url, headers, filename, progress, connections, resume, mirrors):
+        if url == 'video':
+            await asyncio.sleep(0.01)
+            raise RuntimeError('video failed')
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(filename)
+            raise
+
+    monkeypatch.setattr(download_async, 'download_stream_async', fake_download)
+    plan = {'headers': {}, 'title': 't', 'video_url': 'video', 'audio_url': 'audio',
+            'video_file': 'v.m4s', 'audio_file': 'a.m4s'}
+
+    async def run():
+        with pytest.raises(RuntimeError, match='video failed'):
+            await asyncio.wait_for(download_async.fetch_streams_async(None, plan, None), timeout=5)
+        # 任务结束时另一个流已经被取消，而不是等到事件循环关闭
+        assert cancelled == ['a.m4s']
+
+    asyncio.run(run())
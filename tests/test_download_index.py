@@ -0,0 +1,54 @@
+import sqlite3
+
+from download_index import DownloadIndex, file_checksum
+
+
+def write_file(path, data: bytes = b'video'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_one_entry_per_save_dir(tmp_path):
+    index = DownloadIndex(tmp_path / 'index.db')
+    first = write_file(tmp_path / 'a' / 'v.mp4')
+    second = write_file(tmp_path / 'b' / 'v.mp4')
+    index.add('BV1', 1, 80, 7, first, file_checksum(first), request='r-a')
+    index.add('BV1', 1, 80, 7, second, file_checksum(second), request='r-b')
+
+    assert index.get('BV1', 1, 80, 7, str(tmp_path / 'a'))['path'] == str(first.resolve())
+    assert index.get('BV1', 1, 80, 7, str(tmp_path / 'b'))['path'] == str(second.resolve())
+    assert index.get('BV1', 1, 80, 7, str(tmp_path / 'c')) is None
+    assert index.lookup('r-a')['path'] == str(first.resolve())
+    assert index.lookup('r-b')['path'] == str(second.resolve())
+
+
+def test_verify_detects_changed_file(tmp_path):
+    index = DownloadIndex(tmp_path / 'index.db')
+    path = write_file(tmp_path / 'v.mp4')
+    index.add('BV1', 1, 80, 7, path, file_checksum(path))
+    entry = index.get('BV1', 1, 80, 7, str(tmp_path))
+    assert index.verify(entry)
+    path.write_bytes(b'other')
+    assert not index.verify(entry)
+
+
+def test_migrates_index_without_save_dir(tmp_path):
+    path = write_file(tmp_path / 'a' / 'v.mp4')
+    conn = sqlite3.connect(tmp_path / 'index.db')
+    conn.execute(
+        'CREATE TABLE downloads (bvid TEXT NOT NULL, cid INTEGER NOT NULL, quality INTEGER NOT NULL, '
+        'codec INTEGER NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+        'sha256 TEXT NOT NULL, finished_at REAL NOT NULL, PRIMARY KEY (bvid, cid, quality, codec))'
+    )
+    conn.execute('CREATE TABLE requests (request TEXT PRIMARY KEY, bvid TEXT NOT NULL, cid INTEGER NOT NULL, '
+                 'quality INTEGER NOT NULL, codec INTEGER NOT NULL)')
+    conn.execute('INSERT INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 ('BV1', 1, 80, 7, str(path.resolve()), 5, path.stat().st_mtime, file_checksum(path), 0))
+    conn.commit()
+    conn.close()
+
+    index = DownloadIndex(tmp_path / 'index.db')
+    entry = index.get('BV1', 1, 80, 7, str(tmp_path / 'a'))
+    assert entry['save_dir'] == str((tmp_path / 'a').resolve())
+    assert index.verify(entry)
@@ -0,0 +1,97 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from job_queue import LEASE_TIMEOUT, MAX_ATTEMPTS, JobQueue
+
+
+def set_job(queue: JobQueue, job_id: int, **fields):
+    columns = ', '.join(f'{name} = ?' for name in fields)
+    queue._connect().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+
+def job_state(queue: JobQueue, job_id: int) -> str:
+    return queue._connect().execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()['state']
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_add_skips_duplicate_requests(tmp_path):
+    queue = JobQueue(str(tmp_path / 'queue.db'))
+    assert queue.add([('u1', None, None, None), ('u2', 80, 'HEVC', 'out')]) == 2
+    assert queue.add([('u1', None, None, None), ('u2', 80, 'HEVC', 'out')]) == 0
+    assert queue.add([('u1', None, None, 'out'), ('u2', 64, 'HEVC', 'out')]) == 2
+    assert queue.counts() == {'queued': 4}
+
+
+def test_claim_in_order_and_only_once(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    first, second = JobQueue(path), JobQueue(path)
+    first.add([('u1', None, None, None), ('u2', None, None, None), ('u3', None, None, None)])
+
+    claimed = [first.claim(), second.claim(), first.claim()]
+    assert [job['url'] for job in claimed] == ['u1', 'u2', 'u3']
+    assert all(job['state'] == 'running' and job['attempts'] == 1 for job in claimed)
+    assert first.claim() is None and second.claim() is None
+
+    first.finish(claimed[0]['id'], 'succeeded', output_path='u1.mp4')
+    assert first.counts() == {'running': 2, 'succeeded': 1}
+
+
+def test_concurrent_claims_are_exclusive(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    JobQueue(path).add([(f'u{i}', None, None, None) for i in range(50)])
+    claimed, lock = [], threading.Lock()
+
+    def worker():
+        queue = JobQueue(path)
+        while (job := queue.claim()) is not None:
+            with lock:
+                claimed.append(job['id'])
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(1, 51))
+
+
+def test_recover_requeues_dead_and_stale_owners(tmp_path):
+    queue = JobQueue(str(tmp_path / 'queue.db'))
+    queue.add([(f'u{i}', None, None, None) for i in range(5)])
+    jobs = [queue.claim()['id'] for _ in range(5)]
+    host, now, stale = socket.gethostname(), time.time(), time.time() - LEASE_TIMEOUT - 1
+
+    # 本机进程已退出
+    set_job(queue, jobs[0], owner=f'{host}:{dead_pid()}', heartbeat_at=now)
+    # 本机进程仍在运行但心跳过期（pid 可能已被复用）
+    set_job(queue, jobs[1], owner=f'{host}:{os.getppid()}', heartbeat_at=stale)
+    # 本机进程仍在运行且心跳正常
+    set_job(queue, jobs[2], owner=f'{host}:{os.getppid()}', heartbeat_at=now)
+    # 其他机器上的进程只看心跳
+    set_job(queue, jobs[3], owner='other-host:1', heartbeat_at=stale)
+    set_job(queue, jobs[4], owner='other-host:1', heartbeat_at=now)
+
+    assert queue.recover() == 3
+    assert [job_state(queue, job_id) for job_id in jobs] == ['queued', 'queued', 'running', 'queued', 'running']
+
+
+def test_recover_retries_failed_jobs_until_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / 'queue.db'))
+    queue.add([('u1', None, None, None), ('u2', None, None, None)])
+    retry, give_up = queue.claim()['id'], queue.claim()['id']
+    queue.finish(retry, 'failed', error='timeout')
+    queue.finish(give_up, 'failed', error='timeout')
+    set_job(queue, give_up, attempts=MAX_ATTEMPTS)
+
+    assert queue.recover() == 1
+    assert job_state(queue, retry) == 'queued'
+    assert job_state(queue, give_up) == 'failed'
@@ -0,0 +1,67 @@
+import struct
+
+from fake_bilibili import AUDIO_FRAME, AUDIO_TIMESCALE, write_m4s
+from mp4_mux import AUDIO_TRACK_ID, VIDEO_TRACK_ID, find_box, iter_boxes, merge_m4s_native
+
+DURATION = 3
+
+
+def top_level(data: bytes, box_type: bytes) -> list:
+    return [box for box in iter_boxes(data) if box.type == box_type]
+
+
+def children(data: bytes, parent, box_type: bytes) -> list:
+    return [box for box in iter_boxes(data, parent.payload_offset, parent.end) if box.type == box_type]
+
+
+def tkhd_track_id(data: bytes, trak) -> int:
+    tkhd = find_box(data, trak, b'tkhd')
+    return struct.unpack_from('>I', data, tkhd.payload_offset + 4 + (16 if data[tkhd.payload_offset] == 1 else 8))[0]
+
+
+def mdat_payloads(data: bytes) -> list[bytes]:
+    return [data[box.payload_offset:box.end] for box in top_level(data, b'mdat')]
+
+
+def test_merge_round_trip(tmp_path):
+    video, audio, output = tmp_path / 'v.m4s', tmp_path / 'a.m4s', tmp_path / 'out.mp4'
+    write_m4s(video, 'video', 64 * 1024, DURATION)
+    # 音频的 mvhd 使用不同的时间单位，并带有编辑列表
+    write_m4s(audio, 'audio', 8 * 1024, DURATION, movie_timescale=AUDIO_TIMESCALE, media_time=AUDIO_FRAME)
+
+    assert merge_m4s_native(video, audio, output)
+    data = output.read_bytes()
+
+    moov = top_level(data, b'moov')[0]
+    traks = children(data, moov, b'trak')
+    assert [tkhd_track_id(data, trak) for trak in traks] == [VIDEO_TRACK_ID, AUDIO_TRACK_ID]
+
+    mvhd = find_box(data, moov, b'mvhd')
+    timescale, duration = struct.unpack_from('>II', data, mvhd.payload_offset + 12)
+    assert timescale == 1000
+    assert duration == DURATION * 1000
+
+    # 音频编辑列表的 segment_duration 换算到视频 mvhd 的时间单位，media_time 不变
+    elst = find_box(data, find_box(data, traks[1], b'edts'), b'elst')
+    assert struct.unpack_from('>Ii', data, elst.payload_offset + 8) == (DURATION * 1000, AUDIO_FRAME)
+
+    # 每个分片的序号连续，track_ID 已改写，音视频的数据原样保留
+    moofs = top_level(data, b'moof')
+    assert len(moofs) == 2 * DURATION
+    sequences, track_ids = [], []
+    for moof in moofs:
+        sequences.append(struct.unpack_from('>I', data, find_box(data, moof, b'mfhd').payload_offset + 4)[0])
+        tfhd = find_box(data, find_box(data, moof, b'traf'), b'tfhd')
+        track_ids.append(struct.unpack_from('>I', data, tfhd.payload_offset + 4)[0])
+    assert sequences == list(range(1, 2 * DURATION + 1))
+    assert track_ids.count(VIDEO_TRACK_ID) == track_ids.count(AUDIO_TRACK_ID) == DURATION
+
+    payloads = mdat_payloads(data)
+    assert [p for p, t in zip(payloads, track_ids) if t == VIDEO_TRACK_ID] == mdat_payloads(video.read_bytes())
+    assert [p for p, t in zip(payloads, track_ids) if t == AUDIO_TRACK_ID] == mdat_payloads(audio.read_bytes())
+
+
+def test_merge_missing_input(tmp_path):
+    video = tmp_path / 'v.m4s'
+    write_m4s(video, 'video', 16 * 1024, 1)
+    assert not merge_m4s_native(video, tmp_path / 'missing.m4s', tmp_path / 'out.mp4')
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from tool import PageExtractor, extract_page
+
+PLAYINFO = {'data': {'timelength': 1000}}
+STATE = {'bvid': 'BV1xx', 'videoData': {'title': 'window.__playinfo__ inside json'}}
+
+HTML = (
+    '<html><head><TITLE>测试视频_哔哩哔哩_bilibili</TITLE></head><body>'
+    '<script>if (window.__playinfo__) { console.log(1) }</script>'
+    f'<script>window.__INITIAL_STATE__={json.dumps(STATE)};</script>'
+    f'<script>window.__playinfo__={json.dumps(PLAYINFO)}</script>'
+    '</body></html>'
+)
+
+
+def test_extract_page_skips_decoy_markers():
+    page = extract_page(HTML)
+    assert page['title'] == '测试视频_哔哩哔哩_bilibili'
+    assert page['playinfo'] == PLAYINFO
+    assert page['initial_state'] == STATE
+    assert page['playurl_ssr_data'] is None
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 64 * 1024])
+def test_streamed_extraction_matches_whole_page(chunk_size):
+    extractor = PageExtractor()
+    for i in range(0, len(HTML), chunk_size):
+        extractor.feed(HTML[i:i + chunk_size])
+    assert extractor.finish() == extract_page(HTML)
+
+
+def test_feed_stops_when_required_fields_found():
+    extractor = PageExtractor(required=('title',))
+    assert extractor.feed('<title>abc</title><script>window.__playinfo__=')
+    assert extractor.result['title'] == 'abc'
+
+
+def test_incomplete_json_at_end():
+    page = extract_page('<title>x</title><script>window.__playinfo__={"a": [1, 2')
+    assert page['title'] == 'x'
+    assert page['playinfo'] is None
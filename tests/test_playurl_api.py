@@ -0,0 +1,26 @@
+import pytest
+
+from playurl_api import PageNotFoundError, playurl_target, ugc_page
+
+
+@pytest.mark.parametrize('url, target', [
+    ('https://www.bilibili.com/video/BV1xx411c7mD', {'kind': 'ugc', 'bvid': 'BV1xx411c7mD', 'page': 1}),
+    ('https://www.bilibili.com/video/BV1xx411c7mD?p=3', {'kind': 'ugc', 'bvid': 'BV1xx411c7mD', 'page': 3}),
+    ('https://www.bilibili.com/bangumi/play/ep123', {'kind': 'pgc', 'ep_id': '123', 'season_id': None}),
+    ('https://www.bilibili.com/bangumi/play/ss45', {'kind': 'pgc', 'ep_id': None, 'season_id': '45'}),
+    ('https://www.bilibili.com/video/BV1xx411c7mD?p=abc', None),
+    ('https://www.bilibili.com/bangumi/media/md28', None),
+])
+def test_playurl_target(url, target):
+    assert playurl_target(url) == target
+
+
+ARCHIVE = {'bvid': 'BV1', 'cid': 10, 'title': '合集',
+           'pages': [{'page': 1, 'cid': 10, 'part': '上'}, {'page': 2, 'cid': 11, 'part': '下'}]}
+
+
+def test_ugc_page():
+    assert ugc_page(ARCHIVE, 2) == (11, '合集_p2_下')
+    assert ugc_page({'bvid': 'BV2', 'cid': 20, 'title': '单P'}, 1) == (20, '单P')
+    with pytest.raises(PageNotFoundError):
+        ugc_page(ARCHIVE, 3)
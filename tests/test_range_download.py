@@ -0,0 +1,122 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from range_download import RangeJournal, finish_journal, iter_resumable, split_ranges
+
+
+def covers(ranges: list[tuple[int, int]], total: int) -> bool:
+    pos = 0
+    for start, end in ranges:
+        if start != pos or end < start:
+            return False
+        pos = end + 1
+    return pos == total
+
+
+@pytest.mark.parametrize('total, connections', [(1, 4), (100, 1), (10 * 1024 * 1024, 4), (10 * 1024 * 1024 + 7, 3)])
+def test_split_ranges_covers_whole_file(total, connections):
+    ranges = split_ranges(total, connections, min_size=1024)
+    assert covers(ranges, total)
+    assert 1 <= len(ranges) <= connections
+
+
+def test_split_ranges_respects_min_size():
+    assert split_ranges(3000, 8, min_size=1024) == [(0, 1499), (1500, 2999)]
+    assert split_ranges(500, 8, min_size=1024) == [(0, 499)]
+
+
+def test_journal_missing_merges_adjacent_ranges(tmp_path):
+    journal = RangeJournal(str(tmp_path / 'video.m4s'), 100, None)
+    assert journal.missing() == [(0, 99)]
+    journal.add(10, 19)
+    journal.add(20, 29)
+    journal.add(50, 59)
+    assert journal.done == [[10, 29], [50, 59]]
+    assert journal.missing() == [(0, 9), (30, 49), (60, 99)]
+    assert journal.completed() == 30
+
+    journal.add(0, 9)
+    journal.add(25, 99)
+    assert journal.missing() == []
+    assert journal.completed() == 100
+
+
+def test_journal_load_rejects_changed_remote(tmp_path):
+    filename = str(tmp_path / 'video.m4s')
+    (tmp_path / 'video.m4s').write_bytes(b'\0' * 100)
+    journal = RangeJournal(filename, 100, 'etag-1')
+    journal.add(0, 49)
+    journal.flush()
+
+    loaded = RangeJournal.load(filename, 100, 'etag-1')
+    assert loaded.missing() == [(50, 99)]
+    assert RangeJournal.load(filename, 100, 'etag-2') is None
+    assert RangeJournal.load(filename, 200, 'etag-1') is None
+
+
+def test_finish_journal_keeps_incomplete_journal(tmp_path):
+    filename = str(tmp_path / 'video.m4s')
+    (tmp_path / 'video.m4s').write_bytes(b'\0' * 100)
+    journal = RangeJournal(filename, 100, None)
+    journal.add(0, 89)
+
+    with pytest.raises(RuntimeError):
+        finish_journal(filename, journal)
+    assert json.loads(journal.path.read_text(encoding='utf-8'))['done'] == [[0, 89]]
+
+    journal.add(90, 99)
+    finish_journal(filename, journal)
+    assert not journal.path.exists()
+
+
+class TruncatingHandler(BaseHTTPRequestHandler):
+    """
+    完整请求在一半处断开；Range 请求声明到文件结尾，但每次只正常返回 CHUNK 字节就结束响应
+    """
+    payload = bytes(range(256)) * 1024
+    chunk = 32 * 1024
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.requests.append(header)
+        if not header:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.payload)))
+            self.end_headers()
+            self.wfile.write(self.payload[:len(self.payload) // 2])
+        else:
+            start = int(header[len('bytes='):].rstrip('-'))
+            body = self.payload[start:start + self.chunk]
+            self.send_response(206)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Content-Range', f'bytes {start}-{len(self.payload) - 1}/{len(self.payload)}')
+            self.end_headers()
+            self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def truncating_server(monkeypatch):
+    monkeypatch.setattr('retry.RetryPolicy.delay', lambda self, attempt: 0)
+    TruncatingHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TruncatingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/stream.m4s'
+    server.shutdown()
+    server.server_close()
+
+
+def test_iter_resumable_resumes_after_early_eof(truncating_server):
+    sizes = []
+    data = b''.join(iter_resumable(truncating_server, {}, 'stream.m4s', sizes.append))
+    assert data == TruncatingHandler.payload
+    assert sizes == [len(TruncatingHandler.payload)]
+    resumed = range(len(data) // 2, len(data), TruncatingHandler.chunk)
+    assert TruncatingHandler.requests == [None] + [f'bytes={pos}-' for pos in resumed]
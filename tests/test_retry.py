@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import pytest
+from curl_cffi.requests.exceptions import ConnectionError, HTTPError, ProxyError, RequestException, Timeout
+
+from range_download import IncompleteRangeError
+from retry import classify_error, retry_after
+
+
+def http_error(status: int, headers: dict = None) -> HTTPError:
+    return HTTPError(f'HTTP {status}', response=SimpleNamespace(status_code=status, headers=headers or {}))
+
+
+@pytest.mark.parametrize('error, policy', [
+    (http_error(412), 'throttle'),
+    (http_error(429), 'throttle'),
+    (http_error(500), 'server'),
+    (http_error(503), 'server'),
+    (http_error(403), None),
+    (http_error(404), None),
+    (ConnectionError('refused'), 'connect'),
+    (ProxyError('proxy'), 'connect'),
+    (Timeout('timeout'), 'read'),
+    (RequestException('reset'), 'read'),
+    (IncompleteRangeError('short read'), 'read'),
+    (ValueError('bad json'), None),
+    (KeyError('data'), None),
+])
+def test_classify_error(error, policy):
+    assert classify_error(error) == policy
+
+
+def test_http_error_without_response_is_read_error():
+    assert classify_error(HTTPError('HTTP error')) == 'read'
+
+
+def test_retry_after():
+    assert retry_after(http_error(429, {'Retry-After': '7'})) == 7
+    assert retry_after(http_error(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) is None
+    assert retry_after(http_error(503)) is None
+    assert retry_after(ValueError()) is None
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+import download_sync
+import stream_remux
+
+pytestmark = pytest.mark.skipif(not stream_remux.stream_remux_supported(), reason='需要命名管道')
+
+
+def plan_for(tmp_path):
+    return {'headers': {}, 'title': 't', 'video_url': 'video', 'audio_url': 'audio',
+            'video_file': str(tmp_path / 'v.m4s'), 'audio_file': str(tmp_path / 'a.m4s'),
+            'output_path': tmp_path / 'out.mp4', 'merge_path': tmp_path / 'merge.mp4'}
+
+
+def test_missing_ffmpeg_closes_stderr_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_remux, 'get_ffmpeg_path', lambda: str(tmp_path / 'no-ffmpeg'))
+    before = set(os.listdir('/proc/self/fd'))
+    # 保留异常的 traceback，防止栈帧被回收时顺带关闭了没有显式关闭的文件
+    with pytest.raises(FileNotFoundError) as excinfo:
+        stream_remux.stream_remux(plan_for(tmp_path), None)
+    assert excinfo.traceback
+    assert set(os.listdir('/proc/self/fd')) <= before
+
+
+def test_stream_merge_falls_back_without_ffmpeg(monkeypatch, tmp_path):
+    monkeypatch.setattr(download_sync, 'get_ffmpeg_path', lambda: str(tmp_path / 'no-ffmpeg'))
+    monkeypatch.setattr(download_sync, 'stream_remux', lambda *args: pytest.fail('不应边下载边合并'))
+    downloaded = []
+    monkeypatch.setattr(download_sync, 'download_stream',
+                        lambda url, headers, filename, *args: downloaded.append(url) or url)
+    plan = plan_for(tmp_path)
+    download_sync.fetch_streams(plan, None, stream_merge=True)
+    assert sorted(downloaded) == ['audio', 'video']
+    assert 'merged' not in plan
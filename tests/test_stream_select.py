@@ -0,0 +1,52 @@
+from stream_select import select_in_budget
+
+VIDEOS = [
+    {'id': 120, 'codecid': 7, 'bandwidth': 16_000_000},
+    {'id': 80, 'codecid': 7, 'bandwidth': 3_000_000},
+    {'id': 80, 'codecid': 12, 'bandwidth': 1_500_000},
+    {'id': 80, 'codecid': 13, 'bandwidth': 1_200_000},
+    {'id': 64, 'codecid': 7, 'bandwidth': 1_000_000},
+    {'id': 32, 'codecid': 7, 'bandwidth': 400_000},
+]
+AUDIOS = [
+    {'id': 30280, 'bandwidth': 320_000},
+    {'id': 30216, 'bandwidth': 64_000},
+]
+
+
+def selected(video: dict, audio: dict) -> tuple:
+    return video['id'], video['codecid'], audio['id']
+
+
+def test_no_budget_picks_best_quality():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None)) == (120, 7, 30280)
+
+
+def test_quality_cap_prefers_smaller_codec():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, 80, None)) == (80, 13, 30280)
+
+
+def test_codec_filter():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, 80, 12)) == (80, 12, 30280)
+    # 没有该编码的流时不限编码
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, 32, 12)) == (32, 7, 30280)
+
+
+def test_max_bitrate():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None, max_bitrate=1_600_000)) == (80, 13, 30280)
+    # 画质相同时先降低音频码率
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None, max_bitrate=1_300_000)) == (80, 13, 30216)
+
+
+def test_max_size():
+    # 10 分钟的视频，(1_200_000 + 64_000) bps 约 94.8 MB
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None, max_size=95_000_000)) == (80, 13, 30216)
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None, max_size=90_000_000)) == (64, 7, 30216)
+
+
+def test_max_size_ignored_without_duration():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, None, None, None, max_size=1)) == (120, 7, 30280)
+
+
+def test_nothing_fits_uses_smallest_pair():
+    assert selected(*select_in_budget(VIDEOS, AUDIOS, 600, None, None, max_bitrate=1000)) == (32, 7, 30216)
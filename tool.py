@@ -1,6 +1,8 @@
+import codecs
 import json
 import os
 import re
+import string
 import subprocess
 from pathlib import Path
 from typing import Optional, Union, List
@@ -10,6 +12,11 @@ import typer
 from curl_cffi import requests
 
 from log_config import app_logger
+from meta_cache import meta_cache, page_cache_key
+from metrics import phase
+from rate_limit import request_limiter
+from retry import API_TIMEOUT, retryable
+from session_pool import borrow_session, close_async_response
 
 def parse_page_input(value: Optional[str]) -> Union[str, List[int]]:
     """
@@ -36,6 +43,20 @@ def parse_page_input(value: Optional[str]) -> Union[str, List[int]]:
             raise typer.BadParameter("必须是整数、范围或英文逗号分隔的整数")
 
 
+def parse_size(value: Optional[str]) -> Optional[int]:
+    """
+    解析带单位的字节数，例如 512K、10M、1.5G，不带单位时按字节处理
+    """
+    if value is None or value == "":
+        return None
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*', value, re.IGNORECASE)
+    if not match:
+        raise typer.BadParameter("大小格式应为数字加可选单位，例如 512K、10M、1.5G")
+    number, unit = match.groups()
+    return int(float(number) * units.get(unit.upper(), 1))
+
+
 def sanitize_filename(name: str, replacement: str = "_") -> str:
     """
     清理视频名称中的非法字符，使其可以安全作为文件名。
@@ -68,57 +89,253 @@ def sanitize_filename(name: str, replacement: str = "_") -> str:
     return name[:240]  # 留一点空间给文件扩展名
 
 
+# 页面中需要提取的内容：(用于快速定位的字面量, 在定位处做校验的正则)
+# 先用 str.find 定位字面量，再在该位置做一次锚定匹配，避免正则逐字符回溯扫描整个页面；
+# 正则忽略大小写时字面量写成小写，在页面的小写副本中查找
+PAGE_MARKERS = {
+    'title': ('<title', re.compile(r'<title\b[^>]*>', re.IGNORECASE)),
+    'playinfo': ('window.__playinfo__', re.compile(r'window\.__playinfo__\s*=\s*')),
+    'initial_state': ('window.__INITIAL_STATE__', re.compile(r'window\.__INITIAL_STATE__\s*=\s*')),
+    'playurl_ssr_data': ('playurlSSRData', re.compile(r'playurlSSRData\s*=\s*')),
+}
+PAGE_FIELDS = tuple(PAGE_MARKERS)
+# 只转换 ASCII 字母，保证小写副本和原文的下标一一对应
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+_json_decoder = json.JSONDecoder()
+
+
+class PageExtractor:
+    """
+    单次扫描的页面内容提取器
+
+    支持分块喂入页面内容（feed），扫描位置只向前推进；找到标记后用 raw_decode 按括号配对
+    直接解码其后的 JSON，并从 JSON 结尾继续扫描，不会对同一段内容重复匹配。
+    required 中的字段全部找到后 feed 返回 True，调用方可以提前停止读取响应。
+    """
+
+    def __init__(self, required: tuple = PAGE_FIELDS):
+        self.buffer = ''
+        # buffer 的小写副本，按需补齐
+        self.folded = ''
+        self.pos = 0
+        self.required = set(required)
+        self.result = dict.fromkeys(PAGE_FIELDS)
+        # 每个标记的查找缓存: name -> (下一次出现的位置或 -1, 确认此前没有该标记的位置)
+        self.hits = {}
+
+    @property
+    def done(self) -> bool:
+        return all(self.result[name] is not None for name in self.required)
+
+    def feed(self, text: str) -> bool:
+        self.buffer += text
+        self._scan(final=False)
+        return self.done
+
+    def finish(self) -> dict:
+        self._scan(final=True)
+        return self.result
+
+    def _lower(self) -> str:
+        if len(self.folded) < len(self.buffer):
+            self.folded += self.buffer[len(self.folded):].translate(_ASCII_LOWER)
+        return self.folded
+
+    def _find(self, name: str) -> int:
+        anchor, pattern = PAGE_MARKERS[name]
+        index, searched = self.hits.get(name, (-1, 0))
+        if index >= self.pos:
+            return index
+        text = self._lower() if pattern.flags & re.IGNORECASE else self.buffer
+        index = text.find(anchor, max(self.pos, searched - len(anchor)))
+        # 找到时只能确认 index 之前没有该标记，之后的内容在这次匹配失败时还需要继续查找
+        self.hits[name] = (index, index if index != -1 else len(self.buffer))
+        return index
+
+    def _scan(self, final: bool):
+        while not self.done:
+            candidates = [(self._find(name), name) for name in PAGE_FIELDS if self.result[name] is None]
+            candidates = [c for c in candidates if c[0] != -1]
+            if not candidates:
+                return
+            index, name = min(candidates)
+
+            match = PAGE_MARKERS[name][1].match(self.buffer, index)
+            if not match:
+                # 标记后面的内容可能还没有接收到
+                if not final and len(self.buffer) - index < 64:
+                    self.pos = index
+                    return
+                self.pos = index + 1
+                continue
+
+            if name == 'title':
+                end = self._lower().find('</title>', match.end())
+                if end == -1:
+                    if final:
+                        self.pos = match.end()
+                        continue
+                    self.pos = index
+                    return
+                self.result['title'] = self.buffer[match.end():end].strip()
+                self.pos = end
+                continue
+
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, match.end())
+            except json.JSONDecodeError:
+                if not final:
+                    # JSON 还没有接收完整，等待后续内容
+                    self.pos = index
+                    return
+                app_logger.warning(f"解析 {name} 的 JSON 出错")
+                self.pos = match.end()
+                continue
+            self.result[name] = value
+            self.pos = end
+
+
+def extract_page(html_content: str) -> dict:
+    """
+    单次扫描提取页面中的 title, playinfo, initial_state, playurl_ssr_data
+    """
+    extractor = PageExtractor()
+    extractor.buffer = html_content
+    return extractor.finish()
+
+
+def read_page(resp, required: tuple = PAGE_FIELDS, chunk_size: int = 64 * 1024) -> dict:
+    """
+    从流式响应中边读边提取页面内容，required 中的字段全部找到后提前停止读取
+
+    注意 resp 需要以 stream=True 发起
+    """
+    decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    extractor = PageExtractor(required)
+    try:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            with phase('extract'):
+                if extractor.feed(decoder.decode(chunk)):
+                    break
+        else:
+            with phase('extract'):
+                extractor.feed(decoder.decode(b'', final=True))
+    finally:
+        resp.close()
+    with phase('extract'):
+        return extractor.finish()
+
+
+async def read_page_async(resp, required: tuple = PAGE_FIELDS) -> dict:
+    """
+    read_page 的协程版本，resp 为 AsyncSession 以 stream=True 发起的响应
+    """
+    decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    extractor = PageExtractor(required)
+    try:
+        resp.raise_for_status()
+        async for chunk in resp.aiter_content():
+            with phase('extract'):
+                if extractor.feed(decoder.decode(chunk)):
+                    break
+        else:
+            with phase('extract'):
+                extractor.feed(decoder.decode(b'', final=True))
+    finally:
+        await close_async_response(resp)
+    with phase('extract'):
+        return extractor.finish()
+
+
+def page_required_fields(url: str) -> tuple:
+    """
+    不同类型的页面包含的内容不同，返回该页面确定会出现的字段，用于提前结束读取
+    """
+    if '/video/BV' in url:
+        return 'title', 'playinfo', 'initial_state'
+    return PAGE_FIELDS
+
+
+def fetch_page(url: str, headers: dict) -> dict:
+    """
+    获取页面并提取其中的 title, playinfo, initial_state, playurl_ssr_data，结果会写入元数据缓存
+    """
+    cache_key = page_cache_key(url, headers)
+    page = meta_cache.get('page', cache_key)
+    if page is None:
+        page = request_page(url, headers)
+        meta_cache.set('page', cache_key, page)
+    return page
+
+
+@retryable
+def request_page(url: str, headers: dict) -> dict:
+    request_limiter.acquire()
+    with phase('page_fetch'), borrow_session(url) as session:
+        resp = session.get(url, headers=headers, timeout=API_TIMEOUT, stream=True)
+        return read_page(resp, page_required_fields(url))
+
+
+async def fetch_page_async(session, url: str, headers: dict) -> dict:
+    """
+    fetch_page 的协程版本，使用 AsyncSession 请求页面
+    """
+    cache_key = page_cache_key(url, headers)
+    page = meta_cache.get('page', cache_key)
+    if page is None:
+        page = await request_page_async(session, url, headers)
+        meta_cache.set('page', cache_key, page)
+    return page
+
+
+@retryable
+async def request_page_async(session, url: str, headers: dict) -> dict:
+    await request_limiter.acquire_async()
+    with phase('page_fetch'):
+        resp = await session.get(url, headers=headers, timeout=API_TIMEOUT, stream=True)
+        return await read_page_async(resp, page_required_fields(url))
+
+
 def extract_playinfo_json(html_content: str):
-    match = re.search(r'window\.__playinfo__\s*=\s*(\{.*?})\s*</script>', html_content, re.DOTALL)
-    if match:
-        json_str = match.group(1)
-        try:
-            playinfo = json.loads(json_str)
-            return playinfo
-        except json.JSONDecodeError:
-            app_logger.exception(f"解析 JSON 出错")
-            return None
-    else:
+    playinfo = extract_page(html_content)['playinfo']
+    if playinfo is None:
         app_logger.warning("没有找到 window.__playinfo__ 的内容")
-        return None
+    return playinfo
 
 
 def extract_initial_state_json(html_content: str):
-    match = re.search(r'window\.__INITIAL_STATE__\s*=\s*(\{.*?})\s*;', html_content, re.DOTALL)
-    if match:
-        json_str = match.group(1)
-        try:
-            initial_state = json.loads(json_str)
-            return initial_state
-        except json.JSONDecodeError:
-            app_logger.exception(f"解析 JSON 出错")
-            return None
-    else:
+    initial_state = extract_page(html_content)['initial_state']
+    if initial_state is None:
         app_logger.warning("没有找到 window.__INITIAL_STATE__ 的内容")
-        return None
+    return initial_state
 
 
 def extract_title(html_content: str) -> str | None:
-    match = re.search(r'<title\b[^>]*>(.*?)</title>', html_content, re.IGNORECASE | re.DOTALL)
-    if match:
-        title = match.group(1).strip()
+    title = extract_page(html_content)['title']
+    if title is not None:
         return sanitize_filename(title)
     return None
 
 
 def extract_playurl_ssr_data(html_content: str) -> dict | None:
-    pattern = r'const\s+playurlSSRData\s*=\s*({.*?})\s'
-    match = re.search(pattern, html_content, re.DOTALL)
+    return extract_page(html_content)['playurl_ssr_data']
 
-    if match:
-        json_str = match.group(1)
-        try:
-            data = json.loads(json_str)
-            return data
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-    return None
 
+def get_ffmpeg_path() -> str:
+    """
+    Windows 下使用程序目录中打包的 ffmpeg.exe，其他平台使用系统的 ffmpeg
+    """
+    import sys, platform
+
+    if platform.system() == 'Windows':
+        if getattr(sys, "frozen", False):
+            base_dir = os.path.dirname(__file__)
+        else:
+            base_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(base_dir, 'ffmpeg.exe')
+    return '/usr/bin/ffmpeg'
 
 
 def merge_m4s_ffmpeg(video_file, audio_file, output_file):
@@ -133,8 +350,6 @@ def merge_m4s_ffmpeg(video_file, audio_file, output_file):
     Returns:
         bool: True 如果合并成功，False 如果失败。
     """
-    import sys, platform
-
     if not Path(video_file).exists():
         app_logger.error("无法找到 video m4s 文件")
         return None
@@ -142,16 +357,9 @@ def merge_m4s_ffmpeg(video_file, audio_file, output_file):
         app_logger.error("无法找到 audio m4s 文件")
         return None
 
-    if platform.system() == 'Windows':
-        if getattr(sys, "frozen", False):
-            base_dir = os.path.dirname(__file__)
-        else:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-        ffmpeg_path = os.path.join(base_dir, 'ffmpeg.exe')
-    else:
-        ffmpeg_path = '/usr/bin/ffmpeg'
-
-    command = [ffmpeg_path, '-i', video_file, '-i', audio_file, '-c', 'copy', output_file]
+    ffmpeg_path = get_ffmpeg_path()
+    # -nostdin -y：不等待终端输入，目标文件已存在时直接覆盖
+    command = [ffmpeg_path, '-nostdin', '-y', '-i', video_file, '-i', audio_file, '-c', 'copy', output_file]
 
     try:
         # 执行命令并等待完成
@@ -0,0 +1,136 @@
+import hashlib
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlencode
+
+from job_queue import JobQueue
+from log_config import app_logger
+from meta_cache import meta_cache
+from playurl_api import api_get
+from rate_limit import request_limiter
+from retry import API_TIMEOUT, retryable
+from session_pool import borrow_session
+from sync_state import SyncState
+
+NAV_URL = 'https://api.bilibili.com/x/web-interface/nav'
+SPACE_VIDEOS_URL = 'https://api.bilibili.com/x/space/wbi/arc/search'
+VIDEO_URL = 'https://www.bilibili.com/video/{bvid}'
+
+# 投稿列表每页的视频数量（接口上限为 50）
+SPACE_PAGE_SIZE = 50
+# 首次同步时同时请求的投稿列表页数
+PAGE_JOBS = 4
+
+# WBI 签名时打乱 img_key + sub_key 的顺序表
+MIXIN_KEY_ENC_TAB = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40, 61,
+    26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11, 36,
+    20, 34, 44, 52,
+]
+
+
+@retryable
+def request_wbi_keys(headers: dict) -> list[str]:
+    request_limiter.acquire()
+    with borrow_session(NAV_URL) as session:
+        resp = session.get(NAV_URL, headers=headers, timeout=API_TIMEOUT)
+    resp.raise_for_status()
+    # 未登录时接口 code 为 -101，但同样会返回 wbi_img
+    wbi_img = resp.json()['data']['wbi_img']
+    return [url.rsplit('/', 1)[-1].split('.')[0] for url in (wbi_img['img_url'], wbi_img['sub_url'])]
+
+
+def sign_wbi(params: dict, headers: dict) -> dict:
+    """
+    为需要 WBI 签名的接口加上 wts 和 w_rid 参数
+    """
+    img_key, sub_key = meta_cache.get_or_load('wbi_keys', 'nav', lambda: request_wbi_keys(headers))
+    mixin_key = ''.join((img_key + sub_key)[i] for i in MIXIN_KEY_ENC_TAB)[:32]
+    signed = dict(params, wts=int(time.time()))
+    signed = {key: ''.join(c for c in str(value) if c not in "!'()*") for key, value in sorted(signed.items())}
+    signed['w_rid'] = hashlib.md5((urlencode(signed) + mixin_key).encode('utf-8')).hexdigest()
+    return signed
+
+
+def get_space_page(mid: int, pn: int, headers: dict) -> dict:
+    """
+    按发布时间从新到旧获取 UP 主投稿列表的第 pn 页
+    """
+    params = sign_wbi({'mid': mid, 'pn': pn, 'ps': SPACE_PAGE_SIZE, 'order': 'pubdate'}, headers)
+    return api_get(SPACE_VIDEOS_URL, headers, params)['data']
+
+
+def is_new(video: dict, watermark: Optional[dict]) -> bool:
+    if watermark is None:
+        return True
+    return video['created'] > watermark['pubdate'] or (
+            video['created'] == watermark['pubdate'] and video['bvid'] not in watermark['bvids'])
+
+
+def fetch_new_videos(mid: int, headers: dict, watermark: Optional[dict] = None,
+                     page_jobs: int = PAGE_JOBS) -> list[dict]:
+    """
+    获取 UP 主在水位线之后发布的投稿（从新到旧），watermark 为 None 时获取全部投稿
+
+    列表按发布时间倒序，某一页出现水位线之前的投稿时就不再往后翻。日常同步通常只需要请求第一页；
+    首次同步时由第一页得到总页数，其余页每次并发请求 page_jobs 页。
+    """
+    videos = {}
+
+    def collect(data: dict) -> bool:
+        """
+        收集一页中的新投稿，返回这一页是否已经到达水位线
+        """
+        reached = False
+        for video in data['list']['vlist'] or []:
+            if is_new(video, watermark):
+                videos.setdefault(video['bvid'], video)
+            else:
+                reached = True
+        return reached
+
+    first = get_space_page(mid, 1, headers)
+    pages = max(1, math.ceil(first['page']['count'] / SPACE_PAGE_SIZE))
+    reached = collect(first)
+    pn = 2
+    with ThreadPoolExecutor(max_workers=page_jobs, thread_name_prefix='bilix-space') as executor:
+        while not reached and pn <= pages:
+            batch = range(pn, min(pages, pn + page_jobs - 1) + 1)
+            for data in executor.map(lambda p: get_space_page(mid, p, headers), batch):
+                reached = collect(data) or reached
+            pn = batch.stop
+    app_logger.debug(f'UP 主 {mid} 共 {pages} 页投稿，请求了 {min(pn, pages + 1) - 1} 页')
+    return sorted(videos.values(), key=lambda video: video['created'], reverse=True)
+
+
+def next_watermark(videos: list[dict], watermark: Optional[dict]) -> dict:
+    """
+    同步 videos 后的水位线，videos 为从新到旧排列的新投稿
+    """
+    pubdate = videos[0]['created']
+    bvids = [video['bvid'] for video in videos if video['created'] == pubdate]
+    if watermark and watermark['pubdate'] == pubdate:
+        bvids += watermark['bvids']
+    return {'pubdate': pubdate, 'bvids': bvids}
+
+
+def sync_uploader(mid: int, headers: dict, sync_state: SyncState, job_queue: JobQueue, quality: Optional[int],
+                  codec: Optional[str], save: Optional[str], full: bool = False, page_jobs: int = PAGE_JOBS) -> int:
+    """
+    把 UP 主的新投稿加入下载队列并更新水位线，返回新加入队列的数量
+
+    先写入队列再更新水位线，中途退出时下次同步会重新发现这些投稿，队列会忽略重复的任务。
+    full 为 True 时忽略水位线，重新检查全部投稿。
+    """
+    watermark = None if full else sync_state.watermark(mid)
+    videos = fetch_new_videos(mid, headers, watermark, page_jobs)
+    # 先发布的先下载
+    added = job_queue.add([(VIDEO_URL.format(bvid=video['bvid']), quality, codec, save)
+                           for video in reversed(videos)])
+    if videos:
+        sync_state.set_watermark(mid, next_watermark(videos, watermark), added)
+    app_logger.info(f'UP 主 {mid}: 新投稿 {len(videos)} 个，加入队列 {added} 个')
+    return added
@@ -1,17 +1,25 @@
-from curl_cffi import requests
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
 
 from log_config import app_logger
+from retry import API_TIMEOUT, retryable
+from session_pool import borrow_session
+
+
+@retryable
+def request_json(url: str, headers: dict, params: dict = None) -> dict:
+    with borrow_session(url) as session:
+        resp = session.get(url, headers=headers, timeout=API_TIMEOUT, params=params)
+    resp.raise_for_status()
+    return resp.json()
 
 
 def get_user_info(headers):
     url1 = 'https://api.bilibili.com/x/web-interface/nav'
     # url2 = 'https://api.bilibili.com/x/space/myinfo'
     url3 = 'https://api.bilibili.com/x/relation/stat'
-    resp1 = requests.get(url1, headers=headers, timeout=5)
-    resp1_json = resp1.json()
+    resp1_json = request_json(url1, headers)
     # resp2 = requests.get(url2, headers=headers, timeout=5)
     # resp2_json = resp2.json()
 
@@ -26,8 +34,7 @@ def get_user_info(headers):
         mid = data['mid']
         level = data['level_info']['current_level']
 
-        resp3 = requests.get(url3, headers=headers, timeout=5, params={'vmid': mid})
-        resp3_json = resp3.json()
+        resp3_json = request_json(url3, headers, params={'vmid': mid})
 
         # 构造内容
         text = Text()
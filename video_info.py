@@ -1,10 +1,10 @@
-import json
 import math
 from abc import abstractmethod
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional, Union
 
-from curl_cffi import requests
 from curl_cffi.requests.exceptions import RequestException, HTTPError
 from rich.console import Console, Group
 from rich.panel import Panel
@@ -13,17 +13,34 @@ from rich.text import Text
 
 from global_param import codec_id_name_map
 from log_config import app_logger
-from tool import clean_bili_url, sanitize_filename
+from playurl_api import get_archive, get_bangumi_episode
+from tool import clean_bili_url, sanitize_filename, extract_page, fetch_page
 import re
 
 console = Console()
 
-class BiliVideoInfo:
+# --info 默认同时获取信息的视频数量
+INFO_JOBS = 8
+
+
+def quality_list(accept_quality: list, accept_description: list, streams: list, key: str = 'id') -> list[dict]:
+    """
+    可选清晰度及每个清晰度可用的编码，用于 JSON 输出
+    """
+    codecs = defaultdict(list)
+    for stream in streams:
+        codecs[stream[key]].append(codec_id_name_map.get(stream.get('codecid')))
+    return [{'id': quality, 'name': name, 'codecs': codecs.get(quality, [])}
+            for quality, name in zip(accept_quality, accept_description)]
+
 
-    playinfo_pattern = r'window\.__playinfo__\s*=\s*(\{.*?})\s*</script>'
-    initial_state_pattern = r'window\.__INITIAL_STATE__\s*=\s*(\{.*?})\s*;'
-    playurl_ssr_data_pattern = r'const\s+playurlSSRData\s*=\s*({.*?})\s'
-    title_pattern = r'<title\b[^>]*>(.*?)</title>'
+def episode_list(episodes: Optional[list]) -> list[dict]:
+    return [{'title': episode['title'], 'long_title': episode['long_title'], 'url': episode.get('share_url')}
+            for episode in episodes or []]
+
+
+class BiliVideoInfo:
+    kind = 'unknown'
 
     def __init__(self, url, headers):
         if not self.check_url_valid(url):
@@ -33,6 +50,7 @@ class BiliVideoInfo:
         self.playinfo = None
         self.initial_state = None
         self.playurl_ssr_data = None
+        self.page = None
         self.title = None
 
     @staticmethod
@@ -46,16 +64,6 @@ class BiliVideoInfo:
         )
         return bool(pattern.match(clean_bili_url(url)))
 
-    @staticmethod
-    def extract_json(pattern: str, text: str):
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(1))
-            except json.JSONDecodeError:
-                app_logger.warning(f'JSON decode failed for pattern: {pattern}')
-        return None
-
     @classmethod
     def from_url(cls, url: str, headers: dict):
         instance = cls(url, headers)
@@ -66,6 +74,12 @@ class BiliVideoInfo:
     def show(self):
         pass
 
+    def to_dict(self) -> dict:
+        """
+        供 --format json 输出的视频信息
+        """
+        return {'type': self.kind, 'url': self.url, 'title': self.title}
+
     def extract_video_time_length(self):
         return self.playinfo.get('data').get('timelength')
 
@@ -83,10 +97,7 @@ class BiliVideoInfo:
 
     def get_bvid_info(self):
         bvid = self.get_video_bvid()
-        bvid_info_url = 'https://api.bilibili.com/x/web-interface/wbi/view'
-        bvid_resp = requests.get(bvid_info_url, headers=self.headers, params={'bvid': bvid}, timeout=5)
-        bvid_resp_json = bvid_resp.json()
-        bvid_data = bvid_resp_json['data']
+        bvid_data = get_archive(bvid, self.headers)
         return {
             'tname': bvid_data['tname'],
             'tname_v2': bvid_data['tname_v2'],
@@ -97,22 +108,29 @@ class BiliVideoInfo:
         }
 
     def extract(self, html_content: str):
-        self.playinfo = self.extract_json(self.playinfo_pattern, html_content)
-        self.initial_state = self.extract_json(self.initial_state_pattern, html_content)
-        self.playurl_ssr_data = self.extract_json(self.playurl_ssr_data_pattern, html_content)
+        self.load_page(extract_page(html_content))
 
-        title_match = re.search(self.title_pattern, html_content, re.IGNORECASE | re.DOTALL)
-        if title_match:
-            self.title = sanitize_filename(title_match.group(1).strip())
+    def load_page(self, page: dict):
+        self.page = page
+        self.playinfo = page['playinfo']
+        self.initial_state = page['initial_state']
+        self.playurl_ssr_data = page['playurl_ssr_data']
+
+        if page['title'] is not None:
+            self.title = sanitize_filename(page['title'])
             # bangumi/media/md 无法提取到 title 需要特殊处理
             if not self.title and self.initial_state:
                 self.title = sanitize_filename(self.initial_state.get('mediaInfo').get('title'))
 
-    def parse(self):
+    def parse(self, page: Optional[dict] = None):
+        """
+        page 为已经获取过的页面时直接使用，不再重复请求
+        """
+        if page is not None:
+            self.load_page(page)
+            return
         try:
-            resp = requests.get(self.url, headers=self.headers, timeout=5)
-            resp.raise_for_status()
-            self.extract(resp.text)
+            self.load_page(fetch_page(self.url, self.headers))
         except HTTPError:
             app_logger.exception(f'HTTP error')
         except RequestException:
@@ -120,9 +138,11 @@ class BiliVideoInfo:
 
 
 class BiliNormalVideo(BiliVideoInfo):
-    def __init__(self, url, headers):
+    kind = 'video'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
         super().__init__(url, headers)
-        self.parse()
+        self.parse(page)
         self.time_length = self.extract_video_time_length()
         self.bvid_info = self.get_bvid_info()
 
@@ -191,13 +211,26 @@ class BiliNormalVideo(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        playinfo_data = self.playinfo.get('data')
+        return {
+            **super().to_dict(),
+            'aid': self.initial_state.get('aid'),
+            'bvid': self.initial_state.get('bvid'),
+            'cid': self.initial_state.get('cid'),
+            'format': playinfo_data.get('format'),
+            'duration': math.ceil(self.time_length / 1000),
+            **self.bvid_info,
+            'qualities': quality_list(playinfo_data['accept_quality'], playinfo_data['accept_description'],
+                                      playinfo_data['dash']['video']),
+        }
 
-class BiliMultiPartVideo(BiliVideoInfo):
-    def __init__(self, url, headers):
-        super().__init__(url, headers)
-        self.parse()
-        self.time_length = self.extract_video_time_length()
-        self.bvid_info = self.get_bvid_info()
+
+class BiliMultiPartVideo(BiliNormalVideo):
+    kind = 'multipart'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
+        super().__init__(url, headers, page)
         self.pages_info = self.extract_pages()
 
 
@@ -283,11 +316,20 @@ class BiliMultiPartVideo(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        return {
+            **super().to_dict(),
+            'pages': [{'page': page['page'], 'part': page['part'], 'duration': page['duration']}
+                      for page in self.pages_info],
+        }
+
 
 class BiliMovie(BiliVideoInfo):
-    def __init__(self, url, headers):
+    kind = 'movie'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
         super().__init__(url, headers)
-        self.parse()
+        self.parse(page)
 
 
     def show(self):
@@ -312,27 +354,24 @@ class BiliMovie(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        desc = self.initial_state['mediaInfo']['evaluate'] if self.initial_state else None
+        return {**super().to_dict(), 'desc': desc}
+
 
 class BiliBangumi(BiliVideoInfo):
-    def __init__(self, url, headers):
+    kind = 'bangumi'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
         super().__init__(url, headers)
-        self.parse()
+        self.parse(page)
         self.episodes = self.get_bangumi_episodes()
 
     def get_bangumi_episodes(self):
         md_id = self.url.split('/')[-1].replace('md', '')
         if 'ep' in md_id:
             return None
-        url1 = f'https://api.bilibili.com/pgc/review/user?media_id={md_id}'
-        resp1 = requests.get(url1, timeout=5)
-        resp1.raise_for_status()
-        season_id = resp1.json()['result']['media']['season_id']
-
-        url2 = f'https://api.bilibili.com/pgc/web/season/section?season_id={season_id}'
-        resp2 = requests.get(url2, timeout=5)
-        resp2.raise_for_status()
-        episodes = resp2.json()['result']['main_section']['episodes']
-        return episodes
+        return get_bangumi_episode(md_id)
 
     def show(self):
         text = Text()
@@ -358,27 +397,24 @@ class BiliBangumi(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), 'desc': self.initial_state['mediaInfo']['evaluate'],
+                'episodes': episode_list(self.episodes)}
+
 
 class BiliOther(BiliVideoInfo):
-    def __init__(self, url, headers):
+    kind = 'other'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
         super().__init__(url, headers)
-        self.parse()
+        self.parse(page)
         self.episodes = self.get_bangumi_episodes()
 
     def get_bangumi_episodes(self):
         md_id = self.url.split('/')[-1].replace('md', '')
         if 'ep' in md_id:
             return None
-        url1 = f'https://api.bilibili.com/pgc/review/user?media_id={md_id}'
-        resp1 = requests.get(url1, timeout=5)
-        resp1.raise_for_status()
-        season_id = resp1.json()['result']['media']['season_id']
-
-        url2 = f'https://api.bilibili.com/pgc/web/season/section?season_id={season_id}'
-        resp2 = requests.get(url2, timeout=5)
-        resp2.raise_for_status()
-        episodes = resp2.json()['result']['main_section']['episodes']
-        return episodes
+        return get_bangumi_episode(md_id)
 
     def show(self):
         text = Text()
@@ -404,13 +440,28 @@ class BiliOther(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), 'desc': self.initial_state['mediaInfo']['evaluate'],
+                'episodes': episode_list(self.episodes)}
+
 
 class BiliEpisode(BiliVideoInfo):
-    def __init__(self, url, headers):
+    kind = 'episode'
+
+    def __init__(self, url, headers, page: Optional[dict] = None):
         super().__init__(url, headers)
-        self.parse()
+        self.parse(page)
         self.bvid_info = self.get_bvid_info()
 
+    def extract_video_info(self) -> dict:
+        result = self.playurl_ssr_data.get('result')
+        raw = self.playurl_ssr_data.get('raw')
+        if result:
+            return result.get('video_info')
+        elif raw:
+            return raw.get('data').get('video_info')
+        raise ValueError('无法找到 video_info')
+
 
     def show(self):
         text = Text()
@@ -445,15 +496,7 @@ class BiliEpisode(BiliVideoInfo):
 
         text.append('单集简介: ', desc_style).append(f'{self.bvid_info["desc"]}\n', info_style)
 
-        result = self.playurl_ssr_data.get('result')
-        raw = self.playurl_ssr_data.get('raw')
-
-        if result:
-            video_info = result.get('video_info')
-        elif raw:
-            video_info = raw.get('data').get('video_info')
-        else:
-            raise ValueError('无法找到 video_info')
+        video_info = self.extract_video_info()
 
         accept_quality = video_info['accept_quality']
         accept_description = video_info['accept_description']
@@ -485,28 +528,67 @@ class BiliEpisode(BiliVideoInfo):
 
         console.print(panel)
 
+    def to_dict(self) -> dict:
+        video_info = self.extract_video_info()
+        if video_info.get('dash'):
+            qualities = quality_list(video_info['accept_quality'], video_info['accept_description'],
+                                     video_info['dash']['video'])
+        else:
+            qualities = quality_list(video_info['accept_quality'], video_info['accept_description'],
+                                     video_info.get('durls') or [], key='quality')
+        return {**super().to_dict(), **self.bvid_info, 'qualities': qualities}
+
 
 def create_bili_video(url: str, headers: dict) -> BiliVideoInfo:
+    """
+    根据页面内容创建对应类型的视频信息，页面只请求一次，解析结果直接交给具体的子类使用
+    """
     clean_url = clean_bili_url(url)
     bv = BiliVideoInfo.from_url(clean_url, headers)
+    page = bv.page
+    if page is None:
+        raise ValueError(f'获取页面失败: {url}')
     if 'video/BV' in clean_url:
         if len(bv.initial_state['videoData']['pages']) > 1:
-            return BiliMultiPartVideo(url, headers)
-        return BiliNormalVideo(url, headers)
+            return BiliMultiPartVideo(url, headers, page)
+        return BiliNormalVideo(url, headers, page)
     elif '/bangumi/play/' in clean_url:
-        return BiliEpisode(url, headers)
+        return BiliEpisode(url, headers, page)
     elif '/bangumi/media/md' in clean_url:
         type_name = bv.initial_state.get('mediaInfo').get('type_name')
         if type_name == '电影':
-            return BiliMovie(url, headers)
+            return BiliMovie(url, headers, page)
         elif type_name == '番剧':
-            return BiliBangumi(url, headers)
+            return BiliBangumi(url, headers, page)
         else:
-            return BiliOther(url, headers)
+            return BiliOther(url, headers, page)
     else:
         raise ValueError(f"不支持的 URL: {url}")
 
 
+def resolve_video_infos(urls: list[str], headers: dict, jobs: int = INFO_JOBS) -> list[Union[BiliVideoInfo, Exception]]:
+    """
+    并发获取多个视频的信息，按 urls 的顺序返回，获取失败的视频对应位置为异常
+
+    每个视频使用 headers 的副本并以自身 URL 作为 Referer。
+    """
+    def resolve(url: str) -> Union[BiliVideoInfo, Exception]:
+        try:
+            return create_bili_video(url, dict(headers, Referer=url))
+        except Exception as e:
+            app_logger.error(f'获取视频信息失败: {url}, {e!r}')
+            return e
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(resolve, urls))
+
+
+def video_info_dict(url: str, result: Union[BiliVideoInfo, Exception]) -> dict:
+    if isinstance(result, Exception):
+        return {'url': url, 'error': repr(result)}
+    return result.to_dict()
+
+
 def main():
     urls = [
         'https://www.bilibili.com/video/BV1yt4y1Q7SS/',